@@ -0,0 +1,111 @@
+"""
+Compares the per-group mask partitioning previously used by insert_raw_data.get_data with the
+single sort + contiguous group pass of the current get_data, on a synthetic file of 100 variables and up to 12 months of
+hourly data. Thresholds are fixed, so no database access is needed.
+
+    cd api && python benchmarks/bench_ingest_partition.py
+"""
+import datetime
+import os
+import sys
+import time
+from unittest import mock
+
+import django
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tempestas_api.settings")
+django.setup()
+
+from wx.decoders.insert_raw_data import columns, insert_columns, qc_thresholds_columnar, get_data
+
+VARIABLES = 100
+INTERVAL = 3600
+
+THRESHOLDS = {
+    'step_min': -5, 'step_max': 5, 'step_description': 'Benchmark threshold',
+    'range_min': 0, 'range_max': 100, 'range_description': 'Benchmark threshold',
+}
+
+
+def synthetic_reads(months):
+    start = datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc)
+    end = datetime.datetime(2023 + months // 12, months % 12 + 1, 1, tzinfo=datetime.timezone.utc)
+    datetimes = pd.date_range(start, end, freq=f'{INTERVAL}s', closed='left')
+
+    rng = np.random.default_rng(0)
+    frames = []
+    for variable_id in range(1, VARIABLES + 1):
+        frames.append(pd.DataFrame({
+            'station_id': 1,
+            'variable_id': variable_id,
+            'seconds': INTERVAL,
+            'datetime': datetimes,
+            'measured': rng.uniform(0, 110, len(datetimes)),
+        }))
+
+    df = pd.concat(frames, ignore_index=True)
+    # Decoders emit the file row by row, one read per variable
+    df = df.sort_values(by=['datetime', 'variable_id'], kind='mergesort')
+    for column in columns:
+        if column not in df:
+            df[column] = None
+
+    return df[columns].values.tolist()
+
+
+def mask_partition(raw_data_list):
+    df = pd.DataFrame(raw_data_list, columns=columns)
+    df['created_at'] = df['updated_at'] = datetime.datetime.now(datetime.timezone.utc)
+    df['month'] = pd.to_datetime(df['datetime']).dt.month
+
+    reads = []
+    for idx, [station_id, variable_id, seconds, month] in df[['station_id', 'variable_id', 'seconds', 'month']].drop_duplicates().iterrows():
+        df1 = df.loc[(df.station_id == station_id) &
+                     (df.variable_id == variable_id) &
+                     (df.seconds == seconds) &
+                     (df.month == month)].copy()
+        df1.sort_values(by='datetime', inplace=True)
+        df1['diff_value'] = df1.measured.diff(periods=1)
+        df1['diff_datetime'] = df1.datetime.diff(periods=1).dt.total_seconds().replace(np.nan, 0).astype("int32")
+        df1 = qc_thresholds_columnar(df1, THRESHOLDS)
+        reads.extend(df1[insert_columns].values.tolist())
+
+    return reads
+
+
+def contiguous_partition(raw_data_list):
+    # The shipped get_data, with the fixed thresholds instead of the database lookup
+    with mock.patch('wx.qc_thresholds.load_qc_thresholds'), \
+            mock.patch('wx.qc_thresholds.get_group_thresholds', return_value=THRESHOLDS):
+        return get_data(raw_data_list)
+
+
+def timed(function, raw_data_list):
+    start = time.perf_counter()
+    reads = function(raw_data_list)
+    return time.perf_counter() - start, reads
+
+
+def main():
+    print(f"{'months':>6} {'rows':>9} {'groups':>6} {'mask (s)':>9} {'contiguous (s)':>14} {'speedup':>7}")
+    for months in (1, 3, 6, 12):
+        raw_data_list = synthetic_reads(months)
+
+        mask_time, mask_reads = timed(mask_partition, raw_data_list)
+        contiguous_time, contiguous_reads = timed(contiguous_partition, raw_data_list)
+
+        # Both must flag the same reads, regardless of the output order and of updated_at/created_at
+        def flagged(reads):
+            return sorted(tuple(read[:-2]) for read in reads)
+
+        assert flagged(mask_reads) == flagged(contiguous_reads)
+
+        print(f"{months:>6} {len(raw_data_list):>9} {VARIABLES * months:>6} {mask_time:>9.2f} "
+              f"{contiguous_time:>14.2f} {mask_time / contiguous_time:>6.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""
+Compares the row-wise persistence QC (set_persist through DataFrame.apply) with the rolling window
+persist_flags on a week of 1-minute data and the 96-hour manual station window. No database access
+is needed.
+
+    cd api && python benchmarks/bench_persist_qc.py
+"""
+import os
+import sys
+import time
+
+import django
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tempestas_api.settings")
+django.setup()
+
+from wx.tasks import persist_flags, set_persist
+
+INTERVAL = 60
+WINDOW = 96 * 3600
+
+THRESHOLDS = {'persist_min': 0.5, 'persist_des': 'Benchmark threshold'}
+
+
+def synthetic_series(days):
+    # The window before the updated period is fetched as well, as in get_persist_raw_data
+    start = pd.Timestamp('2023-01-01', tz='UTC')
+    datetimes = pd.date_range(start - pd.Timedelta(seconds=WINDOW), start + pd.Timedelta(days=days),
+                              freq=f'{INTERVAL}s', closed='left')
+
+    rng = np.random.default_rng(0)
+    measured = np.round(rng.normal(25, 0.2, len(datetimes)), 1)
+    # A stuck sensor for a day
+    measured[len(measured) // 2:len(measured) // 2 + 1440] = 25.0
+
+    df = pd.DataFrame({'datetime': datetimes, 'measured': measured, 'station_id': 1, 'variable_id': 10})
+    df['qc_persist_quality_flag'] = np.where(rng.random(len(df)) < 0.001, 3, np.nan)
+    df['qc_persist_description'] = None
+    df['qc_range_quality_flag'] = 4
+    df['qc_step_quality_flag'] = 4
+    df['updated'] = df['datetime'] >= start
+
+    return df, start, datetimes[-1]
+
+
+def row_wise(df, s_datetime, e_datetime):
+    df = df.copy()
+    columns = ['updated', 'qc_persist_quality_flag', 'qc_persist_description', 'quality_flag']
+    df[columns] = df.apply(lambda row: set_persist(row, df, s_datetime, e_datetime, INTERVAL, WINDOW, THRESHOLDS),
+                           axis=1, result_type="expand")
+    return df
+
+
+def main():
+    print(f"{'days':>4} {'rows':>7} {'row-wise (s)':>12} {'rolling (s)':>11} {'speedup':>8}")
+    for days in (1, 3, 7):
+        df, s_datetime, e_datetime = synthetic_series(days)
+
+        start = time.perf_counter()
+        expected = row_wise(df, s_datetime, e_datetime)
+        row_wise_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        result = persist_flags(df, s_datetime, e_datetime, WINDOW, THRESHOLDS)
+        rolling_time = time.perf_counter() - start
+
+        for column in ('updated', 'qc_persist_quality_flag', 'quality_flag'):
+            expected_values = expected[column].fillna(0).astype('float64').to_numpy()
+            result_values = result[column].fillna(0).astype('float64').to_numpy()
+            assert (expected_values == result_values).all(), column
+
+        print(f"{days:>4} {len(df):>7} {row_wise_time:>12.2f} {rolling_time:>11.3f} {row_wise_time / rolling_time:>7.0f}x")
+
+
+if __name__ == '__main__':
+    main()
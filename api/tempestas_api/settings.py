@@ -121,6 +121,12 @@ SURFACE_CONNECTION_STRING = "dbname={0} user={1} password={2} host={3}".format(o
                                                                                os.getenv('SURFACE_DB_PASSWORD'),
                                                                                os.getenv('SURFACE_DB_HOST'))
 
+# Process-wide pool used by the raw psycopg2 queries (wx.db_pool)
+SURFACE_DB_POOL_MAX_SIZE = int(os.getenv('SURFACE_DB_POOL_MAX_SIZE', 5))
+SURFACE_DB_POOL_TIMEOUT = int(os.getenv('SURFACE_DB_POOL_TIMEOUT', 30))
+SURFACE_DB_POOL_HEALTH_CHECK_INTERVAL = int(os.getenv('SURFACE_DB_POOL_HEALTH_CHECK_INTERVAL', 60))
+SURFACE_DB_POOL_MAX_IDLE = int(os.getenv('SURFACE_DB_POOL_MAX_IDLE', 600))
+
 # Password validation
 # https://docs.djangoproject.com/en/1.11/ref/settings/#auth-password-validators
 
@@ -184,6 +190,11 @@ SIMPLE_JWT = {
 SURFACE_DATA_DIR = os.getenv('SURFACE_DATA_DIR', '/data')
 SURFACE_BROKER_URL = os.getenv('SURFACE_BROKER_URL', 'redis://localhost:6379/0')
 
+# Results are only kept for the tasks that need them (the export bundle chords)
+CELERY_RESULT_BACKEND = os.getenv('SURFACE_RESULT_BACKEND', SURFACE_BROKER_URL)
+CELERY_TASK_IGNORE_RESULT = True
+CELERY_RESULT_EXPIRES = 24 * 60 * 60
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -260,6 +271,38 @@ SESSION_EXPIRE_AT_BROWSER_CLOSE = False
 SESSION_COOKIE_AGE = 2 * 60 * 60
 EXPORTED_DATA_CELERY_PATH = '/data/exported_data/'
 
+# Comma separated decoder names (e.g. TOA5,HOBO) whose reads are bulk loaded into raw_data with COPY
+RAW_DATA_COPY_DECODERS = [decoder.strip() for decoder in os.getenv('RAW_DATA_COPY_DECODERS', '').split(',') if decoder.strip()]
+
+# Hourly and daily summaries are upserted from the raw_data_15min_summary continuous aggregate instead of raw_data
+SUMMARY_CONTINUOUS_AGGREGATES = os.getenv('SUMMARY_CONTINUOUS_AGGREGATES', 'False') == 'True'
+
+# Workers (and database connections) used at the same time by wx.tasks.rebuild_summaries
+SUMMARY_REBUILD_CONCURRENCY = int(os.getenv('SUMMARY_REBUILD_CONCURRENCY', 4))
+# Celery queue of the summary rebuild workers, consumed by a dedicated worker started with
+# --concurrency SUMMARY_REBUILD_CONCURRENCY, so a rebuild never holds the workers of the regular summary tasks.
+SUMMARY_REBUILD_QUEUE = 'summary_rebuild'
+
+# Celery queue of the export bundle station tasks, consumed by a dedicated worker started with
+# --concurrency EXPORT_BUNDLE_CONCURRENCY: at most that many stations (and database connections) are extracted at the
+# same time across all the bundles
+EXPORT_BUNDLE_QUEUE = 'export_bundle'
+EXPORT_BUNDLE_CONCURRENCY = int(os.getenv('EXPORT_BUNDLE_CONCURRENCY', 4))
+CELERY_TASK_ROUTES = {
+    'wx.tasks.process_summary_rebuild_tasks': {'queue': SUMMARY_REBUILD_QUEUE},
+    'wx.tasks.export_bundle_station': {'queue': EXPORT_BUNDLE_QUEUE},
+}
+
+# Larger exports requested for streaming are scheduled as files
+EXPORT_STREAM_MAX_ROWS = int(os.getenv('EXPORT_STREAM_MAX_ROWS', 50000))
+
+# Streams run at the same time on their own (not pooled) database connections, the others are scheduled as files.
+# Their queries are cancelled after EXPORT_STREAM_STATEMENT_TIMEOUT seconds, and their connection closed when the
+# client does not read for EXPORT_STREAM_IDLE_TIMEOUT seconds.
+EXPORT_STREAM_MAX_CONCURRENT = int(os.getenv('EXPORT_STREAM_MAX_CONCURRENT', 4))
+EXPORT_STREAM_STATEMENT_TIMEOUT = int(os.getenv('EXPORT_STREAM_STATEMENT_TIMEOUT', 300))
+EXPORT_STREAM_IDLE_TIMEOUT = int(os.getenv('EXPORT_STREAM_IDLE_TIMEOUT', 60))
+
 INMET_HOURLY_DATA_URL = os.getenv('INMET_HOURLY_DATA_URL')
 INMET_DAILY_DATA_BASE_PATH = os.getenv('INMET_DAILY_DATA_BASE_PATH')
 
@@ -223,6 +223,11 @@ class DailySummaryTaskAdmin(admin.ModelAdmin):
     list_display = ("created_at", "started_at", "finished_at", "station", "date")
 
 
+@admin.register(models.SummaryRebuildTask)
+class SummaryRebuildTaskAdmin(admin.ModelAdmin):
+    list_display = ("rebuild_id", "created_at", "started_at", "finished_at", "station", "start_date", "end_date")
+
+
 @admin.register(models.DcpMessages)
 class DcpMessagesAdmin(admin.ModelAdmin):
     list_display = ("noaa_dcp", "station", "datetime", "frequency_offset", "failure_code", "data_quality")
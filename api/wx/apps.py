@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class WxConfig(AppConfig):
     name = 'wx'
+
+    def ready(self):
+        # Connects the cache invalidation receivers
+        import wx.signals  # noqa: F401
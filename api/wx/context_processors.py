@@ -1,10 +1,20 @@
 import logging
+from time import time
 
-import psycopg2
 from django.conf import settings
+from django.core.cache import cache
+
+from wx.db_pool import get_connection
 
 logger = logging.getLogger('surface')
 
+# Bumped by the signals in wx.signals whenever group permissions or group memberships change
+WX_PERMISSIONS_VERSION_KEY = 'wx_permissions_version'
+WX_PERMISSIONS_CACHE_TIMEOUT = 24 * 60 * 60
+
+# user_id -> (version, permission map)
+_user_permissions = {}
+
 
 def get_surface_context(req):
     return {
@@ -34,8 +44,23 @@ def get_surface_context(req):
     }
 
 
-def get_user_wx_permissions(req):
-    with psycopg2.connect(settings.SURFACE_CONNECTION_STRING) as conn:
+def get_wx_permissions_version():
+    version = cache.get(WX_PERMISSIONS_VERSION_KEY)
+    if version is None:
+        version = time()
+        cache.add(WX_PERMISSIONS_VERSION_KEY, version, None)
+        version = cache.get(WX_PERMISSIONS_VERSION_KEY, version)
+    return version
+
+
+def invalidate_wx_permissions():
+    # Every process compares the version of its cached permission maps with this one
+    cache.set(WX_PERMISSIONS_VERSION_KEY, time(), None)
+    _user_permissions.clear()
+
+
+def load_user_wx_permissions(user_id):
+    with get_connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute(
                 """
@@ -45,7 +70,7 @@ def get_user_wx_permissions(req):
                     JOIN wx_wxgrouppermission as gp ON gp.id = gpp.wxgrouppermission_id
                     JOIN auth_user_groups as aug ON aug.group_id = gp.group_id 
                     WHERE aug.user_id = %s
-                """, (req.user.id,))
+                """, (user_id,))
 
             user_permissions = {}
             for row in cursor.fetchall():
@@ -54,4 +79,25 @@ def get_user_wx_permissions(req):
 
                 user_permissions[row[0]].append(row[1])
 
+    return user_permissions
+
+
+def get_user_wx_permissions(req):
+    user_id = req.user.id
+    if user_id is None:
+        return {'USER_PERMISSIONS': {}, 'USER_IS_ADMIN': 0}
+
+    # In process -> memcached -> database, all keyed by the current permissions version
+    version = get_wx_permissions_version()
+    cached = _user_permissions.get(user_id)
+    if cached is not None and cached[0] == version:
+        user_permissions = cached[1]
+    else:
+        cache_key = f'wx_user_permissions_{version}_{user_id}'
+        user_permissions = cache.get(cache_key)
+        if user_permissions is None:
+            user_permissions = load_user_wx_permissions(user_id)
+            cache.set(cache_key, user_permissions, WX_PERMISSIONS_CACHE_TIMEOUT)
+        _user_permissions[user_id] = (version, user_permissions)
+
     return {'USER_PERMISSIONS': user_permissions, 'USER_IS_ADMIN': 1 if req.user.is_superuser else 0}
@@ -0,0 +1,209 @@
+import logging
+import os
+import threading
+from time import time
+
+import psycopg2
+import psycopg2.extensions
+from psycopg2.pool import PoolError
+
+from tempestas_api import settings
+
+logger = logging.getLogger('surface')
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    """psycopg2 connection returned to the process pool by close() or at the end of a with block"""
+
+    def close(self):
+        self._pool.release(self)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            return super().__exit__(exc_type, exc_value, traceback)
+        finally:
+            self.close()
+
+    def __del__(self):
+        # Never given back (e.g. an exception before close), its slot must not be lost
+        if getattr(self, '_checked_out', False):
+            self._pool.forget(self)
+
+
+class ConnectionPool:
+
+    def __init__(self, dsn, max_size, timeout, health_check_interval, max_idle):
+        self.pid = os.getpid()
+        self.dsn = dsn
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.max_idle = max_idle
+
+        self._idle = []  # (connection, released_at)
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+
+        self.stats = {
+            'created': 0,
+            'reused': 0,
+            'discarded': 0,
+            'checkouts': 0,
+            'in_use': 0,
+            'waits': 0,
+            'wait_time': 0.0,
+            'timeouts': 0,
+            'health_checks': 0,
+            'failed_health_checks': 0,
+            'leaked': 0,
+        }
+
+    def acquire(self):
+        if not self._slots.acquire(blocking=False):
+            started_at = time()
+            acquired = self._slots.acquire(timeout=self.timeout)
+            with self._lock:
+                self.stats['waits'] += 1
+                self.stats['wait_time'] += time() - started_at
+                if not acquired:
+                    self.stats['timeouts'] += 1
+            if not acquired:
+                raise PoolError(f'No database connection available after {self.timeout} seconds '
+                                f'(max size {self.max_size}).')
+            logger.warning(f'Waited {time() - started_at:.3f} seconds for a pooled database connection.')
+
+        try:
+            conn = self._get_idle()
+            if conn is None:
+                conn = psycopg2.connect(self.dsn, connection_factory=PooledConnection)
+                conn._pool = self
+                with self._lock:
+                    self.stats['created'] += 1
+        except Exception:
+            self._slots.release()
+            raise
+
+        conn._checked_out = True
+        with self._lock:
+            self.stats['checkouts'] += 1
+            self.stats['in_use'] += 1
+        return conn
+
+    def _get_idle(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return None
+                conn, released_at = self._idle.pop()
+
+            if self._is_usable(conn, released_at):
+                with self._lock:
+                    self.stats['reused'] += 1
+                return conn
+
+            self._discard(conn)
+
+    def _is_usable(self, conn, released_at):
+        if conn.closed:
+            return False
+
+        idle_time = time() - released_at
+        if idle_time > self.max_idle:
+            return False
+
+        # Connections idle for a while may have been dropped by the server or a firewall
+        if idle_time > self.health_check_interval:
+            with self._lock:
+                self.stats['health_checks'] += 1
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute('SELECT 1')
+                conn.rollback()
+            except psycopg2.Error:
+                with self._lock:
+                    self.stats['failed_health_checks'] += 1
+                return False
+
+        return True
+
+    def _discard(self, conn):
+        with self._lock:
+            self.stats['discarded'] += 1
+        try:
+            psycopg2.extensions.connection.close(conn)
+        except psycopg2.Error:
+            pass
+
+    def release(self, conn):
+        # Connections inherited from a parent process belong to it
+        if not getattr(conn, '_checked_out', False) or self.pid != os.getpid():
+            return
+
+        conn._checked_out = False
+        with self._lock:
+            self.stats['in_use'] -= 1
+
+        try:
+            if conn.closed:
+                self._discard(conn)
+                return
+
+            # Uncommitted work is discarded, as it was when the connection was closed
+            if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+            if conn.autocommit:
+                conn.autocommit = False
+
+            with self._lock:
+                self._idle.append((conn, time()))
+        except psycopg2.Error:
+            self._discard(conn)
+        finally:
+            self._slots.release()
+
+    def forget(self, conn):
+        if self.pid != os.getpid():
+            return
+
+        conn._checked_out = False
+        with self._lock:
+            self.stats['in_use'] -= 1
+            self.stats['leaked'] += 1
+        self._slots.release()
+
+    def get_stats(self):
+        with self._lock:
+            idle = len(self._idle)
+        return dict(self.stats, idle=idle, max_size=self.max_size, pid=self.pid)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+# Pools inherited from a parent process (celery prefork, gunicorn) are kept referenced and never used:
+# closing or garbage collecting their connections in the child would also close them for the parent
+_inherited_pools = []
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.pid != os.getpid():
+            if _pool is not None:
+                _inherited_pools.append(_pool)
+            _pool = ConnectionPool(settings.SURFACE_CONNECTION_STRING,
+                                   max_size=settings.SURFACE_DB_POOL_MAX_SIZE,
+                                   timeout=settings.SURFACE_DB_POOL_TIMEOUT,
+                                   health_check_interval=settings.SURFACE_DB_POOL_HEALTH_CHECK_INTERVAL,
+                                   max_idle=settings.SURFACE_DB_POOL_MAX_IDLE)
+        return _pool
+
+
+def get_connection():
+    """Pooled replacement of psycopg2.connect(settings.SURFACE_CONNECTION_STRING); call close() or use it
+    in a with block to give it back"""
+    return get_pool().acquire()
+
+
+def pool_stats():
+    return get_pool().get_stats()
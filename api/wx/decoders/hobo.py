@@ -6,7 +6,7 @@ from datetime import datetime
 import pytz
 from celery import shared_task
 
-from wx.decoders.insert_raw_data import insert
+from wx.decoders.insert_raw_data import chunked, insert_stream
 from wx.decoders.insert_hf_data import insert as insert_hf
 from wx.models import VariableFormat, Station, StationVariable
 from wx.utils import update_station_variables
@@ -103,48 +103,55 @@ def read_header(file):
     pass
 
 
-@shared_task
-def read_file(filename, highfrequency_data=False, station_object=None, utc_offset=-360, override_data_on_conflict=False):
-    """Read a TOA5 file and return a seq of records or nil in case of error"""
+def read_lines(filename, station_object, utc_offset):
+    """Parse a HOBO file yielding one read at a time"""
+    with open(filename, 'r', encoding='ISO-8859-1') as source:
+        reader = csv_reader(source)
 
-    start = time.time()
+        if station_object is None:
+            station_code = parse_first_line_header(next(reader))
+            station = Station.objects.get(code=station_code)
+        else:
+            next(reader)  # skip station line
+            station = station_object
+            station_code = station.code
 
-    reads = []
+        lookup_table = parse_second_line_header(station, next(reader))
 
-    try:
-        with open(filename, 'r', encoding='ISO-8859-1') as source:
-            reader = csv_reader(source)
+        station_variables_list = StationVariable.objects.filter(station_id=station.id)
+        station_variables_dict = {}
+
+        for station_variable in station_variables_list:
+            station_variables_dict[station_variable.variable_id] = station_variable
+
+        for r in reader:
+            for line_data in parse_line(r, station, lookup_table, station_variables_dict, utc_offset):
+                yield line_data
 
-            if station_object is None:
-                station_code = parse_first_line_header(next(reader))
-                station = Station.objects.get(code=station_code)
-            else:
-                next(reader)  # skip station line
-                station = station_object
-                station_code = station.code
 
-            lookup_table = parse_second_line_header(station, next(reader))
+@shared_task
+def read_file(filename, highfrequency_data=False, station_object=None, utc_offset=-360, override_data_on_conflict=False):
+    """Read a HOBO file and insert its records in chunks"""
 
-            station_variables_list = StationVariable.objects.filter(station_id=station.id)
-            station_variables_dict = {}
+    start = time.time()
 
-            for station_variable in station_variables_list:
-                station_variables_dict[station_variable.variable_id] = station_variable
+    total_reads = 0
 
-            for r in reader:
-                for line_data in parse_line(r, station, lookup_table, station_variables_dict, utc_offset):
-                    reads.append(line_data)
+    reads = read_lines(filename, station_object, utc_offset)
+
+    try:
+        if highfrequency_data:
+            for chunk in chunked(reads):
+                insert_hf(chunk, override_data_on_conflict)
+                total_reads += len(chunk)
+        else:
+            total_reads = insert_stream(reads, override_data_on_conflict, decoder='HOBO')
 
     except FileNotFoundError as fnf:
         logger.error(repr(fnf))
         logger.error(f'No such file or directory {filename}.')
 
-    if highfrequency_data:
-        insert_hf(reads, override_data_on_conflict)
-    else:
-        insert(reads, override_data_on_conflict)
-
     end = time.time()
 
     logger.info(f'Processing file {filename} in {end - start} seconds, '
-                f'returning #reads={len(reads)}.')
+                f'returning #reads={total_reads}.')
@@ -4,13 +4,13 @@ import logging
 import time
 
 import pandas as pd
-import psycopg2
 import pytz
 from celery import shared_task
 
 from tempestas_api import settings
 from wx.decoders.insert_raw_data import insert
 from wx.decoders.insert_hf_data import insert as insert_hf
+from wx.db_pool import get_connection
 from wx.models import RatingCurve, RatingCurveTable
 
 logger = logging.getLogger('surface.manual_data')
@@ -34,7 +34,7 @@ def create_raw_data_line(station_id, variable_id, seconds, date, measurement):
 
 
 def get_interpolated_value(rating_curve, height):
-    with psycopg2.connect(settings.SURFACE_CONNECTION_STRING) as conn:
+    with get_connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute(
                 """
@@ -139,7 +139,7 @@ def read_file(filename, highfrequency_data=False, station_object=None, utc_offse
     if highfrequency_data:
         insert_hf(reads, override_data_on_conflict)
     else:
-        insert(reads, override_data_on_conflict)
+        insert(reads, override_data_on_conflict, decoder='HYDROLOGY')
 
     end = time.time()
 
@@ -1,11 +1,11 @@
-import logging, pytz, psycopg2
+import logging, pytz
 import numpy as np
 import pandas as pd
 from django.core.exceptions import ObjectDoesNotExist
 from django.utils import timezone
 from psycopg2.extras import execute_values
-from tempestas_api import settings
-from wx.models import StationVariable
+from wx.db_pool import get_connection
+from wx.decoders.insert_raw_data import upsert_station_variables
 
 logger = logging.getLogger('surface')
 
@@ -47,7 +47,7 @@ def get_data(raw_data_list):
     return reads
 
 def insert_query(reads, override_data_on_conflict):
-    with psycopg2.connect(settings.SURFACE_CONNECTION_STRING) as conn:
+    with get_connection() as conn:
         with conn.cursor() as cursor:
 
             logger.info(f'Inserting into database #{len(reads)} records.')
@@ -117,25 +117,8 @@ def update_stationvariable(reads):
                 ]
 
 
-    for read in update_station_variable.values():
-
-        station_id = read[0]
-        variable_id = read[1]
-        observation_datetime = read[2]
-        observation_value = read[3]
-
-        station_variable, created = StationVariable.objects.get_or_create(station_id=station_id,
-                                                                          variable_id=variable_id)
-
-        if station_variable.last_data_datetime is None or observation_datetime >= station_variable.last_data_datetime:
-            station_variable.last_data_datetime = observation_datetime
-            station_variable.last_data_value = observation_value
-            station_variable.last_data_code = None
-
-            station_variable.save()
-
-            logger.info(f'Updating StationVariable {station_id} {variable_id} '
-                        f'{observation_datetime} {observation_value}')
+    upsert_station_variables([station_id, variable_id, observation_datetime, observation_value, None]
+                             for station_id, variable_id, observation_datetime, observation_value in update_station_variable.values())
 
 ############################# Main #############################
 
@@ -1,15 +1,18 @@
+import csv
+import io
 import logging
 
 import numpy as np
 import pandas as pd
-import psycopg2
 import pytz
-from django.core.exceptions import ObjectDoesNotExist
 from django.utils import timezone
 from psycopg2.extras import execute_values
 from tempestas_api import settings
+from wx.db_pool import get_connection
 from wx.enums import QualityFlagEnum
-from wx.models import QcRangeThreshold, QcStepThreshold, StationVariable, Station, Variable
+from wx.models import Station
+from wx import qc_thresholds as qc_thresholds_module
+from wx.qc_thresholds import get_step_thresholds, get_range_thresholds
 
 logger = logging.getLogger('surface')
 
@@ -27,6 +30,11 @@ qc_columns = ["qc_step_quality_flag",
               "qc_range_description",
               "quality_flag"]                  
 
+group_columns = ["station_id", "variable_id", "seconds", "month"]
+
+# Number of reads handled at once by insert_stream
+CHUNK_SIZE = 50000
+
 GOOD = QualityFlagEnum.GOOD.id
 NOT_CHECKED = QualityFlagEnum.NOT_CHECKED.id
 BAD = QualityFlagEnum.BAD.id
@@ -34,89 +42,12 @@ BAD = QualityFlagEnum.BAD.id
 ######################## Quality Control #######################
 
 def get_qc_step(thresholds, station_id, variable_id, interval):
-    try:
-        # Trying to set step thresholds using current station
-        _step = QcStepThreshold.objects.get(station_id=station_id, variable_id=variable_id, interval=interval)
-        thresholds['step_min'], thresholds['step_max'] = _step.step_min, _step.step_max
-        thresholds['step_description'] = 'Custom station Threshold'
-    except ObjectDoesNotExist:
-        try:
-            # Trying to set step thresholds using current station with NULL intervall
-            _step = QcStepThreshold.objects.get(station_id=station_id, variable_id=variable_id, interval__isnull=True)        
-            thresholds['step_min'], thresholds['step_max'] = _step.step_min, _step.step_max
-            thresholds['step_description'] = 'Custom station Threshold'
-        except ObjectDoesNotExist:
-            try:
-                # Trying to set step thresholds using referece station
-                _station = Station.objects.get(pk=station_id)
-                _step = QcStepThreshold.objects.get(station_id=_station.reference_station_id, variable_id=variable_id, interval=interval)
-                thresholds['step_min'], thresholds['step_max'] = _step.step_min, _step.step_max
-                thresholds['step_description'] = 'Reference station threshold'
-            except ObjectDoesNotExist:
-                try:
-                    # Trying to set step thresholds using referece station with NULL intervall
-                    _station = Station.objects.get(pk=station_id)
-                    _step = QcStepThreshold.objects.get(station_id=_station.reference_station_id, variable_id=variable_id, interval__isnull=True)
-                    thresholds['step_min'], thresholds['step_max'] = _step.step_min, _step.step_max
-                    thresholds['step_description'] = 'Reference station threshold'
-                except ObjectDoesNotExist:
-                    try:
-                        # Trying to set range thresholds using global ranges
-                        _station = Station.objects.get(pk=station_id)
-                        _step = Variable.objects.get(pk=variable_id)
-                        if _station.is_automatic:
-                            if _step.step_hourly is not None:
-                                thresholds['step_min'], thresholds['step_max'] = -_step.step_hourly, _step.step_hourly
-                                thresholds['step_description'] = 'Global threshold (Automatic)'
-                        else:
-                            if _step.step is not None:
-                                thresholds['step_min'], thresholds['step_max'] = -_step.step, _step.step
-                                thresholds['step_description'] = 'Global threshold (Manual)'
-                    except ObjectDoesNotExist:
-                        pass;
-
-    return thresholds
+    # Custom station -> custom station with NULL interval -> reference station -> global thresholds, resolved in memory
+    return get_step_thresholds(thresholds, station_id, variable_id, interval)
 
 def get_qc_range(thresholds, station_id, variable_id, interval, month):
-    try:
-        # Trying to set range thresholds using current station
-        _range = QcRangeThreshold.objects.get(station_id=station_id, variable_id=variable_id, interval=interval, month=month)
-        thresholds['range_min'], thresholds['range_max'] = _range.range_min, _range.range_max
-        thresholds['range_description'] = 'Custom station Threshold'
-    except ObjectDoesNotExist:
-        try:
-            # Trying to set range thresholds using current station with NULL intervall
-            _range = QcRangeThreshold.objects.get(station_id=station_id, variable_id=variable_id, interval__isnull=True, month=month)        
-            thresholds['range_min'], thresholds['range_max'] = _range.range_min, _range.range_max
-            thresholds['range_description'] = 'Custom station threshold'
-        except ObjectDoesNotExist:
-            try:
-                # Trying to set range thresholds using referece station
-                _station = Station.objects.get(pk=station_id)
-                _range = QcRangeThreshold.objects.get(station_id=_station.reference_station_id, variable_id=variable_id, interval=interval, month=month)
-                thresholds['range_min'], thresholds['range_max'] = _range.range_min, _range.range_max
-                thresholds['range_description'] = 'Reference station threshold'
-            except ObjectDoesNotExist:
-                try:
-                    # Trying to set range thresholds using referece station with NULL intervall
-                    _station = Station.objects.get(pk=station_id)
-                    _range = QcRangeThreshold.objects.get(station_id=_station.reference_station_id, variable_id=variable_id, interval__isnull=True, month=month)
-                    thresholds['range_min'], thresholds['range_max'] = _range.range_min, _range.range_max
-                    thresholds['range_description'] = 'Reference station threshold'
-                except ObjectDoesNotExist:
-                    try:
-                        # Trying to set range thresholds using global ranges
-                        _station = Station.objects.get(pk=station_id)
-                        _range = Variable.objects.get(pk=variable_id)
-                        if _station.is_automatic:
-                            thresholds['range_min'], thresholds['range_max'] = _range.range_min_hourly, _range.range_max_hourly
-                            thresholds['range_description'] = 'Global threshold (Automatic)'
-                        else:
-                            thresholds['range_min'], thresholds['range_max'] = _range.range_min, _range.range_max
-                            thresholds['range_description'] = 'Global threshold (Manual)'                                       
-                    except ObjectDoesNotExist:
-                        pass;
-    return thresholds
+    # Custom station -> custom station with NULL interval -> reference station -> global thresholds, resolved in memory
+    return get_range_thresholds(thresholds, station_id, variable_id, interval, month)
 
 def qc_step(seconds, diff_value, diff_datetime, thresholds):
     if 'step_min' not in thresholds or 'step_max' not in thresholds:
@@ -179,9 +110,98 @@ def qc_thresholds(row, thresholds):
 
     return result_array
 
+def qc_arrays(seconds, value, diff_value, diff_datetime, thresholds):
+    # Same rules as qc_step, qc_range and qc_final, computed with NumPy masks for a whole
+    # (station, variable, interval, month) group instead of calling Python once per row
+    count = len(value)
+
+    # Step
+    if 'step_min' not in thresholds or 'step_max' not in thresholds:
+        result_step = np.full(count, NOT_CHECKED)
+        msg_step = np.full(count, "Threshold not found", dtype=object)
+    else:
+        s_min = thresholds['step_min']
+        s_max = thresholds['step_max']
+        s_des = thresholds['step_description']
+
+        # NaN differences fail both comparisons and are flagged as BAD, like the row-wise qc_step
+        consecutive = seconds == diff_datetime
+        in_step = (s_min <= diff_value) & (diff_value <= s_max)
+
+        result_step = np.where(consecutive, np.where(in_step, GOOD, BAD), NOT_CHECKED)
+        msg_step = np.where(consecutive, s_des, "Consecutive value not present").astype(object)
+
+    # Range
+    if 'range_min' not in thresholds or 'range_max' not in thresholds or \
+            thresholds['range_min'] is None or thresholds['range_max'] is None:
+        result_range = np.full(count, NOT_CHECKED)
+        msg_range = np.full(count, "Threshold not found", dtype=object)
+    else:
+        r_min = thresholds['range_min']
+        r_max = thresholds['range_max']
+        r_des = thresholds['range_description']
+
+        in_range = (r_min <= value) & (value <= r_max)
+
+        result_range = np.where(in_range, GOOD, BAD)
+        msg_range = np.full(count, r_des, dtype=object)
+
+    # Final
+    result_final = np.where((result_step == BAD) | (result_range == BAD), BAD,
+                            np.where(result_step == NOT_CHECKED, result_range,
+                                     np.where(result_range == NOT_CHECKED, result_step, GOOD)))
+
+    return result_step, msg_step, result_range, msg_range, result_final
+
+def qc_thresholds_columnar(df, thresholds):
+    results = qc_arrays(df['seconds'].to_numpy(),
+                        df['measured'].to_numpy(dtype='float64'),
+                        df['diff_value'].to_numpy(dtype='float64'),
+                        df['diff_datetime'].to_numpy(),
+                        thresholds)
+
+    for column, result in zip(qc_columns, results):
+        df[column] = result
+
+    return df
+
 ##########################  Functions ##########################
 
-def get_data(raw_data_list):
+def partition_groups(df):
+    # Single sort, so every (station, variable, interval, month) group is a contiguous block of rows ordered by datetime
+    df.sort_values(by=group_columns + ['datetime'], inplace=True, kind='mergesort')
+    df.reset_index(drop=True, inplace=True)
+
+    keys = df[group_columns].to_numpy()
+    starts = np.flatnonzero(np.r_[True, (keys[1:] != keys[:-1]).any(axis=1)])
+    ends = np.r_[starts[1:], len(df)]
+
+    return keys, starts, ends
+
+def carry_previous_reads(df, keys, starts, ends, diff_value, diff_datetime, previous_reads):
+    # Step continuity between chunks: the first read of a group is compared with the last read of the
+    # same series in the previous chunks, as long as both belong to the same month like in a single batch
+    datetimes = df['datetime']
+    measured = df['measured']
+
+    for start in starts:
+        station_id, variable_id, interval, month = keys[start]
+        previous = previous_reads.get((station_id, variable_id, interval))
+        if previous is None:
+            continue
+
+        previous_datetime, previous_value, previous_month = previous
+        if previous_month == month and previous_datetime < datetimes.iat[start]:
+            diff_value[start] = measured.iat[start] - previous_value
+            diff_datetime[start] = int((datetimes.iat[start] - previous_datetime).total_seconds())
+
+    for end in ends:
+        station_id, variable_id, interval, month = keys[end - 1]
+        previous = previous_reads.get((station_id, variable_id, interval))
+        if previous is None or previous[0] < datetimes.iat[end - 1]:
+            previous_reads[(station_id, variable_id, interval)] = (datetimes.iat[end - 1], measured.iat[end - 1], month)
+
+def get_data(raw_data_list, previous_reads=None):
     now = timezone.now()
 
     df = pd.DataFrame(raw_data_list, columns=columns)    
@@ -191,167 +211,338 @@ def get_data(raw_data_list):
     df['updated_at'] = now
     df['month'] = pd.to_datetime(df['datetime']).dt.month
 
-    reads = []
-    for idx, [station_id, variable_id, seconds, month] in df[['station_id', 'variable_id', 'seconds', 'month']].drop_duplicates().iterrows():
+    if df.empty:
+        return []
 
-        df1 = df.loc[(df.station_id == station_id) &
-                     (df.variable_id == variable_id) &
-                     (df.seconds == seconds) &
-                     (df.month == month)].copy()
-                     
-        df1.sort_values(by="datetime", inplace=True)
+    # Loading thresholds of every station in the batch at once
+    qc_thresholds_module.load_qc_thresholds(df['station_id'].unique())
 
-        count = len(df1)
-        if count == 0:
-            logger.debug(
-                f"Skipping station_id={station_id}, variable_id={variable_id}, seconds={seconds} found 0 records, skipping it!")
-            continue
-        else:
-            logger.debug(
-                f"Processing station_id={station_id}, variable_id={variable_id}, seconds={seconds} #{count} records.")
+    keys, starts, ends = partition_groups(df)
 
+    # Calculating step values and step time in one pass, the first row of each group has no previous value
+    diff_value = df.measured.diff(periods=1).to_numpy(dtype='float64')
+    diff_value[starts] = np.nan
 
-        # Defining threshholds
-        thresholds = {}
-        thresholds = get_qc_step(thresholds=thresholds, station_id=station_id, variable_id=variable_id, interval=seconds)
-        thresholds = get_qc_range(thresholds=thresholds, station_id=station_id, variable_id=variable_id, interval=seconds, month=month)
+    diff_datetime = df.datetime.diff(periods=1).dt.total_seconds().replace(np.nan, 0).astype("int32").to_numpy()
+    diff_datetime[starts] = 0
+
+    if previous_reads is not None:
+        carry_previous_reads(df, keys, starts, ends, diff_value, diff_datetime, previous_reads)
+
+    seconds = df['seconds'].to_numpy()
+    value = df['measured'].to_numpy(dtype='float64')
 
-        # Sort values by datetime
-        df1.sort_values(by='datetime', inplace=True)
+    results = [np.empty(len(df), dtype=object) for column in qc_columns]
+    for start, end in zip(starts, ends):
+        station_id, variable_id, interval, month = keys[start]
 
-        # Calculating step values
-        df1['diff_value'] = df1.measured.diff(periods=1)
+        logger.debug(
+            f"Processing station_id={station_id}, variable_id={variable_id}, seconds={interval} #{end - start} records.")
 
-        # Calculating step time
-        df1['diff_datetime'] = df1.datetime.diff(periods=1).dt.total_seconds().replace(np.nan, 0).astype("int32")
+        # Defining threshholds
+        thresholds = qc_thresholds_module.get_group_thresholds(station_id, variable_id, interval, month)
+
+        # Apllying  quality control logic and thresholds on the group views
+        group_results = qc_arrays(seconds[start:end], value[start:end], diff_value[start:end],
+                                  diff_datetime[start:end], thresholds)
 
-        # Apllying  quality control logic and thresholds
-        df1[qc_columns] = df1.apply(lambda row: qc_thresholds(row, thresholds), axis=1, result_type="expand")
+        for result, group_result in zip(results, group_results):
+            result[start:end] = group_result
 
-        # Replace "" empty string to None/Null
-        df1["qc_step_description"].replace("", None)
-        df1["qc_range_description"].replace("", None)
+    for column, result in zip(qc_columns, results):
+        df[column] = result
 
-        reads.extend(df1[insert_columns].values.tolist())
-    return reads
+    return df[insert_columns].values.tolist()
 
 def insert_query(reads, override_data_on_conflict):
-    with psycopg2.connect(settings.SURFACE_CONNECTION_STRING) as conn:
+    with get_connection() as conn:
         with conn.cursor() as cursor:
+            insert_reads(cursor, reads, override_data_on_conflict)
 
-            logger.info(f'Inserting into database #{len(reads)} records.')
-
-            if override_data_on_conflict:
-                on_conflict_sql = """
-                    ON CONFLICT (station_id, variable_id, datetime)
-                    DO UPDATE SET
-                        datetime = excluded.datetime,
-                        measured = excluded.measured,
-                        quality_flag = excluded.quality_flag,
-                        qc_range_quality_flag = excluded.qc_range_quality_flag,
-                        qc_range_description = excluded.qc_range_description,
-                        qc_step_quality_flag = excluded.qc_step_quality_flag,
-                        qc_step_description = excluded.qc_step_description,
-                        qc_persist_quality_flag = excluded.qc_persist_quality_flag,
-                        qc_persist_description = excluded.qc_persist_description,
-                        manual_flag = null,
-                        consisted = null,
-                        updated_at = now()
-                """
-            else:
-                on_conflict_sql = " ON CONFLICT DO NOTHING "
-
-            inserted_raw_data = execute_values(cursor, f"""
-                INSERT INTO raw_data (
-                        station_id, variable_id, datetime, measured, quality_flag,
-                        qc_range_quality_flag, qc_range_description,
-                        qc_step_quality_flag, qc_step_description,
-                        qc_persist_quality_flag, qc_persist_description,
-                        manual_flag, consisted, is_daily, updated_at, created_at)
+        conn.commit()
+
+def insert_reads(cursor, reads, override_data_on_conflict):
+    logger.info(f'Inserting into database #{len(reads)} records.')
+
+    if override_data_on_conflict:
+        on_conflict_sql = """
+            ON CONFLICT (station_id, variable_id, datetime)
+            DO UPDATE SET
+                datetime = excluded.datetime,
+                measured = excluded.measured,
+                quality_flag = excluded.quality_flag,
+                qc_range_quality_flag = excluded.qc_range_quality_flag,
+                qc_range_description = excluded.qc_range_description,
+                qc_step_quality_flag = excluded.qc_step_quality_flag,
+                qc_step_description = excluded.qc_step_description,
+                qc_persist_quality_flag = excluded.qc_persist_quality_flag,
+                qc_persist_description = excluded.qc_persist_description,
+                manual_flag = null,
+                consisted = null,
+                updated_at = now()
+        """
+    else:
+        on_conflict_sql = " ON CONFLICT DO NOTHING "
+
+    inserted_raw_data = execute_values(cursor, f"""
+        INSERT INTO raw_data (
+                station_id, variable_id, datetime, measured, quality_flag,
+                qc_range_quality_flag, qc_range_description,
+                qc_step_quality_flag, qc_step_description,
+                qc_persist_quality_flag, qc_persist_description,
+                manual_flag, consisted, is_daily, updated_at, created_at)
+        VALUES %s
+        {on_conflict_sql}
+        RETURNING station_id, date_trunc('hour', datetime), now(), now(), is_daily
+    """, reads, fetch=True)
+
+    if inserted_raw_data:
+        distinct_raw_data = set(inserted_raw_data)
+        not_daily_raw_data = filter(lambda data: data[4] == False, distinct_raw_data)
+        filtered_raw_data = set(map(lambda raw_data: (raw_data[0], raw_data[1], raw_data[2], raw_data[3]), not_daily_raw_data))
+
+        if filtered_raw_data:
+            execute_values(cursor, """
+                INSERT INTO wx_hourlysummarytask (station_id, datetime, updated_at, created_at)
                 VALUES %s
-                {on_conflict_sql}
-                RETURNING station_id, date_trunc('hour', datetime), now(), now(), is_daily
-            """, reads, fetch=True)
-
-            if inserted_raw_data:
-                distinct_raw_data = set(inserted_raw_data)
-                not_daily_raw_data = filter(lambda data: data[4] == False, distinct_raw_data)
-                filtered_raw_data = set(map(lambda raw_data: (raw_data[0], raw_data[1], raw_data[2], raw_data[3]), not_daily_raw_data))
-
-                if filtered_raw_data:
-                    execute_values(cursor, """
-                        INSERT INTO wx_hourlysummarytask (station_id, datetime, updated_at, created_at)
-                        VALUES %s
-                        ON CONFLICT DO NOTHING
-                    """, filtered_raw_data)
-
-                    station_id = reads[0][0]
-                    station_fixed_offset = pytz.FixedOffset(Station.objects.get(pk=station_id).utc_offset_minutes)
-                    # When a datetime is inserted on the database, the inserted value returns converted to UTC timezone
-                    # Convert UTC datetime to the station_fixed_offset and then transform datetime field in date to insert in wx_dailysummarytask table
-
-                    filtered_raw_data = map(lambda raw_data: (raw_data[0], raw_data[1].astimezone(station_fixed_offset).date(), raw_data[2], raw_data[3]),
-                                            filtered_raw_data)
-                    filtered_raw_data = set(filtered_raw_data)
-
-                    execute_values(cursor, """
-                        INSERT INTO wx_dailysummarytask (station_id, date, updated_at, created_at)
-                        VALUES %s
-                        ON CONFLICT DO NOTHING
-                    """, filtered_raw_data)
+                ON CONFLICT DO NOTHING
+            """, filtered_raw_data)
+
+            station_id = reads[0][0]
+            station_fixed_offset = pytz.FixedOffset(Station.objects.get(pk=station_id).utc_offset_minutes)
+            # When a datetime is inserted on the database, the inserted value returns converted to UTC timezone
+            # Convert UTC datetime to the station_fixed_offset and then transform datetime field in date to insert in wx_dailysummarytask table
+
+            filtered_raw_data = map(lambda raw_data: (raw_data[0], raw_data[1].astimezone(station_fixed_offset).date(), raw_data[2], raw_data[3]),
+                                    filtered_raw_data)
+            filtered_raw_data = set(filtered_raw_data)
+
+            execute_values(cursor, """
+                INSERT INTO wx_dailysummarytask (station_id, date, updated_at, created_at)
+                VALUES %s
+                ON CONFLICT DO NOTHING
+            """, filtered_raw_data)
+
+def copy_reads(cursor, reads):
+    # Streams the reads to the staging table using COPY instead of one VALUES tuple per read
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for read in reads:
+        writer.writerow(['\\N' if value is None else value for value in read])
+    buffer.seek(0)
+
+    cursor.copy_expert(f"""
+        COPY raw_data_staging ({', '.join(insert_columns)})
+        FROM STDIN WITH (FORMAT csv, NULL '\\N')
+    """, buffer)
+
+def insert_query_copy(reads, override_data_on_conflict):
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
+            copy_insert_reads(cursor, reads, override_data_on_conflict)
 
         conn.commit()
 
-def update_stationvariable(reads):
+def copy_insert_reads(cursor, reads, override_data_on_conflict):
+    logger.info(f'Copying into database #{len(reads)} records.')
+
+    # The staging table lives until the end of the transaction
+    cursor.execute("""
+        CREATE TEMPORARY TABLE IF NOT EXISTS raw_data_staging (
+            station_id integer,
+            variable_id integer,
+            datetime timestamp with time zone,
+            measured double precision,
+            quality_flag integer,
+            qc_range_quality_flag integer,
+            qc_range_description character varying(256),
+            qc_step_quality_flag integer,
+            qc_step_description character varying(256),
+            qc_persist_quality_flag integer,
+            qc_persist_description character varying(256),
+            manual_flag integer,
+            consisted double precision,
+            is_daily boolean,
+            updated_at timestamp with time zone,
+            created_at timestamp with time zone
+        ) ON COMMIT DROP
+    """)
+
+    copy_reads(cursor, reads)
+
+    if override_data_on_conflict:
+        on_conflict_sql = """
+            ON CONFLICT (station_id, variable_id, datetime)
+            DO UPDATE SET
+                datetime = excluded.datetime,
+                measured = excluded.measured,
+                quality_flag = excluded.quality_flag,
+                qc_range_quality_flag = excluded.qc_range_quality_flag,
+                qc_range_description = excluded.qc_range_description,
+                qc_step_quality_flag = excluded.qc_step_quality_flag,
+                qc_step_description = excluded.qc_step_description,
+                qc_persist_quality_flag = excluded.qc_persist_quality_flag,
+                qc_persist_description = excluded.qc_persist_description,
+                manual_flag = null,
+                consisted = null,
+                updated_at = now()
+        """
+    else:
+        on_conflict_sql = " ON CONFLICT DO NOTHING "
+
+    # Summary tasks are derived from the inserted rows without sending them back to the client.
+    # The daily task date is the truncated hour converted to the station utc offset, as in insert_query
+    cursor.execute(f"""
+        WITH inserted_raw_data AS (
+            INSERT INTO raw_data (
+                    station_id, variable_id, datetime, measured, quality_flag,
+                    qc_range_quality_flag, qc_range_description,
+                    qc_step_quality_flag, qc_step_description,
+                    qc_persist_quality_flag, qc_persist_description,
+                    manual_flag, consisted, is_daily, updated_at, created_at)
+            SELECT DISTINCT ON (station_id, variable_id, datetime)
+                   station_id, variable_id, datetime, measured, quality_flag,
+                   qc_range_quality_flag, qc_range_description,
+                   qc_step_quality_flag, qc_step_description,
+                   qc_persist_quality_flag, qc_persist_description,
+                   manual_flag, consisted, is_daily, updated_at, created_at
+              FROM raw_data_staging
+            {on_conflict_sql}
+            RETURNING station_id, date_trunc('hour', datetime) AS datetime, is_daily
+        ), hourly_summary_task AS (
+            INSERT INTO wx_hourlysummarytask (station_id, datetime, updated_at, created_at)
+            SELECT DISTINCT station_id, datetime, now(), now()
+              FROM inserted_raw_data
+             WHERE NOT is_daily
+            ON CONFLICT DO NOTHING
+        )
+        INSERT INTO wx_dailysummarytask (station_id, date, updated_at, created_at)
+        SELECT DISTINCT ird.station_id
+              ,((ird.datetime AT TIME ZONE 'UTC') + st.utc_offset_minutes * interval '1 minute')::date
+              ,now()
+              ,now()
+          FROM inserted_raw_data ird
+          JOIN wx_station st ON st.id = ird.station_id
+         WHERE NOT ird.is_daily
+        ON CONFLICT DO NOTHING
+    """)
+
+    cursor.execute('TRUNCATE raw_data_staging')
+
+def upsert_station_variables(last_reads):
+    # One upsert for the whole batch; the WHERE clause is evaluated against the locked current row,
+    # so a concurrent ingest of older data for the same station never regresses the last value
+    now = timezone.now()
+    # Sorted so concurrent batches lock the same (station, variable) rows in the same order
+    rows = [(now, now, station_id, variable_id, observation_datetime, observation_value, observation_code)
+            for station_id, variable_id, observation_datetime, observation_value, observation_code
+            in sorted(last_reads, key=lambda read: (read[0], read[1]))]
+
+    if not rows:
+        return
+
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
+            updated = execute_values(cursor, """
+                INSERT INTO wx_stationvariable (created_at, updated_at, station_id, variable_id,
+                                                last_data_datetime, last_data_value, last_data_code)
+                VALUES %s
+                ON CONFLICT (station_id, variable_id)
+                DO UPDATE SET
+                    last_data_datetime = excluded.last_data_datetime,
+                    last_data_value = excluded.last_data_value,
+                    last_data_code = excluded.last_data_code,
+                    updated_at = excluded.updated_at
+                WHERE wx_stationvariable.last_data_datetime IS NULL
+                   OR excluded.last_data_datetime >= wx_stationvariable.last_data_datetime
+                RETURNING station_id
+            """, rows, fetch=True)
+
+        conn.commit()
+
+    logger.info(f'Updating StationVariable last data of #{len(updated)} of #{len(rows)} station variables.')
+
+def collect_last_reads(reads, last_reads):
     # holds last value for (station_id, variable_id) to update StationVariable last_data_datetime
-    update_station_variable = {}
     for read in reads:
         station_id = read[0]
         variable_id = read[1]
         observation_datetime = read[2]
         observation_value = read[3]
 
-        if (station_id, variable_id) not in update_station_variable:
-            update_station_variable[(station_id, variable_id)] = [
+        if (station_id, variable_id) not in last_reads:
+            last_reads[(station_id, variable_id)] = [
                 station_id, variable_id, observation_datetime, observation_value
             ]
         else:
-            [prev_station_id, prev_var_id, prev_datetime, prev_value] = update_station_variable[
-                (station_id, variable_id)]
+            [prev_station_id, prev_var_id, prev_datetime, prev_value] = last_reads[(station_id, variable_id)]
             if prev_datetime < observation_datetime:
-                update_station_variable[(station_id, variable_id)] = [
+                last_reads[(station_id, variable_id)] = [
                     station_id, variable_id, observation_datetime, observation_value
                 ]
 
+    return last_reads
 
-    for read in update_station_variable.values():
-
-        station_id = read[0]
-        variable_id = read[1]
-        observation_datetime = read[2]
-        observation_value = read[3]
-
-        station_variable, created = StationVariable.objects.get_or_create(station_id=station_id,
-                                                                          variable_id=variable_id)
-
-        if station_variable.last_data_datetime is None or observation_datetime >= station_variable.last_data_datetime:
-            station_variable.last_data_datetime = observation_datetime
-            station_variable.last_data_value = observation_value
-            station_variable.last_data_code = None
-
-            station_variable.save()
+def update_stationvariable(reads):
+    last_reads = collect_last_reads(reads, {})
 
-            logger.info(f'Updating StationVariable {station_id} {variable_id} '
-                        f'{observation_datetime} {observation_value}')
+    upsert_station_variables([station_id, variable_id, observation_datetime, observation_value, None]
+                             for station_id, variable_id, observation_datetime, observation_value in last_reads.values())
 
 ############################# Main #############################
 
-def insert(raw_data_list, override_data_on_conflict=False):
+def use_copy(decoder):
+    # Decoders listed in RAW_DATA_COPY_DECODERS load their reads through a COPY into a staging table
+    return decoder in settings.RAW_DATA_COPY_DECODERS
+
+def insert(raw_data_list, override_data_on_conflict=False, decoder=None):
     # Extracting and formating data from raw data list
     reads = get_data(raw_data_list)
 
+    if not reads:
+        return
+
     # Inserting new data
-    insert_query(reads, override_data_on_conflict)
+    if use_copy(decoder):
+        insert_query_copy(reads, override_data_on_conflict)
+    else:
+        insert_query(reads, override_data_on_conflict)
 
     # Updating "station varaiable" table
-    update_stationvariable(reads)
\ No newline at end of file
+    update_stationvariable(reads)
+
+def chunked(reads, chunk_size=CHUNK_SIZE):
+    chunk = []
+    for read in reads:
+        chunk.append(read)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+def insert_stream(raw_data_reads, override_data_on_conflict=False, decoder=None, chunk_size=CHUNK_SIZE):
+    """Consume an iterable of raw reads in fixed size chunks, so memory depends on the chunk size and not
+    on the file size. Every chunk is committed on its own like the HF reads, the previous reads of each series
+    are carried over to the next chunk so its step checks match a single batch. Reads already committed are
+    skipped or overwritten with the same values when a file is ingested again. Returns the number of reads consumed."""
+    previous_reads = {}
+    total_reads = 0
+
+    for raw_data_list in chunked(raw_data_reads, chunk_size):
+        reads = get_data(raw_data_list, previous_reads)
+
+        if reads:
+            if use_copy(decoder):
+                insert_query_copy(reads, override_data_on_conflict)
+            else:
+                insert_query(reads, override_data_on_conflict)
+
+            # Updating "station varaiable" table once the chunk is committed
+            update_stationvariable(reads)
+
+        total_reads += len(raw_data_list)
+        logger.info(f'Inserted chunk of #{len(raw_data_list)} reads, #{total_reads} reads so far.')
+
+    return total_reads
@@ -3,13 +3,15 @@ import logging
 
 import numpy as np
 import pandas as pd
-import psycopg2
 from django.core.exceptions import ObjectDoesNotExist
 from django.utils import timezone
 from psycopg2.extras import execute_values
 from tempestas_api import settings
+from wx.db_pool import get_connection
+from wx.decoders.insert_raw_data import get_qc_step, get_qc_range, qc_thresholds_columnar, upsert_station_variables
 from wx.enums import QualityFlagEnum
-from wx.models import QcRangeThreshold, QcStepThreshold, StationVariable, Station, Variable
+from wx.models import Variable
+from wx.qc_thresholds import load_qc_thresholds
 
 logger = logging.getLogger('surface')
 
@@ -34,91 +36,6 @@ BAD = QualityFlagEnum.BAD.id
 
 ######################## Quality Control #######################
 
-def get_qc_step(thresholds, station_id, variable_id, interval):
-    try:
-        # Trying to set step thresholds using current station
-        _step = QcStepThreshold.objects.get(station_id=station_id, variable_id=variable_id, interval=interval)
-        thresholds['step_min'], thresholds['step_max'] = _step.step_min, _step.step_max
-        thresholds['step_description'] = 'Custom station Threshold'
-    except ObjectDoesNotExist:
-        try:
-            # Trying to set step thresholds using current station with NULL intervall
-            _step = QcStepThreshold.objects.get(station_id=station_id, variable_id=variable_id, interval__isnull=True)        
-            thresholds['step_min'], thresholds['step_max'] = _step.step_min, _step.step_max
-            thresholds['step_description'] = 'Custom station Threshold'
-        except ObjectDoesNotExist:
-            try:
-                # Trying to set step thresholds using referece station
-                _station = Station.objects.get(pk=station_id)
-                _step = QcStepThreshold.objects.get(station_id=_station.reference_station_id, variable_id=variable_id, interval=interval)
-                thresholds['step_min'], thresholds['step_max'] = _step.step_min, _step.step_max
-                thresholds['step_description'] = 'Reference station threshold'
-            except ObjectDoesNotExist:
-                try:
-                    # Trying to set step thresholds using referece station with NULL intervall
-                    _station = Station.objects.get(pk=station_id)
-                    _step = QcStepThreshold.objects.get(station_id=_station.reference_station_id, variable_id=variable_id, interval__isnull=True)
-                    thresholds['step_min'], thresholds['step_max'] = _step.step_min, _step.step_max
-                    thresholds['step_description'] = 'Reference station threshold'
-                except ObjectDoesNotExist:
-                    try:
-                        # Trying to set range thresholds using global ranges
-                        _station = Station.objects.get(pk=station_id)
-                        _step = Variable.objects.get(pk=variable_id)
-                        if _station.is_automatic:
-                            if _step.step_hourly is not None:
-                                thresholds['step_min'], thresholds['step_max'] = -_step.step_hourly, _step.step_hourly
-                                thresholds['step_description'] = 'Global threshold (Automatic)'
-                        else:
-                            if _step.step is not None:
-                                thresholds['step_min'], thresholds['step_max'] = -_step.step, _step.step
-                                thresholds['step_description'] = 'Global threshold (Manual)'
-                    except ObjectDoesNotExist:
-                        pass;
-
-    return thresholds
-
-def get_qc_range(thresholds, station_id, variable_id, interval, month):
-    try:
-        # Trying to set range thresholds using current station
-        _range = QcRangeThreshold.objects.get(station_id=station_id, variable_id=variable_id, interval=interval, month=month)
-        thresholds['range_min'], thresholds['range_max'] = _range.range_min, _range.range_max
-        thresholds['range_description'] = 'Custom station Threshold'
-    except ObjectDoesNotExist:
-        try:
-            # Trying to set range thresholds using current station with NULL intervall
-            _range = QcRangeThreshold.objects.get(station_id=station_id, variable_id=variable_id, interval__isnull=True, month=month)        
-            thresholds['range_min'], thresholds['range_max'] = _range.range_min, _range.range_max
-            thresholds['range_description'] = 'Custom station threshold'
-        except ObjectDoesNotExist:
-            try:
-                # Trying to set range thresholds using referece station
-                _station = Station.objects.get(pk=station_id)
-                _range = QcRangeThreshold.objects.get(station_id=_station.reference_station_id, variable_id=variable_id, interval=interval, month=month)
-                thresholds['range_min'], thresholds['range_max'] = _range.range_min, _range.range_max
-                thresholds['range_description'] = 'Reference station threshold'
-            except ObjectDoesNotExist:
-                try:
-                    # Trying to set range thresholds using referece station with NULL intervall
-                    _station = Station.objects.get(pk=station_id)
-                    _range = QcRangeThreshold.objects.get(station_id=_station.reference_station_id, variable_id=variable_id, interval__isnull=True, month=month)
-                    thresholds['range_min'], thresholds['range_max'] = _range.range_min, _range.range_max
-                    thresholds['range_description'] = 'Reference station threshold'
-                except ObjectDoesNotExist:
-                    try:
-                        # Trying to set range thresholds using global ranges
-                        _station = Station.objects.get(pk=station_id)
-                        _range = Variable.objects.get(pk=variable_id)
-                        if _station.is_automatic:
-                            thresholds['range_min'], thresholds['range_max'] = _range.range_min_hourly, _range.range_max_hourly
-                            thresholds['range_description'] = 'Global threshold (Automatic)'
-                        else:
-                            thresholds['range_min'], thresholds['range_max'] = _range.range_min, _range.range_max
-                            thresholds['range_description'] = 'Global threshold (Manual)'                                       
-                    except ObjectDoesNotExist:
-                        pass;
-    return thresholds
-
 def qc_step(seconds, diff_value, diff_datetime, thresholds):
     if 'step_min' not in thresholds or 'step_max' not in thresholds:
         return NOT_CHECKED, "Threshold not found"
@@ -193,6 +110,9 @@ def get_data(raw_data_list):
     df['updated_at'] = now
     df['month'] = pd.to_datetime(df['datetime']).dt.month
 
+    # Loading thresholds of every station in the batch at once
+    load_qc_thresholds(df['station_id'].unique())
+
     reads = []
     for idx, [station_id, variable_id, seconds, month] in df[['station_id', 'variable_id', 'seconds', 'month']].drop_duplicates().iterrows():
 
@@ -231,7 +151,7 @@ def get_data(raw_data_list):
             # Calculating step time
             df1['diff_datetime'] = df1.datetime.diff(periods=1).dt.total_seconds().replace(np.nan, 0).astype("int32")
 
-            df1[qc_columns] = df1.apply(lambda row: qc_thresholds(row, thresholds), axis=1, result_type="expand")
+            df1 = qc_thresholds_columnar(df1, thresholds)
 
             # replace "" empty string to None/null
             df1["qc_step_description"].replace("", None)
@@ -245,7 +165,7 @@ def get_data(raw_data_list):
     return reads
 
 def insert_query(reads, station_id, date, override_data_on_conflict):
-    with psycopg2.connect(settings.SURFACE_CONNECTION_STRING) as conn:
+    with get_connection() as conn:
         with conn.cursor() as cursor:
 
             logger.info(f'Inserting into database #{len(reads)} records.')
@@ -326,25 +246,7 @@ def update_stationvariable(reads):
                     station_id, variable_id, observation_datetime, observation_value, observation_code
                 ]
 
-    for read in update_station_variable.values():
-
-        station_id = read[0]
-        variable_id = read[1]
-        observation_datetime = read[2]
-        observation_value = read[3]
-        observation_code = read[4]
-
-        station_variable, created = StationVariable.objects.get_or_create(station_id=station_id,
-                                                                          variable_id=variable_id)
-
-        if station_variable.last_data_datetime is None or observation_datetime >= station_variable.last_data_datetime:
-            station_variable.last_data_datetime = observation_datetime
-            station_variable.last_data_value = observation_value
-            station_variable.last_data_code = observation_code
-            station_variable.save()
-
-            logger.info(f'Updating StationVariable {station_id} {variable_id} '
-                        f'{observation_datetime} {observation_value}')
+    upsert_station_variables(update_station_variable.values())
 
 ############################# Main #############################
 
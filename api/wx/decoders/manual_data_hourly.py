@@ -253,7 +253,7 @@ def read_file(filename, highfrequency_data=False, station_object=None, utc_offse
     if highfrequency_data:
         insert_hf(reads, override_data_on_conflict)
     else:
-        insert(reads, override_data_on_conflict)
+        insert(reads, override_data_on_conflict, decoder='BELIZE MANUAL HOURLY DATA')
 
     end = time.time()
 
@@ -7,7 +7,7 @@ import pandas as pd
 import pytz
 from celery import shared_task
 
-from wx.decoders.insert_raw_data import insert
+from wx.decoders.insert_raw_data import chunked, insert_stream
 from wx.decoders.insert_hf_data import insert as insert_hf
 from wx.models import Station
 from wx.models import Variable
@@ -70,8 +70,6 @@ def read_file(filename, highfrequency_data=False, station_object=None, utc_offse
     station_id = station_object.id
     for var_symbol in variable_symbols:
 
-        reads = []
-
         try:
             variable = Variable.objects.get(symbol=var_symbol)
             variable_id = variable.id
@@ -99,38 +97,33 @@ def read_file(filename, highfrequency_data=False, station_object=None, utc_offse
             in_file_station_variables = {variable_id}
             update_station_variables(station_object, in_file_station_variables)
 
-        for idx, row in df_symbol.iterrows():
-            columns = [
-                station_id,            # station
-                variable_id,           # variable
-                interval,              # interval seconds
-                row["datetime"],       # datetime
-                row[var_symbol],       # value
-                None,                  # "quality_flag"
-                None,                  # "qc_range_quality_flag"
-                None,                  # "qc_range_description"
-                None,                  # "qc_step_quality_flag"
-                None,                  # "qc_step_description"
-                None,                  # "qc_persist_quality_flag"
-                None,                  # "qc_persist_description"
-                None,                  # "manual_flag"
-                None,                  # "consisted"
-                False                  # "is_daily"
-            ]
-            reads.append(columns)
+        # reads are built lazily, only one chunk of them is held in memory at a time
+        reads = ([
+            station_id,            # station
+            variable_id,           # variable
+            interval,              # interval seconds
+            observation_datetime,  # datetime
+            value,                 # value
+            None,                  # "quality_flag"
+            None,                  # "qc_range_quality_flag"
+            None,                  # "qc_range_description"
+            None,                  # "qc_step_quality_flag"
+            None,                  # "qc_step_description"
+            None,                  # "qc_persist_quality_flag"
+            None,                  # "qc_persist_description"
+            None,                  # "manual_flag"
+            None,                  # "consisted"
+            False                  # "is_daily"
+        ] for observation_datetime, value in zip(df_symbol["datetime"], df_symbol[var_symbol]))
 
         if highfrequency_data:
-            insert_hf(reads, override_data_on_conflict)
+            for chunk in chunked(reads):
+                insert_hf(chunk, override_data_on_conflict)
+                total_reads = total_reads + len(chunk)
         else:
-            insert(reads, override_data_on_conflict)
-
-        total_reads = total_reads + len(reads)
+            total_reads = total_reads + insert_stream(reads, override_data_on_conflict, decoder='SURFACE')
 
     end = time.time()
 
     logger.info(f'Processing file {filename} in {end - start} seconds, '
                 f'returning #reads={total_reads}.')
-
-
-
-
@@ -0,0 +1,32 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wx', '0027_auto_20230725_0352'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='hourlysummarytask',
+            name='attempts',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='dailysummarytask',
+            name='attempts',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='hfsummarytask',
+            name='attempts',
+            field=models.IntegerField(default=0),
+        ),
+        # The tasks are also created by raw INSERTs that do not list the column
+        migrations.RunSQL('''
+            ALTER TABLE public.wx_hourlysummarytask ALTER COLUMN attempts SET DEFAULT 0;
+            ALTER TABLE public.wx_dailysummarytask ALTER COLUMN attempts SET DEFAULT 0;
+            ALTER TABLE public.wx_hfsummarytask ALTER COLUMN attempts SET DEFAULT 0;
+        ''', migrations.RunSQL.noop),
+    ]
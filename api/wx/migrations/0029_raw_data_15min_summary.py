@@ -0,0 +1,40 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    # Continuous aggregates cannot be created or dropped inside a transaction block
+    atomic = False
+
+    dependencies = [
+        ('wx', '0028_summary_task_attempts'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql=[
+                """
+                CREATE MATERIALIZED VIEW public.raw_data_15min_summary
+                WITH (timescaledb.continuous, timescaledb.materialized_only = true)
+                AS  SELECT time_bucket('15 minutes', rd.datetime) AS bucket,
+                           rd.station_id,
+                           rd.variable_id,
+                           rd.is_daily,
+                           time_bucket('15 minutes', rd.datetime) = rd.datetime AS on_boundary,
+                           min(COALESCE(rd.consisted, rd.measured)) AS min_value,
+                           max(COALESCE(rd.consisted, rd.measured)) AS max_value,
+                           sum(COALESCE(rd.consisted, rd.measured)) AS sum_value,
+                           count(COALESCE(rd.consisted, rd.measured)) AS num_records
+                      FROM public.raw_data rd
+                     WHERE (rd.manual_flag IN (1, 4) OR (rd.manual_flag IS NULL AND rd.quality_flag IN (1, 4)))
+                       AND COALESCE(rd.consisted, rd.measured) != -99.9
+                     GROUP BY 1, 2, 3, 4, 5
+                WITH NO DATA;
+                """,
+                """
+                CREATE INDEX raw_data_15min_summary_station_id_bucket_idx
+                    ON public.raw_data_15min_summary (station_id, bucket);
+                """,
+            ],
+            reverse_sql="DROP MATERIALIZED VIEW IF EXISTS public.raw_data_15min_summary;",
+        ),
+    ]
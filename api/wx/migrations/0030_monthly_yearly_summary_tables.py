@@ -0,0 +1,109 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wx', '0029_raw_data_15min_summary'),
+    ]
+
+    # monthly_summary and yearly_summary become tables with the same columns and types as the views they replace,
+    # kept up to date by calculate_daily_summary for the months and years it recalculates
+    operations = [
+        migrations.RunSQL('''
+            DROP VIEW IF EXISTS public.monthly_summary;
+            DROP VIEW IF EXISTS public.yearly_summary;
+
+            CREATE TABLE public.monthly_summary (
+                year double precision NOT NULL,
+                month double precision NOT NULL,
+                date timestamp NOT NULL,
+                station_id int4 NOT NULL,
+                variable_id int4 NOT NULL,
+                min_value float4 NULL,
+                max_value float4 NULL,
+                avg_value double precision NULL,
+                sum_value float4 NULL,
+                num_records int8 NULL,
+                CONSTRAINT monthly_summary_uniq UNIQUE (station_id, variable_id, date)
+            );
+            CREATE INDEX monthly_summary_date_idx ON public.monthly_summary (date);
+
+            CREATE TABLE public.yearly_summary (
+                year double precision NOT NULL,
+                date timestamp NOT NULL,
+                station_id int4 NOT NULL,
+                variable_id int4 NOT NULL,
+                min_value float4 NULL,
+                max_value float4 NULL,
+                avg_value double precision NULL,
+                sum_value float4 NULL,
+                num_records int8 NULL,
+                CONSTRAINT yearly_summary_uniq UNIQUE (station_id, variable_id, date)
+            );
+            CREATE INDEX yearly_summary_date_idx ON public.yearly_summary (date);
+
+            INSERT INTO public.monthly_summary
+                 SELECT extract('year' from day) AS year,
+                        extract('month' from day) AS month,
+                        date_trunc('month', day)::timestamp AS date,
+                        station_id,
+                        variable_id,
+                        min(min_value) AS min_value,
+                        max(max_value) AS max_value,
+                        sum(sum_value) / sum(num_records) AS avg_value,
+                        sum(sum_value) AS sum_value,
+                        sum(num_records) AS num_records
+                   FROM public.daily_summary
+                  WHERE station_id IS NOT NULL
+                    AND variable_id IS NOT NULL
+                    AND day IS NOT NULL
+                  GROUP BY 1, 2, 3, 4, 5;
+
+            INSERT INTO public.yearly_summary
+                 SELECT extract('year' from day) AS year,
+                        date_trunc('year', day)::timestamp AS date,
+                        station_id,
+                        variable_id,
+                        min(min_value) AS min_value,
+                        max(max_value) AS max_value,
+                        sum(sum_value) / sum(num_records) AS avg_value,
+                        sum(sum_value) AS sum_value,
+                        sum(num_records) AS num_records
+                   FROM public.daily_summary
+                  WHERE station_id IS NOT NULL
+                    AND variable_id IS NOT NULL
+                    AND day IS NOT NULL
+                  GROUP BY 1, 2, 3, 4;
+        ''', '''
+            DROP TABLE IF EXISTS public.monthly_summary;
+            DROP TABLE IF EXISTS public.yearly_summary;
+
+            CREATE OR REPLACE VIEW public.monthly_summary
+            AS  (SELECT extract('year' from day) AS year,
+                        extract('month' from day) AS month,
+                        date_trunc('month', day)::timestamp AS date,
+                        station_id,
+                        variable_id,
+                        min(min_value) AS min_value,
+                        max(max_value) AS max_value,
+                        sum(sum_value) / sum(num_records) AS avg_value,
+                        sum(sum_value) AS sum_value,
+                        sum(num_records) AS num_records
+                FROM public.daily_summary
+                GROUP BY 1, 2, 3, 4, 5);
+
+            CREATE OR REPLACE VIEW public.yearly_summary
+            AS  (SELECT extract('year' from day) AS year,
+                        date_trunc('year', day)::timestamp AS date,
+                        station_id,
+                        variable_id,
+                        min(min_value) AS min_value,
+                        max(max_value) AS max_value,
+                        sum(sum_value) / sum(num_records) AS avg_value,
+                        sum(sum_value) AS sum_value,
+                        sum(num_records) AS num_records
+                FROM public.daily_summary
+                GROUP BY 1, 2, 3, 4);
+        '''),
+    ]
@@ -0,0 +1,29 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wx', '0030_monthly_yearly_summary_tables'),
+    ]
+
+    # Per hour partial aggregates of the last 24 hours, with the last24h_summary filters, maintained by
+    # calculate_last24h_summary
+    operations = [
+        migrations.RunSQL('''
+            CREATE TABLE public.last24h_partial (
+                hour timestamptz NOT NULL,
+                station_id int4 NOT NULL,
+                variable_id int4 NOT NULL,
+                min_value double precision NULL,
+                max_value double precision NULL,
+                sum_value double precision NULL,
+                num_records int4 NOT NULL,
+                latest_datetime timestamptz NULL,
+                latest_value double precision NULL,
+                CONSTRAINT last24h_partial_uniq UNIQUE (hour, station_id, variable_id)
+            );
+        ''', '''
+            DROP TABLE IF EXISTS public.last24h_partial;
+        '''),
+    ]
@@ -0,0 +1,20 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+    atomic = False
+
+    dependencies = [
+        ('wx', '0031_last24h_partial'),
+    ]
+
+    # Used by calculate_last24h_summary to find the hours with new reads. Built without blocking the ingestion,
+    # which keeps inserting summary tasks. IF NOT EXISTS: earlier versions of 0031 created it.
+    operations = [
+        migrations.RunSQL('''
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS wx_hourlysummarytask_datetime_idx ON public.wx_hourlysummarytask (datetime);
+        ''', '''
+            DROP INDEX CONCURRENTLY IF EXISTS public.wx_hourlysummarytask_datetime_idx;
+        '''),
+    ]
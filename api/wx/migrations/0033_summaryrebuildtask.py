@@ -0,0 +1,30 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wx', '0032_hourlysummarytask_datetime_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SummaryRebuildTask',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('rebuild_id', models.CharField(db_index=True, max_length=32)),
+                ('start_date', models.DateField()),
+                ('end_date', models.DateField()),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('attempts', models.IntegerField(default=0)),
+                ('station', models.ForeignKey(on_delete=django.db.models.deletion.DO_NOTHING, to='wx.station')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
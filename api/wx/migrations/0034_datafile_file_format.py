@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wx', '0033_summaryrebuildtask'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datafile',
+            name='file_format',
+            field=models.CharField(default='csv', max_length=10),
+        ),
+    ]
@@ -707,6 +707,7 @@ class DataFile(BaseModel):
     lines = models.IntegerField(null=True, blank=True, default=None)
     prepared_by = models.CharField(max_length=256, null=True, blank=True)
     interval_in_seconds = models.IntegerField(null=True, blank=True)
+    file_format = models.CharField(max_length=10, default='csv')
 
     def __str__(self):
         return 'file ' + str(self.id)
@@ -1012,6 +1013,7 @@ class HourlySummaryTask(BaseModel):
     datetime = models.DateTimeField()
     started_at = models.DateTimeField(null=True, blank=True)
     finished_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.IntegerField(default=0)
 
 
 class DailySummaryTask(BaseModel):
@@ -1019,6 +1021,17 @@ class DailySummaryTask(BaseModel):
     date = models.DateField()
     started_at = models.DateTimeField(null=True, blank=True)
     finished_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.IntegerField(default=0)
+
+
+class SummaryRebuildTask(BaseModel):
+    rebuild_id = models.CharField(max_length=32, db_index=True)
+    station = models.ForeignKey(Station, on_delete=models.DO_NOTHING)
+    start_date = models.DateField()
+    end_date = models.DateField()
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.IntegerField(default=0)
 
 
 class DcpMessages(BaseModel):
@@ -1275,6 +1288,7 @@ class HFSummaryTask(BaseModel):
     end_datetime = models.DateTimeField()
     started_at = models.DateTimeField(null=True, blank=True)
     finished_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.IntegerField(default=0)
 
     class Meta:
         unique_together = ('station', 'variable', 'start_datetime', 'end_datetime')
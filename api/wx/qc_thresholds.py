@@ -0,0 +1,232 @@
+import logging
+from time import time
+
+from django.core.cache import cache
+
+from wx.models import QcRangeThreshold, QcStepThreshold, QcPersistThreshold, Station, Variable
+
+logger = logging.getLogger('surface')
+
+# Shared (memcached) key holding the current thresholds version, bumped whenever a threshold is edited
+QC_THRESHOLDS_VERSION_KEY = 'qc_thresholds_version'
+
+# Thresholds edited outside the threshold views (e.g. django admin) are picked up after this many seconds
+QC_THRESHOLDS_MAX_AGE = 600
+
+# In-process thresholds, loaded per batch of stations with a few set-based queries. Every process (gunicorn or celery
+# worker) keeps its own copy, only kept in sync with the others through the shared version. They are not guarded by
+# a lock: both run single threaded workers, threads of the same process must not load or clear them concurrently.
+_state = {
+    'version': None,
+    'loaded_at': None,
+}
+_stations = {}  # station_id -> (reference_station_id, is_automatic)
+_loaded_station_ids = set()  # stations whose custom thresholds are already in memory
+_resolved_station_ids = set()  # stations whose own and reference station thresholds are both in memory
+_variables = {}  # variable_id -> global thresholds
+_step_thresholds = {}  # (station_id, variable_id, interval) -> (step_min, step_max)
+_range_thresholds = {}  # (station_id, variable_id, interval, month) -> (range_min, range_max)
+_persist_thresholds = {}  # (station_id, variable_id, interval, window) -> minimum_variance
+
+
+def get_qc_thresholds_version():
+    version = cache.get(QC_THRESHOLDS_VERSION_KEY)
+    if version is None:
+        version = time()
+        cache.add(QC_THRESHOLDS_VERSION_KEY, version, None)
+        version = cache.get(QC_THRESHOLDS_VERSION_KEY, version)
+    return version
+
+
+def invalidate_qc_thresholds():
+    # Every process compares its loaded version with this one before using its thresholds
+    cache.set(QC_THRESHOLDS_VERSION_KEY, time(), None)
+    _clear()
+
+
+def _clear():
+    _stations.clear()
+    _loaded_station_ids.clear()
+    _resolved_station_ids.clear()
+    _variables.clear()
+    _step_thresholds.clear()
+    _range_thresholds.clear()
+    _persist_thresholds.clear()
+    _state['version'] = None
+    _state['loaded_at'] = None
+
+
+def _check_version():
+    version = get_qc_thresholds_version()
+    expired = _state['loaded_at'] is not None and time() - _state['loaded_at'] > QC_THRESHOLDS_MAX_AGE
+    if version != _state['version'] or expired:
+        _clear()
+        _state['version'] = version
+        _state['loaded_at'] = time()
+
+
+def _load_stations(station_ids):
+    new_station_ids = station_ids - set(_stations)
+    if not new_station_ids:
+        return
+
+    for station_id, reference_station_id, is_automatic in (Station.objects.filter(id__in=new_station_ids)
+                                                           .values_list('id', 'reference_station_id', 'is_automatic')):
+        _stations[station_id] = (reference_station_id, is_automatic)
+
+
+def load_qc_thresholds(station_ids):
+    """Load in memory the custom thresholds of the given stations and of their reference stations"""
+    _check_version()
+
+    # A station loaded as the reference of another one may not have its own reference loaded yet
+    station_ids = set(int(station_id) for station_id in station_ids) - _resolved_station_ids
+    if not station_ids and _variables:
+        return
+
+    if not _variables:
+        for variable in Variable.objects.values('id', 'step', 'step_hourly', 'range_min', 'range_max',
+                                                'range_min_hourly', 'range_max_hourly', 'persistence',
+                                                'persistence_hourly'):
+            _variables[variable['id']] = variable
+
+    _load_stations(station_ids)
+    reference_station_ids = set(_stations[station_id][0] for station_id in station_ids if station_id in _stations)
+    # Reference stations may be requested later on their own, so their global fallback must be known as well
+    _load_stations(reference_station_ids - {None})
+
+    threshold_station_ids = (station_ids | reference_station_ids) - {None} - _loaded_station_ids
+    if not threshold_station_ids:
+        _resolved_station_ids.update(station_ids)
+        return
+
+    for station_id, variable_id, interval, step_min, step_max in (QcStepThreshold.objects
+            .filter(station_id__in=threshold_station_ids)
+            .values_list('station_id', 'variable_id', 'interval', 'step_min', 'step_max')):
+        _step_thresholds.setdefault((station_id, variable_id, interval), (step_min, step_max))
+
+    for station_id, variable_id, interval, month, range_min, range_max in (QcRangeThreshold.objects
+            .filter(station_id__in=threshold_station_ids)
+            .values_list('station_id', 'variable_id', 'interval', 'month', 'range_min', 'range_max')):
+        _range_thresholds.setdefault((station_id, variable_id, interval, month), (range_min, range_max))
+
+    for station_id, variable_id, interval, window, minimum_variance in (QcPersistThreshold.objects
+            .filter(station_id__in=threshold_station_ids)
+            .values_list('station_id', 'variable_id', 'interval', 'window', 'minimum_variance')):
+        _persist_thresholds.setdefault((station_id, variable_id, interval, window), minimum_variance)
+
+    _loaded_station_ids.update(threshold_station_ids)
+    _resolved_station_ids.update(station_ids)
+
+    logger.debug(f'Loaded QC thresholds for stations {sorted(threshold_station_ids)}')
+
+
+def _ensure_loaded(station_id):
+    # The version is checked once per batch by load_qc_thresholds, lookups only load what is missing
+    if station_id not in _resolved_station_ids:
+        load_qc_thresholds([station_id])
+
+
+def _custom_lookup(table, station_id, variable_id, interval, *extra):
+    # Custom station -> custom station with NULL interval -> reference station -> reference station with NULL interval
+    key = (station_id, variable_id, interval) + extra
+    if key in table:
+        return table[key], 'custom'
+
+    key = (station_id, variable_id, None) + extra
+    if key in table:
+        return table[key], 'custom_null_interval'
+
+    if station_id not in _stations:
+        return None, None
+
+    reference_station_id = _stations[station_id][0]
+    if reference_station_id is None:
+        return None, None
+
+    key = (reference_station_id, variable_id, interval) + extra
+    if key in table:
+        return table[key], 'reference'
+
+    key = (reference_station_id, variable_id, None) + extra
+    if key in table:
+        return table[key], 'reference'
+
+    return None, None
+
+
+def get_step_thresholds(thresholds, station_id, variable_id, interval):
+    _ensure_loaded(station_id)
+
+    value, level = _custom_lookup(_step_thresholds, station_id, variable_id, interval)
+    if level in ('custom', 'custom_null_interval'):
+        thresholds['step_min'], thresholds['step_max'] = value
+        thresholds['step_description'] = 'Custom station Threshold'
+    elif level == 'reference':
+        thresholds['step_min'], thresholds['step_max'] = value
+        thresholds['step_description'] = 'Reference station threshold'
+    elif station_id in _stations and variable_id in _variables:
+        variable = _variables[variable_id]
+        if _stations[station_id][1]:
+            if variable['step_hourly'] is not None:
+                thresholds['step_min'], thresholds['step_max'] = -variable['step_hourly'], variable['step_hourly']
+                thresholds['step_description'] = 'Global threshold (Automatic)'
+        else:
+            if variable['step'] is not None:
+                thresholds['step_min'], thresholds['step_max'] = -variable['step'], variable['step']
+                thresholds['step_description'] = 'Global threshold (Manual)'
+
+    return thresholds
+
+
+def get_range_thresholds(thresholds, station_id, variable_id, interval, month):
+    _ensure_loaded(station_id)
+
+    value, level = _custom_lookup(_range_thresholds, station_id, variable_id, interval, month)
+    if level == 'custom':
+        thresholds['range_min'], thresholds['range_max'] = value
+        thresholds['range_description'] = 'Custom station Threshold'
+    elif level == 'custom_null_interval':
+        thresholds['range_min'], thresholds['range_max'] = value
+        thresholds['range_description'] = 'Custom station threshold'
+    elif level == 'reference':
+        thresholds['range_min'], thresholds['range_max'] = value
+        thresholds['range_description'] = 'Reference station threshold'
+    elif station_id in _stations and variable_id in _variables:
+        variable = _variables[variable_id]
+        if _stations[station_id][1]:
+            thresholds['range_min'], thresholds['range_max'] = variable['range_min_hourly'], variable['range_max_hourly']
+            thresholds['range_description'] = 'Global threshold (Automatic)'
+        else:
+            thresholds['range_min'], thresholds['range_max'] = variable['range_min'], variable['range_max']
+            thresholds['range_description'] = 'Global threshold (Manual)'
+
+    return thresholds
+
+
+def get_group_thresholds(station_id, variable_id, interval, month):
+    """Step and range thresholds of a (station, variable, interval, month) group of reads"""
+    thresholds = get_step_thresholds({}, station_id, variable_id, interval)
+    return get_range_thresholds(thresholds, station_id, variable_id, interval, month)
+
+
+def get_persist_thresholds(thresholds, station_id, variable_id, interval, window):
+    _ensure_loaded(station_id)
+
+    value, level = _custom_lookup(_persist_thresholds, station_id, variable_id, interval, window)
+    if level in ('custom', 'custom_null_interval'):
+        thresholds['persist_min'] = value
+        thresholds['persist_des'] = 'Custom station Threshold'
+    elif level == 'reference':
+        thresholds['persist_min'] = value
+        thresholds['persist_des'] = 'Reference station threshold'
+    elif station_id in _stations and variable_id in _variables:
+        variable = _variables[variable_id]
+        if _stations[station_id][1]:
+            thresholds['persist_min'] = variable['persistence_hourly']
+            thresholds['persist_des'] = 'Global threshold (Automatic)'
+        else:
+            thresholds['persist_min'] = variable['persistence']
+            thresholds['persist_des'] = 'Global threshold (Manual)'
+
+    return thresholds
@@ -0,0 +1,24 @@
+from django.contrib.auth.models import Group, User
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from wx.context_processors import invalidate_wx_permissions
+from wx.models import WxGroupPermission, WxPermission
+
+
+@receiver(post_save, sender=WxPermission)
+@receiver(post_delete, sender=WxPermission)
+@receiver(post_save, sender=WxGroupPermission)
+@receiver(post_delete, sender=WxGroupPermission)
+@receiver(post_delete, sender=Group)
+def wx_permission_changed(sender, **kwargs):
+    # After the commit, so a request rendered before it cannot cache the old permissions under the new version
+    transaction.on_commit(invalidate_wx_permissions)
+
+
+@receiver(m2m_changed, sender=WxGroupPermission.permissions.through)
+@receiver(m2m_changed, sender=User.groups.through)
+def wx_permission_relation_changed(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        transaction.on_commit(invalidate_wx_permissions)
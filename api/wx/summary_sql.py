@@ -0,0 +1,58 @@
+from tempestas_api import settings
+from wx.enums import QualityFlagEnum
+
+# Reads entering the summaries: manual flag first, then the automatic flag
+SUMMARY_QUALITY_FLAGS = (QualityFlagEnum.NOT_CHECKED.id, QualityFlagEnum.GOOD.id)
+
+
+def summary_value_sql(alias='rd'):
+    # Consisted values replace the measured ones
+    return f'COALESCE({alias}.consisted, {alias}.measured)'
+
+
+def summary_reads_filter_sql(alias='rd'):
+    flags = ', '.join(str(flag) for flag in SUMMARY_QUALITY_FLAGS)
+    return f"""({alias}.manual_flag IN ({flags}) OR ({alias}.manual_flag IS NULL AND {alias}.quality_flag IN ({flags})))
+               AND {summary_value_sql(alias)} != {float(settings.MISSING_VALUE)}"""
+
+
+def summary_hour_sql(alias='rd'):
+    # Reads at midnight belong to the hour ending at it, daily reads to the hour they are at
+    return f"""CASE WHEN NOT {alias}.is_daily AND {alias}.datetime = {alias}.datetime::date
+                    THEN date_trunc('hour', {alias}.datetime - '1 second'::interval)
+                    ELSE date_trunc('hour', {alias}.datetime) END"""
+
+
+def hourly_summary_sql(target_sql):
+    """SELECT of the hourly summaries (datetime, station_id, variable_id, min_value, max_value, avg_value, sum_value,
+    num_records) of the reads of %(station_ids)s between %(start_datetime)s and %(end_datetime)s, keeping the
+    summaries matching target_sql, a condition over values.station_id and values.datetime"""
+    return f"""
+        SELECT
+            values.datetime,
+            values.station_id,
+            values.variable_id,
+            values.min_value,
+            values.max_value,
+            values.avg_value,
+            values.sum_value,
+            values.num_records
+        FROM
+            (SELECT
+                {summary_hour_sql('rd')} as datetime,
+                rd.station_id,
+                rd.variable_id,
+                min({summary_value_sql('rd')}) AS min_value,
+                max({summary_value_sql('rd')}) AS max_value,
+                avg({summary_value_sql('rd')}) AS avg_value,
+                sum({summary_value_sql('rd')}) AS sum_value,
+                count({summary_value_sql('rd')}) AS num_records
+            FROM raw_data rd
+            WHERE rd.datetime >= %(start_datetime)s
+              AND rd.datetime <= %(end_datetime)s
+              AND {summary_reads_filter_sql('rd')}
+              AND rd.station_id in %(station_ids)s
+            GROUP BY 1, 2, 3, rd.is_daily) values
+        WHERE {target_sql}
+    """
+
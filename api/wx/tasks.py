@@ -1,11 +1,17 @@
 from __future__ import absolute_import, unicode_literals
 
+import csv
 import hashlib
+import io
 import json
 import logging
 import os
+import re
+import shutil
 import socket
 import subprocess
+import uuid
+import zipfile
 from datetime import datetime, timedelta
 from ftplib import FTP, error_perm, error_reply
 from time import sleep, time
@@ -19,13 +25,15 @@ import psycopg2
 import pytz
 import requests
 import subprocess
-from celery import shared_task
+from celery import chord, group, shared_task
 from celery.utils.log import get_task_logger
 from django.core.cache import cache
 from django.db import connection
+from django.db.models import Count, F, Q
 
 
 from tempestas_api import settings
+from wx.db_pool import get_connection
 from wx.decoders.flash import read_data as read_data_flash
 from wx.decoders.hobo import read_file as read_file_hobo
 from wx.decoders.hydro import read_file as read_file_hydrology
@@ -36,22 +44,23 @@ from wx.decoders.sat_tx325 import read_data as read_data_sat_tx325
 from wx.decoders.surtron import read_data as read_data_surtron
 from wx.decoders.surface import read_file as read_file_surface
 from wx.decoders.toa5 import read_file as read_file_toa5
-from wx.models import DataFile
+from wx.models import DataFile, DataFileVariable
 from wx.models import Document
 from wx.models import NoaaDcp
 from wx.models import Station
 from wx.models import StationFileIngestion, StationDataFile
-from wx.models import HourlySummaryTask, DailySummaryTask
+from wx.models import HourlySummaryTask, DailySummaryTask, SummaryRebuildTask
 from wx.models import HydroMLPredictionStation, HydroMLPredictionMapping
 from wx.models import HighFrequencyData, HFSummaryTask
 from wx.decoders.insert_raw_data import insert as insert_rd
 
-from django.core.exceptions import ObjectDoesNotExist
 import numpy as np
 import pandas as pd
 from wx.models import Variable
-from wx.models import QcPersistThreshold, BackupTask, BackupLog
+from wx.models import BackupTask, BackupLog
+from wx.qc_thresholds import get_persist_thresholds, load_qc_thresholds
 from wx.enums import QualityFlagEnum
+from wx.summary_sql import hourly_summary_sql
 
 NOT_CHECKED = QualityFlagEnum.NOT_CHECKED.id
 SUSPICIOUS = QualityFlagEnum.SUSPICIOUS.id
@@ -61,9 +70,6 @@ GOOD = QualityFlagEnum.GOOD.id
 logger = get_task_logger(__name__)
 db_logger = get_task_logger('db')
 
-def get_connection():
-    return psycopg2.connect(settings.SURFACE_CONNECTION_STRING)
-
 ############################################################
 
 
@@ -256,82 +262,19 @@ def calculate_hourly_summary(start_datetime=None, end_datetime=None, station_id_
             created_at,
             updated_at
         )
-        SELECT 
-            values.datetime,
-            values.station_id,
-            values.variable_id,
-            values.min_value,
-            values.max_value,
-            values.avg_value,
-            values.sum_value,
-            values.num_records,
-            now(),
-            now()
-        FROM
-            (SELECT 
-                CASE WHEN rd.datetime = rd.datetime::date THEN date_trunc('hour', rd.datetime - '1 second'::interval) ELSE date_trunc('hour', rd.datetime) END as datetime,
-                station_id,
-                variable_id,
-                min(calc.value) AS min_value,
-                max(calc.value) AS max_value,
-                avg(calc.value) AS avg_value,
-                sum(calc.value) AS sum_value,
-                count(calc.value) AS num_records
-            FROM 
-                raw_data rd
-                ,LATERAL (SELECT CASE WHEN rd.consisted IS NOT NULL THEN rd.consisted ELSE rd.measured END as value) AS calc
-            WHERE rd.datetime >= %(start_datetime)s
-              AND rd.datetime <= %(end_datetime)s
-              AND (rd.manual_flag in (1,4) OR (rd.manual_flag IS NULL AND rd.quality_flag in (1,4)))
-              AND NOT rd.is_daily
-              AND calc.value != %(MISSING_VALUE)s
-              AND station_id in %(station_ids)s
-            GROUP BY 1,2,3) values
-        WHERE values.datetime = %(start_datetime)s
-        UNION ALL
-        SELECT 
-            values.datetime,
-            values.station_id,
-            values.variable_id,
-            values.min_value,
-            values.max_value,
-            values.avg_value,
-            values.sum_value,
-            values.num_records,
-            now(),
-            now()
-        FROM
-            (SELECT date_trunc('hour', rd.datetime) as datetime,
-                station_id,
-                variable_id,
-                min(calc.value) AS min_value,
-                max(calc.value) AS max_value,
-                avg(calc.value) AS avg_value,
-                sum(calc.value) AS sum_value,
-                count(calc.value) AS num_records
-            FROM 
-                raw_data rd
-                ,LATERAL (SELECT CASE WHEN rd.consisted IS NOT NULL THEN rd.consisted ELSE rd.measured END as value) AS calc
-            WHERE rd.datetime >= %(start_datetime)s
-              AND rd.datetime <= %(end_datetime)s
-              AND (rd.manual_flag in (1,4) OR (rd.manual_flag IS NULL AND rd.quality_flag in (1,4)))
-              AND rd.is_daily
-              AND calc.value != %(MISSING_VALUE)s
-              AND station_id in %(station_ids)s
-            GROUP BY 1,2,3) values
-        WHERE values.datetime = %(start_datetime)s
+        SELECT summary.*, now(), now()
+        FROM ({hourly_summary_sql('values.datetime = %(start_datetime)s')}) summary
     """
 
-    conn = get_connection()
-    with conn.cursor() as cursor:
-        cursor.execute(delete_sql, {"station_ids": station_ids, "start_datetime": start_datetime})
-        cursor.execute(insert_sql, {"station_ids": station_ids, "start_datetime": start_datetime, "end_datetime": end_datetime, "MISSING_VALUE": settings.MISSING_VALUE})
-    conn.commit()
-    conn.close()
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(delete_sql, {"station_ids": station_ids, "start_datetime": start_datetime})
+            cursor.execute(insert_sql, {"station_ids": station_ids, "start_datetime": start_datetime, "end_datetime": end_datetime})
+        conn.commit()
     logger.info(f'Hourly summary finished at {datetime.now(pytz.UTC)}. Took {time() - start_at} seconds.')
 
 @shared_task
-def calculate_daily_summary(start_date=None, end_date=None, station_id_list=None):
+def calculate_daily_summary(start_date=None, end_date=None, station_id_list=None, period_summary_keys=None):
     logger.info(f'DAILY SUMMARY started at {datetime.now(tz=pytz.UTC)} with parameters: '
                 f'start_date={start_date} end_date={end_date} '
                 f'station_id_list={station_id_list}')
@@ -346,110 +289,184 @@ def calculate_daily_summary(start_date=None, end_date=None, station_id_list=None
         print('Error - start_date is more recent than end_date.')
         return
 
-    conn = get_connection()
-    with conn.cursor() as cursor:
-
-        if station_id_list is None:
-            stations = Station.objects.filter(is_active=True)
-        else:
-            stations = Station.objects.filter(id__in=station_id_list)
-
-        offsets = list(set([s.utc_offset_minutes for s in stations]))
-        for offset in offsets:
-            station_ids = tuple(stations.filter(utc_offset_minutes=offset).values_list('id', flat=True))
-            fixed_offset = pytz.FixedOffset(offset)
-
-            datetime_start_utc = datetime(start_date.year, start_date.month, start_date.day, 0, 0, 0, tzinfo=pytz.UTC)
-            datetime_end_utc = datetime(end_date.year, end_date.month, end_date.day, 0, 0, 0, tzinfo=pytz.UTC)
-
-            datetime_start = datetime(start_date.year, start_date.month, start_date.day, 0, 0, 0,
-                                      tzinfo=fixed_offset).astimezone(pytz.UTC)
-            datetime_end = datetime(end_date.year, end_date.month, end_date.day, 0, 0, 0,
-                                    tzinfo=fixed_offset).astimezone(pytz.UTC)
-
-            logger.info(f"datetime_start={datetime_start}, datetime_end={datetime_end} "
-                        f"offset={offset} "
-                        f"station_ids={station_ids}")
-
-            delete_sql = """
-                DELETE FROM daily_summary 
-                WHERE station_id in %(station_ids)s 
-                AND day >= %(datetime_start)s
-                AND day < %(datetime_end)s
-            """
-
-            insert_sql = """
-                INSERT INTO daily_summary (
-                    "day",
-                    station_id,
-                    variable_id,
-                    min_value,
-                    max_value,
-                    avg_value,
-                    sum_value,
-                    num_records,
-                    created_at,
-                    updated_at
-                )
-                SELECT 
-                    cast((rd.datetime + interval '%(offset)s minutes') at time zone 'utc' - '1 second'::interval as DATE) as "date",
-                    station_id,
-                    variable_id,
-                    min(calc.value) AS min_value,
-                    max(calc.value) AS max_value,
-                    avg(calc.value) AS avg_value,
-                    sum(calc.value) AS sum_value,
-                    count(calc.value) AS num_records,
-                    now(),
-                    now()
-                FROM 
-                    raw_data rd
-                    ,LATERAL (SELECT CASE WHEN rd.consisted IS NOT NULL THEN rd.consisted ELSE rd.measured END as value) AS calc
-                WHERE rd.datetime > %(datetime_start)s
-                  AND rd.datetime <= %(datetime_end)s
-                  AND calc.value != %(MISSING_VALUE)s
-                  AND station_id in %(station_ids)s
-                  AND (rd.manual_flag in (1,4) OR (rd.manual_flag IS NULL AND rd.quality_flag in (1,4)))
-                  AND NOT rd.is_daily
-                GROUP BY 1,2,3
-                UNION ALL
-                SELECT 
-                    cast((rd.datetime + interval '%(offset)s minutes') at time zone 'utc' as DATE) as "date",
-                    station_id,
-                    variable_id,
-                    min(calc.value) AS min_value,
-                    max(calc.value) AS max_value,
-                    avg(calc.value) AS avg_value,
-                    sum(calc.value) AS sum_value,
-                    count(calc.value) AS num_records,
-                    now(),
-                    now()
-                FROM 
-                    raw_data rd
-                    ,LATERAL (SELECT CASE WHEN rd.consisted IS NOT NULL THEN rd.consisted ELSE rd.measured END as value) AS calc
-                WHERE rd.datetime > %(datetime_start)s
-                  AND rd.datetime <= %(datetime_end)s
-                  AND calc.value != %(MISSING_VALUE)s
-                  AND station_id in %(station_ids)s
-                  AND (rd.manual_flag in (1,4) OR (rd.manual_flag IS NULL AND rd.quality_flag in (1,4)))
-                  AND rd.is_daily
-                GROUP BY 1,2,3
-            """
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
 
-            cursor.execute(delete_sql, {"datetime_start": datetime_start_utc, "datetime_end": datetime_end_utc,
-                                        "station_ids": station_ids})
-            cursor.execute(insert_sql,
-                           {"datetime_start": datetime_start, "datetime_end": datetime_end, "station_ids": station_ids,
-                            "offset": offset, "MISSING_VALUE": settings.MISSING_VALUE})
-            conn.commit()
+            if station_id_list is None:
+                stations = Station.objects.filter(is_active=True)
+            else:
+                stations = Station.objects.filter(id__in=station_id_list)
+
+            offsets = list(set([s.utc_offset_minutes for s in stations]))
+            for offset in offsets:
+                station_ids = tuple(stations.filter(utc_offset_minutes=offset).values_list('id', flat=True))
+                fixed_offset = pytz.FixedOffset(offset)
+
+                datetime_start_utc = datetime(start_date.year, start_date.month, start_date.day, 0, 0, 0, tzinfo=pytz.UTC)
+                datetime_end_utc = datetime(end_date.year, end_date.month, end_date.day, 0, 0, 0, tzinfo=pytz.UTC)
+
+                datetime_start = datetime(start_date.year, start_date.month, start_date.day, 0, 0, 0,
+                                          tzinfo=fixed_offset).astimezone(pytz.UTC)
+                datetime_end = datetime(end_date.year, end_date.month, end_date.day, 0, 0, 0,
+                                        tzinfo=fixed_offset).astimezone(pytz.UTC)
+
+                logger.info(f"datetime_start={datetime_start}, datetime_end={datetime_end} "
+                            f"offset={offset} "
+                            f"station_ids={station_ids}")
+
+                delete_sql = """
+                    DELETE FROM daily_summary 
+                    WHERE station_id in %(station_ids)s 
+                    AND day >= %(datetime_start)s
+                    AND day < %(datetime_end)s
+                """
+
+                insert_sql = """
+                    INSERT INTO daily_summary (
+                        "day",
+                        station_id,
+                        variable_id,
+                        min_value,
+                        max_value,
+                        avg_value,
+                        sum_value,
+                        num_records,
+                        created_at,
+                        updated_at
+                    )
+                    SELECT 
+                        cast((rd.datetime + interval '%(offset)s minutes') at time zone 'utc' - '1 second'::interval as DATE) as "date",
+                        station_id,
+                        variable_id,
+                        min(calc.value) AS min_value,
+                        max(calc.value) AS max_value,
+                        avg(calc.value) AS avg_value,
+                        sum(calc.value) AS sum_value,
+                        count(calc.value) AS num_records,
+                        now(),
+                        now()
+                    FROM 
+                        raw_data rd
+                        ,LATERAL (SELECT CASE WHEN rd.consisted IS NOT NULL THEN rd.consisted ELSE rd.measured END as value) AS calc
+                    WHERE rd.datetime > %(datetime_start)s
+                      AND rd.datetime <= %(datetime_end)s
+                      AND calc.value != %(MISSING_VALUE)s
+                      AND station_id in %(station_ids)s
+                      AND (rd.manual_flag in (1,4) OR (rd.manual_flag IS NULL AND rd.quality_flag in (1,4)))
+                      AND NOT rd.is_daily
+                    GROUP BY 1,2,3
+                    UNION ALL
+                    SELECT 
+                        cast((rd.datetime + interval '%(offset)s minutes') at time zone 'utc' as DATE) as "date",
+                        station_id,
+                        variable_id,
+                        min(calc.value) AS min_value,
+                        max(calc.value) AS max_value,
+                        avg(calc.value) AS avg_value,
+                        sum(calc.value) AS sum_value,
+                        count(calc.value) AS num_records,
+                        now(),
+                        now()
+                    FROM 
+                        raw_data rd
+                        ,LATERAL (SELECT CASE WHEN rd.consisted IS NOT NULL THEN rd.consisted ELSE rd.measured END as value) AS calc
+                    WHERE rd.datetime > %(datetime_start)s
+                      AND rd.datetime <= %(datetime_end)s
+                      AND calc.value != %(MISSING_VALUE)s
+                      AND station_id in %(station_ids)s
+                      AND (rd.manual_flag in (1,4) OR (rd.manual_flag IS NULL AND rd.quality_flag in (1,4)))
+                      AND rd.is_daily
+                    GROUP BY 1,2,3
+                """
+
+                cursor.execute(delete_sql, {"datetime_start": datetime_start_utc, "datetime_end": datetime_end_utc,
+                                            "station_ids": station_ids})
+                cursor.execute(insert_sql,
+                               {"datetime_start": datetime_start, "datetime_end": datetime_end, "station_ids": station_ids,
+                                "offset": offset, "MISSING_VALUE": settings.MISSING_VALUE})
+                # Callers processing several ranges collect the months to refresh them once
+                if period_summary_keys is None:
+                    refresh_period_summaries(cursor, get_period_summary_keys(station_ids, start_date, end_date))
+                else:
+                    period_summary_keys.update(get_period_summary_keys(station_ids, start_date, end_date))
+                conn.commit()
 
 
-    conn.commit()
-    conn.close()
+        conn.commit()
 
     cache.set('daily_summary_last_run', datetime.today(), None)
     logger.info(f'Daily summary finished at {datetime.now(pytz.UTC)}. Took {time() - start_at} seconds.')
 
+def get_period_summary_keys(station_ids, start_date, end_date):
+    # (station_id, first day of the month) of every month with days from start_date to end_date (exclusive)
+    last_date = max(start_date, end_date - timedelta(days=1))
+    months = []
+    month = datetime(start_date.year, start_date.month, 1)
+    while month.date() <= last_date:
+        months.append(month)
+        month = datetime(month.year + month.month // 12, month.month % 12 + 1, 1)
+    return set((station_id, month) for station_id in station_ids for month in months)
+
+def refresh_period_summaries(cursor, period_summary_keys):
+    """Recalculate the monthly_summary rows of the given (station_id, first day of the month) from daily_summary,
+    then the yearly_summary rows of their years from monthly_summary"""
+    if not period_summary_keys:
+        return
+
+    month_keys = sorted(period_summary_keys)
+    year_keys = sorted(set((station_id, datetime(month.year, 1, 1)) for station_id, month in month_keys))
+
+    for table, constraint, period, key_columns, source_table, source_date, keys in (
+            ('monthly_summary', 'monthly_summary_uniq', 'month', ['year', 'month'], 'daily_summary', 'day', month_keys),
+            ('yearly_summary', 'yearly_summary_uniq', 'year', ['year'], 'monthly_summary', 'date', year_keys)):
+
+        key_select = ', '.join(f"extract('{column}' from target.date) AS {column}" for column in key_columns)
+        key_insert = ', '.join(key_columns)
+        group_by = ', '.join(str(i) for i in range(1, len(key_columns) + 4))
+
+        cursor.execute(f"""
+            WITH target AS (
+                SELECT * FROM unnest(%(station_ids)s::integer[], %(dates)s::timestamp[]) AS target(station_id, date)
+            ), computed AS (
+                SELECT {key_select},
+                       target.date,
+                       source.station_id,
+                       source.variable_id,
+                       min(source.min_value) AS min_value,
+                       max(source.max_value) AS max_value,
+                       sum(source.sum_value) / sum(source.num_records) AS avg_value,
+                       sum(source.sum_value) AS sum_value,
+                       sum(source.num_records) AS num_records
+                  FROM target
+                  JOIN {source_table} source ON source.station_id = target.station_id
+                                            AND source.{source_date} >= target.date
+                                            AND source.{source_date} < target.date + INTERVAL '1 {period}'
+                 WHERE source.variable_id IS NOT NULL
+                 GROUP BY {group_by}
+            ), deleted AS (
+                DELETE FROM {table} summary
+                 USING target
+                 WHERE summary.station_id = target.station_id
+                   AND summary.date = target.date
+                   AND NOT EXISTS (SELECT 1
+                                     FROM computed
+                                    WHERE computed.date = summary.date
+                                      AND computed.station_id = summary.station_id
+                                      AND computed.variable_id = summary.variable_id)
+            )
+            INSERT INTO {table} ({key_insert}, date, station_id, variable_id, min_value, max_value, avg_value, sum_value, num_records)
+            SELECT {key_insert}, date, station_id, variable_id, min_value, max_value, avg_value, sum_value, num_records
+              FROM computed
+            ON CONFLICT ON CONSTRAINT {constraint} DO UPDATE
+               SET min_value = excluded.min_value
+                  ,max_value = excluded.max_value
+                  ,avg_value = excluded.avg_value
+                  ,sum_value = excluded.sum_value
+                  ,num_records = excluded.num_records
+             WHERE ({table}.min_value, {table}.max_value, {table}.avg_value, {table}.sum_value, {table}.num_records)
+                   IS DISTINCT FROM (excluded.min_value, excluded.max_value, excluded.avg_value, excluded.sum_value, excluded.num_records)
+        """, {"station_ids": [station_id for station_id, date in keys], "dates": [date for station_id, date in keys]})
+
 @shared_task
 def calculate_station_minimum_interval(start_date=None, end_date=None, station_id_list=None):
     logger.info(f'CALCULATE STATION MINIMUM INTERVAL started at {datetime.now(tz=pytz.UTC)} with parameters: '
@@ -466,180 +483,288 @@ def calculate_station_minimum_interval(start_date=None, end_date=None, station_i
         print('Error - start_date is more recent than end_date.')
         return
 
-    conn = get_connection()
-    with conn.cursor() as cursor:
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
 
-        if station_id_list is None:
-            stations = Station.objects.filter(is_active=True)
-        else:
-            stations = Station.objects.filter(id__in=station_id_list)
-
-        offsets = list(set([s.utc_offset_minutes for s in stations]))
-        for offset in offsets:
-            station_ids = tuple(stations.filter(utc_offset_minutes=offset).values_list('id', flat=True))
-            fixed_offset = pytz.FixedOffset(offset)
-
-            datetime_start_utc = datetime(start_date.year, start_date.month, start_date.day, 0, 0, 0, tzinfo=pytz.UTC)
-            datetime_end_utc = datetime(end_date.year, end_date.month, end_date.day, 0, 0, 0, tzinfo=pytz.UTC)
-
-            datetime_start = datetime(start_date.year, start_date.month, start_date.day, 0, 0, 0,
-                                      tzinfo=fixed_offset).astimezone(pytz.UTC)
-            datetime_end = datetime(end_date.year, end_date.month, end_date.day, 0, 0, 0,
-                                    tzinfo=fixed_offset).astimezone(pytz.UTC)
-
-            logger.info(f"datetime_start={datetime_start}, datetime_end={datetime_end} "
-                        f"offset={offset} "
-                        f"station_ids={station_ids}")
-
-            insert_minimum_data_interval = """
-                INSERT INTO wx_stationdataminimuminterval (
-                     datetime
-                    ,station_id
-                    ,variable_id
-                    ,minimum_interval
-                    ,record_count
-                    ,ideal_record_count
-                    ,record_count_percentage
-                    ,created_at
-                    ,updated_at
-                ) 
-                SELECT current_day
-                      ,[station_id]station_id
-                      ,stationvariable.variable_id
-                      ,min(value.data_interval) as minimum_interval
-                      ,COALESCE(count(value.formated_datetime), 0) as record_count 
-                      ,COALESCE(EXTRACT('EPOCH' FROM interval '1 day') / EXTRACT('EPOCH' FROM min(value.data_interval)), 0) as ideal_record_count
-                      ,COALESCE(count(value.formated_datetime) / (EXTRACT('EPOCH' FROM interval '1 day') / EXTRACT('EPOCH' FROM min(value.data_interval))) * 100, 0) as record_count_percentage
-                      ,now()
-                      ,now()
-                FROM generate_series(%(datetime_start)s , %(datetime_end)s , INTERVAL '1 day') as current_day
-                    ,wx_stationvariable as stationvariable
-                    ,wx_station as station
-                LEFT JOIN LATERAL (
-                    SELECT date_trunc('day', rd.datetime - INTERVAL '1 second' + (COALESCE(station.utc_offset_minutes, 0)||' minutes')::interval) as formated_datetime
-                          ,CASE WHEN rd.is_daily THEN '24:00:00' ELSE LEAD(datetime, 1) OVER (partition by station_id, variable_id order by datetime) - datetime END as data_interval
-                    FROM raw_data rd
-                    WHERE rd.datetime   > current_day - ((COALESCE(station.utc_offset_minutes, 0)||' minutes')::interval)
-                      AND rd.datetime   <= current_day + INTERVAL '1 DAY' - ((COALESCE(station.utc_offset_minutes, 0)||' minutes')::interval)
-                      AND rd.station_id  = stationvariable.station_id
-                      AND rd.variable_id = stationvariable.variable_id
-                ) value ON TRUE
-                WHERE stationvariable.station_id IN %(station_ids)s
-                  AND stationvariable.station_id = station.id
-                  AND (value.formated_datetime = current_day OR value.formated_datetime is null)
-                GROUP BY current_day, stationvariable.station_id, stationvariable.variable_id
-                  ON CONFLICT (datetime, station_id, variable_id)
-                  DO UPDATE SET
-                     minimum_interval        = excluded.minimum_interval
-                    ,record_count            = excluded.record_count
-                    ,ideal_record_count      = excluded.ideal_record_count
-                    ,record_count_percentage = excluded.record_count_percentage
-                    ,updated_at = now()
-            """
-            cursor.execute(insert_minimum_data_interval,
-                           {"datetime_start": datetime_start_utc, "datetime_end": datetime_end_utc,
-                            "station_ids": station_ids})
-            conn.commit()
+            if station_id_list is None:
+                stations = Station.objects.filter(is_active=True)
+            else:
+                stations = Station.objects.filter(id__in=station_id_list)
+
+            offsets = list(set([s.utc_offset_minutes for s in stations]))
+            for offset in offsets:
+                station_ids = tuple(stations.filter(utc_offset_minutes=offset).values_list('id', flat=True))
+                fixed_offset = pytz.FixedOffset(offset)
+
+                datetime_start_utc = datetime(start_date.year, start_date.month, start_date.day, 0, 0, 0, tzinfo=pytz.UTC)
+                datetime_end_utc = datetime(end_date.year, end_date.month, end_date.day, 0, 0, 0, tzinfo=pytz.UTC)
+
+                datetime_start = datetime(start_date.year, start_date.month, start_date.day, 0, 0, 0,
+                                          tzinfo=fixed_offset).astimezone(pytz.UTC)
+                # Reads of the last day go up to (and include) the local midnight after it
+                datetime_end = (datetime(end_date.year, end_date.month, end_date.day, 0, 0, 0, tzinfo=fixed_offset)
+                                + timedelta(days=1)).astimezone(pytz.UTC)
+
+                logger.info(f"datetime_start={datetime_start}, datetime_end={datetime_end} "
+                            f"offset={offset} "
+                            f"station_ids={station_ids}")
+
+                # A single ordered pass over the reads of the stations, the interval of a read being the time until the
+                # next read of the same local day. Station variables without reads on a day get a zero row.
+                insert_minimum_data_interval = """
+                    WITH value AS (
+                        SELECT reads.formated_datetime
+                              ,reads.station_id
+                              ,reads.variable_id
+                              ,min(reads.data_interval) AS minimum_interval
+                              ,count(1) AS record_count
+                        FROM (
+                            SELECT date_trunc('day', rd.datetime - INTERVAL '1 second' + %(offset)s * INTERVAL '1 minute') as formated_datetime
+                                  ,rd.station_id
+                                  ,rd.variable_id
+                                  ,CASE WHEN rd.is_daily THEN '24:00:00'
+                                        ELSE LEAD(rd.datetime, 1) OVER (partition by rd.station_id, rd.variable_id, date_trunc('day', rd.datetime - INTERVAL '1 second' + %(offset)s * INTERVAL '1 minute')
+                                                                        order by rd.datetime) - rd.datetime END as data_interval
+                            FROM raw_data rd
+                            WHERE rd.datetime   > %(datetime_start)s
+                              AND rd.datetime  <= %(datetime_end)s
+                              AND rd.station_id IN %(station_ids)s
+                        ) reads
+                        GROUP BY 1, 2, 3
+                    )
+                    INSERT INTO wx_stationdataminimuminterval (
+                         datetime
+                        ,station_id
+                        ,variable_id
+                        ,minimum_interval
+                        ,record_count
+                        ,ideal_record_count
+                        ,record_count_percentage
+                        ,created_at
+                        ,updated_at
+                    ) 
+                    SELECT current_day
+                          ,stationvariable.station_id
+                          ,stationvariable.variable_id
+                          ,value.minimum_interval
+                          ,COALESCE(value.record_count, 0) as record_count 
+                          ,COALESCE(EXTRACT('EPOCH' FROM interval '1 day') / EXTRACT('EPOCH' FROM value.minimum_interval), 0) as ideal_record_count
+                          ,COALESCE(value.record_count / (EXTRACT('EPOCH' FROM interval '1 day') / EXTRACT('EPOCH' FROM value.minimum_interval)) * 100, 0) as record_count_percentage
+                          ,now()
+                          ,now()
+                    FROM generate_series(%(datetime_start_utc)s , %(datetime_end_utc)s , INTERVAL '1 day') as current_day
+                    JOIN wx_stationvariable as stationvariable ON stationvariable.station_id IN %(station_ids)s
+                    LEFT JOIN value ON value.formated_datetime = current_day
+                                   AND value.station_id = stationvariable.station_id
+                                   AND value.variable_id = stationvariable.variable_id
+                      ON CONFLICT (datetime, station_id, variable_id)
+                      DO UPDATE SET
+                         minimum_interval        = excluded.minimum_interval
+                        ,record_count            = excluded.record_count
+                        ,ideal_record_count      = excluded.ideal_record_count
+                        ,record_count_percentage = excluded.record_count_percentage
+                        ,updated_at = now()
+                """
+                cursor.execute(insert_minimum_data_interval,
+                               {"datetime_start_utc": datetime_start_utc, "datetime_end_utc": datetime_end_utc,
+                                "datetime_start": datetime_start, "datetime_end": datetime_end,
+                                "station_ids": station_ids, "offset": offset})
+                conn.commit()
 
-    conn.commit()
-    conn.close()
+        conn.commit()
 
     logger.info(f'Calculate minimum interval finished at {datetime.now(pytz.UTC)}. Took {time() - start_at} seconds.')
 
+# Cache key of the last hour closed and the time of the previous calculate_last24h_summary run
+LAST24H_SUMMARY_STATE_KEY = 'last24h_summary_state'
+
+# Summary tasks are read again for this long after a run, as ingestion transactions may commit after it
+LAST24H_SUMMARY_TASKS_OVERLAP = timedelta(minutes=10)
+
+def last24h_partial_sql(where_sql):
+    # Per hour, station and variable aggregates of the reads matching where_sql, with the last24h_summary filters
+    return f"""
+        SELECT 
+            date_trunc('hour', rd.datetime) AS hour,
+            rd.station_id,
+            rd.variable_id,
+            min(calc.value) FILTER (WHERE calc.value != %(MISSING_VALUE)s) AS min_value,
+            max(calc.value) FILTER (WHERE calc.value != %(MISSING_VALUE)s) AS max_value,
+            sum(calc.value) FILTER (WHERE calc.value != %(MISSING_VALUE)s) AS sum_value,
+            count(calc.value) FILTER (WHERE calc.value != %(MISSING_VALUE)s) AS num_records,
+            max(rd.datetime) FILTER (WHERE rd.measured != %(MISSING_VALUE)s) AS latest_datetime,
+            (array_agg(calc.value ORDER BY rd.datetime DESC) FILTER (WHERE rd.measured != %(MISSING_VALUE)s))[1] AS latest_value
+        FROM 
+            raw_data rd
+            ,LATERAL (SELECT CASE WHEN rd.consisted IS NOT NULL THEN rd.consisted ELSE rd.measured END as value) AS calc
+        WHERE (rd.consisted IS NOT NULL OR rd.quality_flag in (1, 4))
+          AND rd.is_daily = false
+          AND {where_sql}
+        GROUP BY 1,2,3
+    """
+
+def refresh_last24h_partials(cursor, start_hour, end_hour, station_hours=None):
+    """Recalculate the last24h_partial rows of every station, or of the given (station_id, hour), from start_hour
+    to end_hour. Rows inserted by a concurrent run after the DELETE are overwritten."""
+    params = {"start_hour": start_hour, "end_hour": end_hour, "MISSING_VALUE": settings.MISSING_VALUE}
+
+    if station_hours is None:
+        cursor.execute("DELETE FROM last24h_partial WHERE hour >= %(start_hour)s AND hour < %(end_hour)s", params)
+        target_sql = ""
+        where_sql = "rd.datetime >= %(start_hour)s AND rd.datetime < %(end_hour)s"
+    else:
+        params["target_station_ids"] = [station_id for station_id, hour in station_hours]
+        params["target_hours"] = [hour for station_id, hour in station_hours]
+        params["station_ids"] = tuple(set(station_id for station_id, hour in station_hours))
+        target_sql = """
+            WITH target AS (
+                SELECT *
+                  FROM unnest(%(target_station_ids)s::integer[], %(target_hours)s::timestamptz[]) AS target(station_id, hour)
+            )
+        """
+        cursor.execute(f"""
+            {target_sql}
+            DELETE FROM last24h_partial partial
+             USING target
+             WHERE partial.station_id = target.station_id
+               AND partial.hour = target.hour
+        """, params)
+        where_sql = """rd.datetime >= %(start_hour)s AND rd.datetime < %(end_hour)s
+          AND rd.station_id in %(station_ids)s
+          AND (rd.station_id, date_trunc('hour', rd.datetime)) IN (SELECT station_id, hour FROM target)"""
+
+    cursor.execute(f"""
+        {target_sql}
+        INSERT INTO last24h_partial (
+            hour,
+            station_id,
+            variable_id,
+            min_value,
+            max_value,
+            sum_value,
+            num_records,
+            latest_datetime,
+            latest_value
+        )
+        {last24h_partial_sql(where_sql)}
+        ON CONFLICT ON CONSTRAINT last24h_partial_uniq DO UPDATE
+           SET min_value = excluded.min_value
+              ,max_value = excluded.max_value
+              ,sum_value = excluded.sum_value
+              ,num_records = excluded.num_records
+              ,latest_datetime = excluded.latest_datetime
+              ,latest_value = excluded.latest_value
+    """, params)
+
 @shared_task
 def calculate_last24h_summary():
     print('Last 24h summary started at {}'.format(datetime.today()))
 
-    conn = get_connection()
+    now = datetime.now(pytz.UTC)
+    window_start = now - timedelta(days=1)
+    # Hours entirely inside the window come from last24h_partial, the first and the current hour from raw_data
+    first_full_hour = window_start.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+    current_hour = now.replace(minute=0, second=0, microsecond=0)
 
-    with conn.cursor() as cursor:
-        sql_delete = "DELETE FROM last24h_summary"
-        print(sql_delete)
-        cursor.execute(sql_delete)
+    state = cache.get(LAST24H_SUMMARY_STATE_KEY)
 
-        sql_insert = f"""
-            INSERT INTO last24h_summary (
-                datetime,
-                station_id,
-                variable_id,
-                min_value,
-                max_value,
-                avg_value,
-                sum_value,
-                num_records,
-                latest_value
-            )
-            WITH last AS (
-                SELECT
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
+            # Hours falling out of the window
+            cursor.execute("DELETE FROM last24h_partial WHERE hour < %(first_full_hour)s",
+                           {"first_full_hour": first_full_hour})
+
+            if state is None or state['closed_until'] < first_full_hour:
+                refresh_last24h_partials(cursor, first_full_hour, current_hour)
+            else:
+                # Hours closed since the previous run
+                if state['closed_until'] < current_hour:
+                    refresh_last24h_partials(cursor, state['closed_until'], current_hour)
+
+                # Hours with new reads or new quality flags since the previous run
+                cursor.execute("""
+                    SELECT DISTINCT station_id, datetime
+                      FROM wx_hourlysummarytask
+                     WHERE datetime >= %(start_hour)s
+                       AND datetime < %(end_hour)s
+                       AND (created_at >= %(since)s OR finished_at >= %(since)s)
+                """, {"start_hour": first_full_hour, "end_hour": state['closed_until'],
+                      "since": state['tasks_since'] - LAST24H_SUMMARY_TASKS_OVERLAP})
+                station_hours = cursor.fetchall()
+                if station_hours:
+                    refresh_last24h_partials(cursor, first_full_hour, state['closed_until'], station_hours)
+
+            # Replaced in a single transaction, readers see either the previous or the new summaries
+            sql_upsert = f"""
+                WITH parts AS (
+                    SELECT station_id, variable_id, min_value, max_value, sum_value, num_records, latest_datetime, latest_value
+                      FROM last24h_partial
+                     WHERE hour >= %(first_full_hour)s
+                       AND hour < %(current_hour)s
+                    UNION ALL
+                    SELECT station_id, variable_id, min_value, max_value, sum_value, num_records, latest_datetime, latest_value
+                      FROM ({last24h_partial_sql("rd.datetime > %(window_start)s AND rd.datetime < %(first_full_hour)s")}) first_hour
+                    UNION ALL
+                    SELECT station_id, variable_id, min_value, max_value, sum_value, num_records, latest_datetime, latest_value
+                      FROM ({last24h_partial_sql("rd.datetime >= %(current_hour)s AND rd.datetime <= %(now)s")}) current_hour
+                ), agg AS (
+                    SELECT 
+                        station_id,
+                        variable_id,
+                        min(min_value) AS min_value,
+                        max(max_value) AS max_value,
+                        sum(sum_value) / sum(num_records) AS avg_value,
+                        sum(sum_value) AS sum_value,
+                        sum(num_records) AS num_records,
+                        (array_agg(latest_value ORDER BY latest_datetime DESC) FILTER (WHERE latest_datetime IS NOT NULL))[1] AS latest_value
+                    FROM parts
+                    GROUP BY 1,2
+                    HAVING sum(num_records) > 0
+                       AND max(latest_datetime) IS NOT NULL
+                ), deleted AS (
+                    DELETE FROM last24h_summary summary
+                     WHERE NOT EXISTS (SELECT 1
+                                         FROM agg
+                                        WHERE agg.station_id = summary.station_id
+                                          AND agg.variable_id = summary.variable_id)
+                )
+                INSERT INTO last24h_summary (
                     datetime,
                     station_id,
                     variable_id,
+                    min_value,
+                    max_value,
+                    avg_value,
+                    sum_value,
+                    num_records,
                     latest_value
+                )
+                SELECT
+                    %(now)s,
+                    agg.station_id,
+                    agg.variable_id,
+                    agg.min_value,
+                    agg.max_value,
+                    agg.avg_value,
+                    agg.sum_value,
+                    agg.num_records,
+                    agg.latest_value
                 FROM
-                    (SELECT 
-                        datetime,
-                        station_id,
-                        variable_id,
-                        calc.value AS latest_value,
-                        row_number() over (partition by station_id, variable_id order by datetime desc) as rownum
-                    FROM 
-                        raw_data rd
-                        ,LATERAL (SELECT CASE WHEN rd.consisted IS NOT NULL THEN rd.consisted ELSE rd.measured END as value) AS calc
-                    WHERE datetime > (now() - interval '1 day')
-                    AND datetime <= now()
-                    AND (rd.consisted IS NOT NULL OR quality_flag in (1, 4))
-                    AND measured != {settings.MISSING_VALUE}
-                    AND is_daily = false) AS latest
-                WHERE
-                    rownum = 1
-            ),
-            agg AS (
-                SELECT 
-                    station_id,
-                    variable_id,
-                    min(calc.value) AS min_value,
-                    max(calc.value) AS max_value,
-                    avg(calc.value) AS avg_value,
-                    sum(calc.value) AS sum_value,
-                    count(calc.value) AS num_records
-                FROM 
-                    raw_data rd
-                    ,LATERAL (SELECT CASE WHEN rd.consisted IS NOT NULL THEN rd.consisted ELSE rd.measured END as value) AS calc
-                WHERE datetime >  (now() - interval '1 day')
-                  AND datetime <= now()
-                  AND (rd.consisted IS NOT NULL OR quality_flag in (1, 4))
-                  AND calc.value != {settings.MISSING_VALUE}
-                  AND is_daily = false
-                GROUP BY 1,2
-            )
-            SELECT
-                now(),
-                agg.station_id,
-                agg.variable_id,
-                agg.min_value,
-                agg.max_value,
-                agg.avg_value,
-                agg.sum_value,
-                agg.num_records,
-                last.latest_value
-            FROM
-                agg
-                JOIN last ON agg.station_id = last.station_id AND agg.variable_id = last.variable_id
-            ON CONFLICT (station_id, variable_id) DO
-            UPDATE SET
-                min_value = excluded.min_value,
-                max_value = excluded.max_value,
-                avg_value = excluded.avg_value,
-                sum_value = excluded.sum_value,
-                num_records = excluded.num_records,
-                latest_value = excluded.latest_value,
-                datetime = excluded.datetime;
-        """
-        print(sql_insert)
-        cursor.execute(sql_insert)
+                    agg
+                ON CONFLICT (station_id, variable_id) DO
+                UPDATE SET
+                    min_value = excluded.min_value,
+                    max_value = excluded.max_value,
+                    avg_value = excluded.avg_value,
+                    sum_value = excluded.sum_value,
+                    num_records = excluded.num_records,
+                    latest_value = excluded.latest_value,
+                    datetime = excluded.datetime;
+            """
+            cursor.execute(sql_upsert, {"now": now, "window_start": window_start, "first_full_hour": first_full_hour,
+                                        "current_hour": current_hour, "MISSING_VALUE": settings.MISSING_VALUE})
 
-    conn.commit()
-    conn.close()
+    cache.set(LAST24H_SUMMARY_STATE_KEY, {'closed_until': current_hour, 'tasks_since': now}, None)
 
     cache.set('last24h_summary_last_run', datetime.today(), None)
     print('Last 24h summary finished at {}'.format(datetime.today()))
@@ -829,319 +954,546 @@ def process_received_data(entl_socket):
 def save_flash_data(data_string):
     read_data_flash(data_string.encode('latin-1'))
 
-@shared_task
-def export_data(station_id, source, start_date, end_date, variable_ids, file_id):
-    logger.info(f'Exporting data (file "{file_id}")')
+# Rows fetched per round trip by the server-side cursor of an export
+EXPORT_CURSOR_ITERSIZE = 5000
 
-    timezone_offset = pytz.timezone(settings.TIMEZONE_NAME)
-    start_date_utc = pytz.UTC.localize(datetime.strptime(start_date, '%Y-%m-%d %H:%M:%S'))
-    end_date_utc = pytz.UTC.localize(datetime.strptime(end_date, '%Y-%m-%d %H:%M:%S'))
+# DataFile.lines is updated every this many lines while a file is exported
+EXPORT_PROGRESS_LINES = 10000
 
-    station = Station.objects.get(pk=station_id)
-    current_datafile = DataFile.objects.get(pk=file_id)
+def get_export_query(source, station, variable_ids, start_datetime, end_datetime, data_interval):
+    """Query of every (datetime, variable_id, value) of an export, with -99.9 for missing values, ordered by datetime
+    and variable so the rows of a time step arrive together"""
+    params = {'utc_offset': station.utc_offset_minutes, 'variable_ids': variable_ids,
+              'start_datetime': start_datetime, 'end_datetime': end_datetime,
+              'station_id': station.id, 'data_interval': data_interval}
 
-    variable_ids = tuple(variable_ids)
-    # variable_ids = ','.join([str(x) for x in variable_ids])
+    summary_value = '''
+        COALESCE(CASE WHEN var.sampling_operation_id in (1,2) THEN data.avg_value::real
+        WHEN var.sampling_operation_id = 3      THEN data.min_value
+        WHEN var.sampling_operation_id = 4      THEN data.max_value
+        WHEN var.sampling_operation_id = 6      THEN data.sum_value
+        ELSE data.sum_value END, '-99.9') as value'''
 
-    # Diferent data sources have diferents columns names for the measurement data and diferents intervals
     if source == 'raw_data':
-        datetime_variable = 'datetime'
-        data_source_description = 'Raw data'
-        converted_start_date = start_date_utc
-        converted_end_date = end_date_utc
+        query = '''
+            WITH processed_data AS (
+                SELECT datetime
+                    ,var.id as variable_id
+                    ,COALESCE(CASE WHEN var.variable_type ilike 'code' THEN data.code ELSE data.measured::varchar END, '-99.9') AS value
+                FROM raw_data data
+                JOIN wx_variable var ON data.variable_id = var.id AND var.id IN %(variable_ids)s
+                WHERE data.datetime >= %(start_datetime)s
+                AND data.datetime < %(end_datetime)s
+                AND data.station_id = %(station_id)s
+            )
+            SELECT (generated_time + interval '%(utc_offset)s minutes') at time zone 'utc' as datetime
+                ,variable.id
+                ,COALESCE(value, '-99.9')
+            FROM generate_series(%(start_datetime)s, %(end_datetime)s - INTERVAL '1 seconds', INTERVAL '%(data_interval)s seconds') generated_time
+            JOIN wx_variable variable ON variable.id IN %(variable_ids)s
+            LEFT JOIN processed_data ON datetime = generated_time AND variable.id = variable_id
+            ORDER BY generated_time, variable.id
+        '''
+    elif source == 'hourly_summary':
+        query = f'''
+            WITH processed_data AS (
+                SELECT datetime ,var.id as variable_id
+                ,{summary_value}
+                FROM hourly_summary data
+                JOIN wx_variable var ON data.variable_id = var.id AND var.id IN %(variable_ids)s
+                WHERE data.datetime >= %(start_datetime)s
+                AND data.datetime < %(end_datetime)s
+                AND data.station_id = %(station_id)s
+            )
+            SELECT (generated_time + interval '%(utc_offset)s minutes') at time zone 'utc' as datetime
+                ,variable.id
+                ,COALESCE(value, '-99.9')
+            FROM generate_series(%(start_datetime)s, %(end_datetime)s - INTERVAL '1 seconds' , INTERVAL '1 hours') generated_time
+            JOIN wx_variable variable ON variable.id IN %(variable_ids)s
+            LEFT JOIN processed_data ON datetime = generated_time AND variable.id = variable_id
+            ORDER BY generated_time, variable.id
+        '''
+    elif source == 'daily_summary':
+        query = f'''
+            WITH processed_data AS (
+                SELECT day ,var.id as variable_id
+                ,{summary_value}
+                FROM daily_summary data
+                JOIN wx_variable var ON data.variable_id = var.id AND var.id IN %(variable_ids)s
+                WHERE data.day >= %(start_datetime)s
+                AND data.day < %(end_datetime)s
+                AND data.station_id = %(station_id)s
+            )
+            SELECT (generated_time) as datetime
+                ,variable.id
+                ,COALESCE(value, '-99.9')
+            FROM generate_series(%(start_datetime)s, %(end_datetime)s - INTERVAL '1 seconds', INTERVAL '1 days') generated_time
+            JOIN wx_variable variable ON variable.id IN %(variable_ids)s
+            LEFT JOIN processed_data ON day = generated_time AND variable.id = variable_id
+            ORDER BY generated_time, variable.id
+        '''
+    else:
+        # Periods only partly inside the range are exported as missing
+        period = 'month' if source == 'monthly_summary' else 'year'
+        query = f'''
+            WITH processed_data AS (
+                SELECT date ,var.id as variable_id
+                ,{summary_value}
+                FROM {source} data
+                JOIN wx_variable var ON data.variable_id = var.id AND var.id IN %(variable_ids)s
+                WHERE data.date >= %(start_datetime)s
+                AND data.date < %(end_datetime)s
+                AND data.station_id = %(station_id)s
+            )
+            SELECT (generated_time) as datetime
+                ,variable.id
+                ,COALESCE(value, '-99.9')
+            FROM generate_series(date_trunc('{period}', %(start_datetime)s::timestamp), %(end_datetime)s - INTERVAL '1 seconds', INTERVAL '1 {period}s') generated_time
+            JOIN wx_variable variable ON variable.id IN %(variable_ids)s
+            LEFT JOIN processed_data ON date = generated_time AND variable.id = variable_id
+            ORDER BY generated_time, variable.id
+        '''
+
+    return query, params
+
+def pivot_export_rows(rows, variable_ids):
+    """Pivot (datetime, variable_id, value) rows ordered by datetime into (datetime, [value per variable_ids]),
+    one time step at a time"""
+    positions = {variable_id: position for position, variable_id in enumerate(variable_ids)}
+    current_datetime, values = None, None
+    for row_datetime, variable_id, value in rows:
+        if values is None or row_datetime != current_datetime:
+            if values is not None:
+                yield current_datetime, values
+            current_datetime, values = row_datetime, [None] * len(positions)
+        values[positions[variable_id]] = value
+    if values is not None:
+        yield current_datetime, values
+
+def get_export_date_columns(source):
+    if source == 'daily_summary':
+        return ['Year', 'Month', 'Day'], ['%Y', '%m', '%d']
+    elif source == 'monthly_summary':
+        return ['Year', 'Month'], ['%Y', '%m']
+    elif source == 'yearly_summary':
+        return ['Year'], ['%Y']
+    return ['Year', 'Month', 'Day', 'Time'], ['%Y', '%m', '%d', '%H:%M:%S']
+
+def iter_export_data(source, station, variable_ids, start_datetime, end_datetime, data_interval, name, conn=None):
+    """Pivoted time steps of an export read through a server-side cursor, so memory does not grow with the range.
+    A given connection (see open_export_stream_connection) is used instead of a pooled one and closed at the end."""
+    try:
+        if not variable_ids:
+            return
+
+        query, params = get_export_query(source, station, tuple(variable_ids), start_datetime, end_datetime, data_interval)
+        with (conn or get_connection()) as query_conn:
+            with query_conn.cursor(name=name) as cursor:
+                cursor.itersize = EXPORT_CURSOR_ITERSIZE
+                cursor.execute(query, params)
+                yield from pivot_export_rows(cursor, variable_ids)
+    finally:
+        if conn is not None:
+            conn.close()
+
+# Session advisory lock of the streaming exports, one per slot of EXPORT_STREAM_MAX_CONCURRENT
+EXPORT_STREAM_LOCK_KEY = 7201
+
+def open_export_stream_connection():
+    """Dedicated connection of a streaming export, which may last as long as the client takes to read it, holding one
+    of the EXPORT_STREAM_MAX_CONCURRENT slots. None when all of them are taken."""
+    conn = psycopg2.connect(settings.SURFACE_CONNECTION_STRING,
+                            options=f'-c statement_timeout={settings.EXPORT_STREAM_STATEMENT_TIMEOUT * 1000} '
+                                    f'-c idle_in_transaction_session_timeout={settings.EXPORT_STREAM_IDLE_TIMEOUT * 1000}')
+    try:
+        # The slot is released with the session, also when the worker dies
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            for slot in range(settings.EXPORT_STREAM_MAX_CONCURRENT):
+                cursor.execute('SELECT pg_try_advisory_lock(%(key)s, %(slot)s)', {"key": EXPORT_STREAM_LOCK_KEY, "slot": slot})
+                if cursor.fetchone()[0]:
+                    conn.autocommit = False
+                    return conn
+    except Exception:
+        conn.close()
+        raise
+
+    conn.close()
+    return None
+
+# File extension and content type of each export format
+EXPORT_FORMATS = {
+    'csv': ('.csv', 'text/csv'),
+    'parquet': ('.parquet', 'application/vnd.apache.parquet'),
+    'netcdf': ('.nc', 'application/x-netcdf'),
+}
+
+# Export bundles archive the files of several stations
+EXPORT_FILE_TYPES = dict(EXPORT_FORMATS, zip=('.zip', 'application/zip'))
+
+# Time steps written at once to a Parquet row group or a NetCDF slice
+EXPORT_BATCH_SIZE = 10000
+
+# Exports are reused while the summary task queues show no change of their data
+EXPORT_CACHE_TIMEOUT = 7 * 24 * 60 * 60
+
+def get_export_file_path(file_id, file_format='csv'):
+    return f'{settings.EXPORTED_DATA_CELERY_PATH}{file_id}{EXPORT_FILE_TYPES[file_format][0]}'
+
+def get_export_cache_key(station_id, source, start_date, end_date, variable_ids, interval_in_seconds, file_format):
+    parameters = json.dumps([int(station_id), source, start_date, end_date, sorted(int(v) for v in variable_ids),
+                             interval_in_seconds, file_format])
+    return 'export_data_' + hashlib.sha256(parameters.encode()).hexdigest()
+
+def export_data_changed(station_id, source, start_date, end_date, exported_at):
+    """Whether the summary task queues have work for the station and period, pending or done after exported_at.
+    New raw data always queues hourly and daily tasks, and summaries are only recalculated by those tasks."""
+    start_datetime = datetime.strptime(start_date, '%Y-%m-%d %H:%M:%S')
+    end_datetime = datetime.strptime(end_date, '%Y-%m-%d %H:%M:%S')
+
+    # Monthly and yearly exports start at the beginning of the month or year
+    if source == 'monthly_summary':
+        start_datetime = start_datetime.replace(day=1)
+    elif source == 'yearly_summary':
+        start_datetime = start_datetime.replace(month=1, day=1)
+
+    # A day of margin covers the station utc offset
+    start_datetime = pytz.UTC.localize(start_datetime - timedelta(days=1))
+    end_datetime = pytz.UTC.localize(end_datetime + timedelta(days=1))
+
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute('''
+                SELECT EXISTS (
+                    SELECT 1
+                      FROM wx_hourlysummarytask
+                     WHERE station_id = %(station_id)s
+                       AND datetime BETWEEN %(start_datetime)s AND %(end_datetime)s
+                       AND (finished_at IS NULL OR finished_at > %(exported_at)s)
+                ) OR EXISTS (
+                    SELECT 1
+                      FROM wx_dailysummarytask
+                     WHERE station_id = %(station_id)s
+                       AND date BETWEEN %(start_date)s AND %(end_date)s
+                       AND (finished_at IS NULL OR finished_at > %(exported_at)s)
+                )
+            ''', {'station_id': station_id, 'start_datetime': start_datetime, 'end_datetime': end_datetime,
+                  'start_date': start_datetime.date(), 'end_date': end_datetime.date(), 'exported_at': exported_at})
+            return cursor.fetchone()[0]
+
+def get_cached_export(station_id, source, start_date, end_date, variable_ids, interval_in_seconds, file_format):
+    """Ready DataFile of a previous export with the same parameters, if its data did not change since"""
+    cache_key = get_export_cache_key(station_id, source, start_date, end_date, variable_ids, interval_in_seconds,
+                                     file_format)
+    file_id = cache.get(cache_key)
+    if file_id is None:
+        return None
+
+    datafile = DataFile.objects.filter(pk=file_id, ready=True).first()
+    if datafile is None or not os.path.exists(get_export_file_path(file_id, file_format)) or \
+            export_data_changed(station_id, source, start_date, end_date, datafile.created_at):
+        cache.delete(cache_key)
+        return None
+
+    logger.info(f'Export cache hit (file "{file_id}")')
+    return datafile
+
+def reuse_cached_export(datafile, station_id, source, start_date, end_date, variable_ids, file_format):
+    """Make datafile ready with the file of a previous export with the same parameters, if its data did not change
+    since. Each request keeps its own DataFile, hard linked to the same file, so deleting one leaves the others."""
+    cached_datafile = get_cached_export(station_id, source, start_date, end_date, variable_ids,
+                                        datafile.interval_in_seconds, file_format)
+    if cached_datafile is None:
+        return False
+
+    try:
+        os.link(get_export_file_path(cached_datafile.id, file_format), get_export_file_path(datafile.id, file_format))
+    except OSError as e:
+        # Deleted since it was checked
+        logger.warning(f'Could not reuse export file "{cached_datafile.id}". {repr(e)}')
+        return False
+
+    # Same metadata as the file content
+    datafile.ready = True
+    datafile.ready_at = cached_datafile.ready_at
+    datafile.lines = cached_datafile.lines
+    datafile.prepared_by = cached_datafile.prepared_by
+    datafile.save()
+    return True
+
+def get_export_variables(variable_ids):
+    return list(Variable.objects.filter(id__in=variable_ids).order_by('id')
+                .values('id', 'symbol', 'name', 'variable_type', 'unit__symbol'))
+
+def is_code_variable(variable):
+    return variable['variable_type'].lower() == 'code'
+
+def iter_export_batches(rows, batch_size=EXPORT_BATCH_SIZE):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def export_float_values(batch, position):
+    # Missing values (-99.9) become NaN in the typed formats
+    values = np.array([np.nan if values[position] is None else float(values[position]) for _, values in batch],
+                      dtype=np.float32)
+    values[values == np.float32(settings.MISSING_VALUE)] = np.nan
+    return values
+
+def export_code_values(batch, position):
+    return [None if values[position] in (None, str(settings.MISSING_VALUE)) else values[position] for _, values in batch]
+
+def export_times(batch, source, station):
+    # Raw data and hourly summaries are exported as UTC timestamps, the other sources as station local dates
+    if source in ('raw_data', 'hourly_summary'):
+        utc_offset = timedelta(minutes=station.utc_offset_minutes)
+        return [pytz.UTC.localize(row_datetime - utc_offset) for row_datetime, _ in batch]
+    return [row_datetime.date() for row_datetime, _ in batch]
+
+def write_export_parquet(filepath, rows, variables, source, station, metadata, progress):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if source in ('raw_data', 'hourly_summary'):
+        time_field = pa.field('datetime', pa.timestamp('s', tz='UTC'))
     else:
-        measured_source = '''
-            CASE WHEN var.sampling_operation_id in (1,2) THEN data.avg_value
-                 WHEN var.sampling_operation_id = 3      THEN data.min_value
-                 WHEN var.sampling_operation_id = 4      THEN data.max_value
-                 WHEN var.sampling_operation_id = 6      THEN data.sum_value
-            ELSE data.sum_value END as value '''
-        if source == 'hourly_summary':
-            datetime_variable = 'datetime'
-            date_source = f"(datetime + interval '{station.utc_offset_minutes} minutes') at time zone 'utc' as date"
-            data_source_description = 'Hourly summary'
-            converted_start_date = start_date_utc
-            converted_end_date = end_date_utc
-        elif source == 'daily_summary':
-            datetime_variable = 'day'
-            data_source_description = 'Daily summary'
-            date_source = "day::date"
-            converted_start_date = start_date_utc.astimezone(timezone_offset).date()
-            converted_end_date = end_date_utc.astimezone(timezone_offset).date()
-        elif source == 'monthly_summary':
-            measured_source = '''
-                CASE WHEN var.sampling_operation_id in (1,2) THEN data.avg_value::real
-                    WHEN var.sampling_operation_id = 3      THEN data.min_value
-                    WHEN var.sampling_operation_id = 4      THEN data.max_value
-                    WHEN var.sampling_operation_id = 6      THEN data.sum_value
-                ELSE data.sum_value END as value '''
-            datetime_variable = 'date'
-            date_source = "date::date"
-            data_source_description = 'Monthly summary'
-            converted_start_date = start_date_utc.astimezone(timezone_offset).date()
-            converted_end_date = end_date_utc.astimezone(timezone_offset).date()
-        elif source == 'yearly_summary':
-            measured_source = '''
-                CASE WHEN var.sampling_operation_id in (1,2) THEN data.avg_value::real
-                    WHEN var.sampling_operation_id = 3      THEN data.min_value
-                    WHEN var.sampling_operation_id = 4      THEN data.max_value
-                    WHEN var.sampling_operation_id = 6      THEN data.sum_value
-                ELSE data.sum_value END as value '''
-            datetime_variable = 'date'
-            date_source = "date::date"
-            data_source_description = 'Yearly summary'
-            converted_start_date = start_date_utc.astimezone(timezone_offset).date()
-            converted_end_date = end_date_utc.astimezone(timezone_offset).date()
+        time_field = pa.field('date', pa.date32())
+
+    fields = [time_field]
+    for variable in variables:
+        fields.append(pa.field(variable['symbol'], pa.string() if is_code_variable(variable) else pa.float32(),
+                               metadata={'name': variable['name'], 'units': variable['unit__symbol'] or ''}))
+    schema = pa.schema(fields, metadata={key: str(value) for key, value in metadata.items()})
 
+    lines = 0
+    writer = pq.ParquetWriter(filepath, schema, compression='zstd')
     try:
-        variable_dict = {}
-        variable_names_string = ''
-
-        with connection.cursor() as cursor_variable:
-            cursor_variable.execute(f'''
-                SELECT var.symbol
-                    ,var.id
-                    ,CASE WHEN unit.symbol IS NOT NULL THEN CONCAT(var.symbol, ' - ', var.name, ' (', unit.symbol, ')') 
-                        ELSE CONCAT(var.symbol, ' - ', var.name) END as var_name
-                FROM wx_variable var 
-                LEFT JOIN wx_unit unit ON var.unit_id = unit.id 
-                WHERE var.id IN %s
-                ORDER BY var.name
-            ''', (variable_ids,))
-
-            rows = cursor_variable.fetchall()
-            for row in rows:
-                variable_dict[row[1]] = row[0]
-                variable_names_string += f'{row[2]}   '
-
-        # Iterate over the start and end date day by day to split the queries
-        datetime_list = [converted_start_date]
-        current_datetime = converted_start_date
-        while current_datetime < converted_end_date and (current_datetime + timedelta(days=1)) < converted_end_date:
-            current_datetime = current_datetime + timedelta(days=1)
-            datetime_list.append(current_datetime)
-        datetime_list.append(converted_end_date)
-
-        query_result = []
-        for i in range(0, len(datetime_list) - 1):
-            current_start_datetime = datetime_list[i]
-            current_end_datetime = datetime_list[i + 1]
-
-            with connection.cursor() as cursor:
-                if source == 'raw_data':
-
-                    query_raw_data = '''
-                        WITH processed_data AS (
-                            SELECT datetime
-                                ,var.id as variable_id
-                                ,COALESCE(CASE WHEN var.variable_type ilike 'code' THEN data.code ELSE data.measured::varchar END, '-99.9') AS value
-                            FROM raw_data data
-                            JOIN wx_variable var ON data.variable_id = var.id AND var.id IN %(variable_ids)s
-                            WHERE data.datetime >= %(start_datetime)s
-                            AND data.datetime < %(end_datetime)s
-                            AND data.station_id = %(station_id)s
-                        )
-                        SELECT (generated_time + interval '%(utc_offset)s minutes') at time zone 'utc' as datetime
-                            ,variable.id
-                            ,COALESCE(value, '-99.9')
-                        FROM generate_series(%(start_datetime)s, %(end_datetime)s - INTERVAL '1 seconds', INTERVAL '%(data_interval)s seconds') generated_time
-                        JOIN wx_variable variable ON variable.id IN %(variable_ids)s
-                        LEFT JOIN processed_data ON datetime = generated_time AND variable.id = variable_id
-                    ''' 
-
-                    logging.info(query_raw_data, {'utc_offset': station.utc_offset_minutes, 'variable_ids': variable_ids,
-                          'start_datetime': current_start_datetime, 'end_datetime': current_end_datetime,
-                          'station_id': station_id, 'data_interval': current_datafile.interval_in_seconds})
-
-
-                    cursor.execute(query_raw_data, {'utc_offset': station.utc_offset_minutes, 'variable_ids': variable_ids,
-                          'start_datetime': current_start_datetime, 'end_datetime': current_end_datetime,
-                          'station_id': station_id, 'data_interval': current_datafile.interval_in_seconds})
-            
-
-
-                elif source == 'hourly_summary':
-
-                    query_hourly = '''
-                        WITH processed_data AS (
-                            SELECT datetime ,var.id as variable_id
-                            ,COALESCE(CASE WHEN var.sampling_operation_id in (1,2) THEN data.avg_value::real
-                            WHEN var.sampling_operation_id = 3      THEN data.min_value
-                            WHEN var.sampling_operation_id = 4      THEN data.max_value
-                            WHEN var.sampling_operation_id = 6      THEN data.sum_value
-                            ELSE data.sum_value END, '-99.9') as value  
-                            FROM hourly_summary data
-                            JOIN wx_variable var ON data.variable_id = var.id AND var.id IN %(variable_ids)s
-                            WHERE data.datetime >= %(start_datetime)s
-                            AND data.datetime < %(end_datetime)s
-                            AND data.station_id = %(station_id)s
-                        )
-                        SELECT (generated_time + interval '%(utc_offset)s minutes') at time zone 'utc' as datetime
-                            ,variable.id
-                            ,COALESCE(value, '-99.9')
-
-                        FROM generate_series(%(start_datetime)s, %(end_datetime)s - INTERVAL '1 seconds' , INTERVAL '1 hours') generated_time
-                        JOIN wx_variable variable ON variable.id IN %(variable_ids)s
-                        LEFT JOIN processed_data ON datetime = generated_time AND variable.id = variable_id
-                    '''
-                    
-                    logging.info(query_hourly,{'utc_offset': station.utc_offset_minutes, 'variable_ids': variable_ids,
-                          'start_datetime': current_start_datetime, 'end_datetime': current_end_datetime, 
-                          'station_id': station_id})
-
-                    cursor.execute(query_hourly,{'utc_offset': station.utc_offset_minutes, 'variable_ids': variable_ids,
-                          'start_datetime': current_start_datetime, 'end_datetime': current_end_datetime, 
-                          'station_id': station_id})
-                    
-                elif source == 'daily_summary':
-                    query_daily = '''
-                        WITH processed_data AS (
-                            SELECT day ,var.id as variable_id
-                            ,COALESCE(CASE WHEN var.sampling_operation_id in (1,2) THEN data.avg_value::real
-                            WHEN var.sampling_operation_id = 3      THEN data.min_value
-                            WHEN var.sampling_operation_id = 4      THEN data.max_value
-                            WHEN var.sampling_operation_id = 6      THEN data.sum_value
-                            ELSE data.sum_value END, '-99.9') as value  
-                            FROM daily_summary data
-                            JOIN wx_variable var ON data.variable_id = var.id AND var.id IN %(variable_ids)s
-                            WHERE data.day >= %(start_datetime)s
-                            AND data.day < %(end_datetime)s
-                            AND data.station_id = %(station_id)s
-                        )
-                        SELECT (generated_time) as datetime
-                            ,variable.id
-                            ,COALESCE(value, '-99.9')
-                        FROM generate_series(%(start_datetime)s, %(end_datetime)s - INTERVAL '1 seconds', INTERVAL '1 days') generated_time
-                        JOIN wx_variable variable ON variable.id IN %(variable_ids)s
-                        LEFT JOIN processed_data ON day = generated_time AND variable.id = variable_id
-                    '''
-
-                    logging.info(query_daily, {'variable_ids': variable_ids,
-                          'start_datetime': current_start_datetime, 'end_datetime': current_end_datetime,
-                          'station_id': station_id})
-
-                    cursor.execute(query_daily, {'variable_ids': variable_ids,
-                          'start_datetime': current_start_datetime, 'end_datetime': current_end_datetime,
-                          'station_id': station_id})
-                
-                elif source == 'monthly_summary':
-                    query_monthly = '''
-                        WITH processed_data AS (
-                            SELECT date ,var.id as variable_id
-                            ,COALESCE(CASE WHEN var.sampling_operation_id in (1,2) THEN data.avg_value::real
-                            WHEN var.sampling_operation_id = 3      THEN data.min_value
-                            WHEN var.sampling_operation_id = 4      THEN data.max_value
-                            WHEN var.sampling_operation_id = 6      THEN data.sum_value
-                            ELSE data.sum_value END, '-99.9') as value  
-                            FROM monthly_summary data
-                            JOIN wx_variable var ON data.variable_id = var.id AND var.id IN %(variable_ids)s
-                            WHERE data.date >= %(start_datetime)s
-                            AND data.date < %(end_datetime)s
-                            AND data.station_id = %(station_id)s
-                        )
-                        SELECT (generated_time) as datetime
-                            ,variable.id
-                            ,COALESCE(value, '-99.9')
-                        FROM generate_series(%(start_datetime)s, %(end_datetime)s, INTERVAL '1 months') generated_time
-                        JOIN wx_variable variable ON variable.id IN %(variable_ids)s
-                        LEFT JOIN processed_data ON date = generated_time AND variable.id = variable_id
-                        '''
-                    
-                    logging.info(query_monthly, {'variable_ids': variable_ids,
-                          'start_datetime': current_start_datetime, 'end_datetime': current_end_datetime,
-                          'station_id': station_id})
-
-                    cursor.execute(query_monthly, {'variable_ids': variable_ids,
-                          'start_datetime': current_start_datetime, 'end_datetime': current_end_datetime,
-                          'station_id': station_id})
-
-                elif source == 'yearly_summary':
-                    query_yearly = '''
-                        WITH processed_data AS (
-                            SELECT date ,var.id as variable_id
-                            ,COALESCE(CASE WHEN var.sampling_operation_id in (1,2) THEN data.avg_value::real
-                            WHEN var.sampling_operation_id = 3      THEN data.min_value
-                            WHEN var.sampling_operation_id = 4      THEN data.max_value
-                            WHEN var.sampling_operation_id = 6      THEN data.sum_value
-                            ELSE data.sum_value END, '-99.9') as value  
-                            FROM yearly_summary data
-                            JOIN wx_variable var ON data.variable_id = var.id AND var.id IN %(variable_ids)s
-                            WHERE data.date >= %(start_datetime)s
-                            AND data.date < %(end_datetime)s
-                            AND data.station_id = %(station_id)s
-                        )
-                        SELECT (generated_time) as datetime
-                            ,variable.id
-                            ,COALESCE(value, '-99.9')
-                        FROM generate_series(%(start_datetime)s, %(end_datetime)s, INTERVAL '1 years') generated_time
-                        JOIN wx_variable variable ON variable.id IN %(variable_ids)s
-                        LEFT JOIN processed_data ON date = generated_time AND variable.id = variable_id
-                        ''' 
-
-                    logging.info(query_yearly, {'variable_ids': variable_ids,
-                          'start_datetime': current_start_datetime, 'end_datetime': current_end_datetime,
-                          'station_id': station_id})
-
-                    cursor.execute(query_yearly, {'variable_ids': variable_ids,
-                          'start_datetime': current_start_datetime, 'end_datetime': current_end_datetime,
-                          'station_id': station_id})
-                query_result = query_result + cursor.fetchall()
-
-
-
-        filepath = f'{settings.EXPORTED_DATA_CELERY_PATH}{file_id}.csv'
-        date_of_completion = datetime.utcnow()
-
-        with open(filepath, 'w') as f: 
-            start_date_header = start_date_utc.astimezone(timezone_offset).strftime('%Y-%m-%d %H:%M:%S')
-            end_date_header = end_date_utc.astimezone(timezone_offset).strftime('%Y-%m-%d %H:%M:%S')
+        for batch in iter_export_batches(rows):
+            arrays = [pa.array(export_times(batch, source, station), type=time_field.type)]
+            for position, variable in enumerate(variables):
+                if is_code_variable(variable):
+                    arrays.append(pa.array(export_code_values(batch, position), type=pa.string()))
+                else:
+                    arrays.append(pa.array(export_float_values(batch, position), type=pa.float32(), from_pandas=True))
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+
+            lines += len(batch)
+            progress(lines)
+    finally:
+        writer.close()
+
+    return lines
+
+def get_netcdf_variable_name(symbol):
+    name = re.sub('[^A-Za-z0-9_]', '_', symbol)
+    return name if name[:1].isalpha() else f'v_{name}'
+
+def write_export_netcdf(filepath, rows, variables, source, station, metadata, progress):
+    """CF-1.8 single station time series, the data variables compressed and indexed by an unlimited time dimension"""
+    import netCDF4
+
+    with netCDF4.Dataset(filepath, 'w', format='NETCDF4') as dataset:
+        dataset.Conventions = 'CF-1.8'
+        dataset.featureType = 'timeSeries'
+        dataset.title = f'{station.code} - {station.name}'
+        for key, value in metadata.items():
+            setattr(dataset, key, str(value))
+
+        station_name = f'{station.code}'.encode('utf-8')
+        dataset.createDimension('name_strlen', max(len(station_name), 1))
+        dataset.createDimension('time', None)
+
+        station_variable = dataset.createVariable('station_name', 'S1', ('name_strlen',))
+        station_variable.long_name = 'station name'
+        station_variable.cf_role = 'timeseries_id'
+        station_variable[:] = netCDF4.stringtochar(np.array(station_name, f'S{max(len(station_name), 1)}'))
+
+        for name, standard_name, units, value in (('lat', 'latitude', 'degrees_north', station.latitude),
+                                                  ('lon', 'longitude', 'degrees_east', station.longitude)):
+            coordinate = dataset.createVariable(name, 'f8')
+            coordinate.standard_name = standard_name
+            coordinate.units = units
+            coordinate.assignValue(value)
+
+        time_variable = dataset.createVariable('time', 'f8', ('time',))
+        time_variable.standard_name = 'time'
+        time_variable.calendar = 'standard'
+        time_variable.axis = 'T'
+        if source in ('raw_data', 'hourly_summary'):
+            time_variable.units = 'seconds since 1970-01-01 00:00:00 UTC'
+        else:
+            time_variable.units = 'days since 1970-01-01'
+
+        data_variables = []
+        for variable in variables:
+            name = get_netcdf_variable_name(variable['symbol'])
+            if is_code_variable(variable):
+                data_variable = dataset.createVariable(name, str, ('time',))
+            else:
+                data_variable = dataset.createVariable(name, 'f4', ('time',), zlib=True, complevel=4,
+                                                       fill_value=np.float32(settings.MISSING_VALUE))
+                if variable['unit__symbol']:
+                    data_variable.units = variable['unit__symbol']
+            data_variable.long_name = variable['name']
+            data_variable.coordinates = 'time lat lon station_name'
+            data_variables.append(data_variable)
+
+        lines = 0
+        epoch = datetime(1970, 1, 1, tzinfo=pytz.UTC)
+        for batch in iter_export_batches(rows):
+            times = export_times(batch, source, station)
+            if source in ('raw_data', 'hourly_summary'):
+                time_variable[lines:lines + len(batch)] = [(time_value - epoch).total_seconds() for time_value in times]
+            else:
+                time_variable[lines:lines + len(batch)] = [(time_value - epoch.date()).days for time_value in times]
+
+            for position, (variable, data_variable) in enumerate(zip(variables, data_variables)):
+                if is_code_variable(variable):
+                    data_variable[lines:lines + len(batch)] = np.array(
+                        ['' if value is None else value for value in export_code_values(batch, position)], dtype=object)
+                else:
+                    data_variable[lines:lines + len(batch)] = np.ma.masked_invalid(export_float_values(batch, position))
+
+            lines += len(batch)
+            progress(lines)
 
+    return lines
+
+def get_export_range(source, start_date, end_date):
+    """Start and end of the export query: datetimes for raw data and hourly summaries, local dates otherwise"""
+    start_date_utc = pytz.UTC.localize(datetime.strptime(start_date, '%Y-%m-%d %H:%M:%S'))
+    end_date_utc = pytz.UTC.localize(datetime.strptime(end_date, '%Y-%m-%d %H:%M:%S'))
+    if source in ('raw_data', 'hourly_summary'):
+        return start_date_utc, end_date_utc
+
+    timezone_offset = pytz.timezone(settings.TIMEZONE_NAME)
+    return start_date_utc.astimezone(timezone_offset).date(), end_date_utc.astimezone(timezone_offset).date()
+
+def estimate_export_rows(source, start_date, end_date, interval_in_seconds):
+    """Upper bound of the time steps (lines) of an export"""
+    seconds = (datetime.strptime(end_date, '%Y-%m-%d %H:%M:%S') -
+               datetime.strptime(start_date, '%Y-%m-%d %H:%M:%S')).total_seconds()
+    step = {
+        'raw_data': interval_in_seconds or 300,
+        'hourly_summary': 60 * 60,
+        'daily_summary': 24 * 60 * 60,
+        'monthly_summary': 28 * 24 * 60 * 60,
+        'yearly_summary': 365 * 24 * 60 * 60,
+    }[source]
+    return int(max(seconds, 0) // step) + 1
+
+def write_export_file(station, source, start_date, end_date, variable_ids, filepath, file_format, interval_in_seconds,
+                      prepared_by, progress, cursor_name):
+    """Export the data of a station to filepath, calling progress with the number of lines written so far.
+    Returns the number of lines and the date of completion."""
+    timezone_offset = pytz.timezone(settings.TIMEZONE_NAME)
+    start_date_utc = pytz.UTC.localize(datetime.strptime(start_date, '%Y-%m-%d %H:%M:%S'))
+    end_date_utc = pytz.UTC.localize(datetime.strptime(end_date, '%Y-%m-%d %H:%M:%S'))
+    converted_start_date, converted_end_date = get_export_range(source, start_date, end_date)
+
+    variable_ids = tuple(variable_ids)
+
+    # The values themselves come from get_export_query
+    data_source_description = {
+        'raw_data': 'Raw data',
+        'hourly_summary': 'Hourly summary',
+        'daily_summary': 'Daily summary',
+        'monthly_summary': 'Monthly summary',
+        'yearly_summary': 'Yearly summary',
+    }[source]
+
+    variable_dict = {}
+    variable_names_string = ''
+
+    with connection.cursor() as cursor_variable:
+        cursor_variable.execute(f'''
+            SELECT var.symbol
+                ,var.id
+                ,CASE WHEN unit.symbol IS NOT NULL THEN CONCAT(var.symbol, ' - ', var.name, ' (', unit.symbol, ')') 
+                    ELSE CONCAT(var.symbol, ' - ', var.name) END as var_name
+            FROM wx_variable var 
+            LEFT JOIN wx_unit unit ON var.unit_id = unit.id 
+            WHERE var.id IN %s
+            ORDER BY var.name
+        ''', (variable_ids,))
+
+        rows = cursor_variable.fetchall()
+        for row in rows:
+            variable_dict[row[1]] = row[0]
+            variable_names_string += f'{row[2]}   '
+
+    # Variable columns follow the variable ids, as the pivot of the whole result used to
+    export_variable_ids = sorted(variable_dict)
+    date_columns, date_formats = get_export_date_columns(source)
+
+    date_of_completion = datetime.utcnow()
+    start_date_header = start_date_utc.astimezone(timezone_offset).strftime('%Y-%m-%d %H:%M:%S')
+    end_date_header = end_date_utc.astimezone(timezone_offset).strftime('%Y-%m-%d %H:%M:%S')
+
+    rows = iter_export_data(source, station, export_variable_ids, converted_start_date, converted_end_date,
+                            interval_in_seconds, cursor_name)
+
+    if file_format in ('parquet', 'netcdf'):
+        metadata = {
+            'station': f'{station.code} - {station.name}',
+            'data_source': data_source_description,
+            'latitude': station.latitude,
+            'longitude': station.longitude,
+            'utc_offset_minutes': station.utc_offset_minutes,
+            'date_of_completion': date_of_completion.strftime("%Y-%m-%d %H:%M:%S"),
+            'prepared_by': prepared_by,
+            'start_date': start_date_header,
+            'end_date': end_date_header,
+        }
+        write_export = write_export_parquet if file_format == 'parquet' else write_export_netcdf
+        lines = write_export(filepath, rows, get_export_variables(export_variable_ids), source, station, metadata,
+                             progress)
+    else:
+        lines = 0
+        with open(filepath, 'w', newline='') as f:
             f.write(f'Station:,{station.code} - {station.name}\n')
             f.write(f'Data source:,{data_source_description}\n')
             f.write(f'Description:,{variable_names_string}\n')
             f.write(f'Latitude:,{station.latitude}\n')
             f.write(f'Longitude:,{station.longitude}\n')
             f.write(f'Date of completion:,{date_of_completion.strftime("%Y-%m-%d %H:%M:%S")}\n')
-            f.write(f'Prepared by:,{current_datafile.prepared_by}\n')
+            f.write(f'Prepared by:,{prepared_by}\n')
             f.write(f'Start date:,{start_date_header},End date:,{end_date_header}\n\n')
 
+            writer = csv.writer(f, lineterminator='\n')
+            for row_datetime, values in rows:
+                if lines == 0:
+                    writer.writerow(date_columns + [variable_dict[variable_id] for variable_id in export_variable_ids])
 
-        lines = 0
-        if query_result:
-            df = pandas.DataFrame(data=query_result).pivot(index=0, columns=1)
-            df.rename(columns=variable_dict, inplace=True)
-            df.columns = df.columns.droplevel(0)
-            if source == 'daily_summary':
-                df['Year'] = df.index.map(lambda x: x.strftime('%Y'))
-                df['Month'] = df.index.map(lambda x: x.strftime('%m'))
-                df['Day'] = df.index.map(lambda x: x.strftime('%d'))
-                cols = df.columns.tolist()
-                cols = cols[-3:] + cols[:-3]
-                df = df[cols]
-                df = df.drop_duplicates(subset=['Day', 'Month', 'Year'], keep='first')
-            elif source == 'monthly_summary':                
-                df['Year'] = df.index.map(lambda x: x.strftime('%Y'))
-                df['Month'] = df.index.map(lambda x: x.strftime('%m'))
-                cols = df.columns.tolist()
-                cols = cols[-2:] + cols[:-2]
-                df = df[cols]
-                df = df.drop_duplicates(subset=['Month', 'Year'], keep='first')
-            elif source == 'yearly_summary':
-                df['Year'] = df.index.map(lambda x: x.strftime('%Y'))
-                cols = df.columns.tolist()
-                cols = cols[-1:] + cols[:-1]
-                df = df[cols]
-                df = df.drop_duplicates(subset=['Year'], keep='first')
-            else:
-                df['Year'] = df.index.map(lambda x: x.strftime('%Y'))
-                df['Month'] = df.index.map(lambda x: x.strftime('%m'))
-                df['Day'] = df.index.map(lambda x: x.strftime('%d'))
-                df['Time'] = df.index.map(lambda x: x.strftime('%H:%M:%S'))
-                cols = df.columns.tolist()
-                cols = cols[-4:] + cols[:-4]
-                df = df[cols]
-            df.to_csv(filepath, index=False, mode='a', header=True)
-            lines = len(df.index)
+                writer.writerow([row_datetime.strftime(date_format) for date_format in date_formats] + values)
+                lines += 1
+
+                if lines % EXPORT_PROGRESS_LINES == 0:
+                    f.flush()
+                    progress(lines)
+
+    return lines, date_of_completion
+
+@shared_task
+def export_data(station_id, source, start_date, end_date, variable_ids, file_id, file_format='csv'):
+    logger.info(f'Exporting data (file "{file_id}")')
+
+    station = Station.objects.get(pk=station_id)
+    current_datafile = DataFile.objects.get(pk=file_id)
+
+    def progress(lines):
+        DataFile.objects.filter(pk=file_id).update(lines=lines)
+
+    try:
+        lines, date_of_completion = write_export_file(station, source, start_date, end_date, variable_ids,
+                                                      get_export_file_path(file_id, file_format), file_format,
+                                                      current_datafile.interval_in_seconds,
+                                                      current_datafile.prepared_by, progress, f'export_data_{file_id}')
 
         current_datafile.ready = True
         current_datafile.ready_at = date_of_completion
@@ -1149,6 +1501,9 @@ def export_data(station_id, source, start_date, end_date, variable_ids, file_id)
         current_datafile.save()
         logger.info(f'Data exported successfully (file "{file_id}")')
 
+        cache.set(get_export_cache_key(station_id, source, start_date, end_date, variable_ids,
+                                       current_datafile.interval_in_seconds, file_format), file_id, EXPORT_CACHE_TIMEOUT)
+
 
     except Exception as e:
         current_datafile.ready = False
@@ -1157,6 +1512,96 @@ def export_data(station_id, source, start_date, end_date, variable_ids, file_id)
         current_datafile.save()
         logger.error(f'Error on export data file "{file_id}". {repr(e)}')
 
+def get_export_bundle_parts_path(file_id):
+    return f'{settings.EXPORTED_DATA_CELERY_PATH}{file_id}_parts/'
+
+def schedule_export_bundle(station_ids, source, start_date, end_date, variable_ids, file_id, file_format):
+    """Export each station in its own task and archive them in a single file. The station tasks are routed to the
+    EXPORT_BUNDLE_QUEUE, whose worker runs at most EXPORT_BUNDLE_CONCURRENCY of them at the same time."""
+    chord(export_bundle_station.s(station_id, source, start_date, end_date, variable_ids, file_id, file_format)
+          for station_id in station_ids)(finish_export_bundle.s(file_id, file_format).on_error(fail_export_bundle.s(file_id)))
+
+@shared_task(ignore_result=False)
+def export_bundle_station(station_id, source, start_date, end_date, variable_ids, file_id, file_format):
+    # Returns the manifest entry of the station, errors included, so a station never fails the whole bundle
+    entry = {'station_id': station_id, 'station_code': str(station_id), 'station_name': None,
+             'latitude': None, 'longitude': None, 'file': None, 'lines': 0}
+    written_lines = [0]
+
+    def progress(lines):
+        # Lines of the bundle are the sum of the lines of its stations
+        DataFile.objects.filter(pk=file_id).update(lines=F('lines') + lines - written_lines[0])
+        written_lines[0] = lines
+
+    try:
+        bundle_datafile = DataFile.objects.get(pk=file_id)
+        parts_path = get_export_bundle_parts_path(file_id)
+        os.makedirs(parts_path, exist_ok=True)
+
+        station = Station.objects.get(pk=station_id)
+        file_name = f'{station.code}{EXPORT_FORMATS[file_format][0]}'
+        entry.update({'station_code': station.code, 'station_name': station.name,
+                      'latitude': station.latitude, 'longitude': station.longitude})
+
+        lines, _ = write_export_file(station, source, start_date, end_date, variable_ids,
+                                     os.path.join(parts_path, file_name), file_format,
+                                     bundle_datafile.interval_in_seconds, bundle_datafile.prepared_by, progress,
+                                     f'export_bundle_{file_id}_{station_id}')
+        progress(lines)
+        entry.update({'file': file_name, 'lines': lines, 'status': 'ready'})
+    except Exception as e:
+        logger.error(f'Error on export bundle "{file_id}" station "{station_id}". {repr(e)}')
+        entry.update({'status': 'error', 'error': repr(e)})
+
+    return entry
+
+@shared_task
+def finish_export_bundle(entries, file_id, file_format):
+    bundle_datafile = DataFile.objects.get(pk=file_id)
+    parts_path = get_export_bundle_parts_path(file_id)
+    entries = sorted(entries, key=lambda entry: entry['station_code'])
+
+    manifest = {
+        'source': bundle_datafile.source,
+        'format': file_format,
+        'initial_date': bundle_datafile.initial_date.isoformat(),
+        'final_date': bundle_datafile.final_date.isoformat(),
+        'variables': list(DataFileVariable.objects.filter(datafile_id=file_id)
+                          .values_list('variable__symbol', flat=True)),
+        'prepared_by': bundle_datafile.prepared_by,
+        'date_of_completion': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
+        'stations': entries,
+    }
+
+    try:
+        # Parquet and NetCDF files are already compressed
+        compress_type = zipfile.ZIP_DEFLATED if file_format == 'csv' else zipfile.ZIP_STORED
+        with zipfile.ZipFile(get_export_file_path(file_id, 'zip'), 'w', compression=compress_type) as archive:
+            for entry in entries:
+                if entry['file']:
+                    archive.write(os.path.join(parts_path, entry['file']), entry['file'])
+            archive.writestr('manifest.json', json.dumps(manifest, indent=2, default=str),
+                             compress_type=zipfile.ZIP_DEFLATED)
+
+        bundle_datafile.ready = any(entry['status'] == 'ready' for entry in entries)
+        logger.info(f'Export bundle "{file_id}" finished with #{len(entries)} stations.')
+    except Exception as e:
+        bundle_datafile.ready = False
+        logger.error(f'Error on export bundle "{file_id}". {repr(e)}')
+    finally:
+        shutil.rmtree(parts_path, ignore_errors=True)
+
+    bundle_datafile.ready_at = datetime.utcnow()
+    bundle_datafile.lines = sum(entry['lines'] for entry in entries)
+    bundle_datafile.save()
+
+@shared_task
+def fail_export_bundle(request, exc, traceback, file_id):
+    # Error callback of the bundle chord: a station task or finish_export_bundle itself failed
+    logger.error(f'Error on export bundle "{file_id}". {repr(exc)}')
+    shutil.rmtree(get_export_bundle_parts_path(file_id), ignore_errors=True)
+    DataFile.objects.filter(pk=file_id).update(ready=False, ready_at=datetime.utcnow())
+
 @shared_task
 def ftp_ingest_historical_station_files():
     hist_data = True
@@ -1343,60 +1788,44 @@ def process_station_data_files(historical_data=False, highfrequency_data=False,
             station_data_file.save()
 
 # Persist Logic Starts here
-# Get hourly data from raw data
-def get_hourly_raw_data(start_datetime, end_datetime, station_ids):
-    con = get_connection()
-    sql = '''SELECT *
+# Needed columns of every series of the given periods, including the persistence window before each period
+def get_persist_raw_data(periods, max_window):
+    sql = '''SELECT station_id, variable_id, datetime, measured,
+                    qc_persist_quality_flag, qc_persist_description,
+                    qc_range_quality_flag, qc_step_quality_flag
              FROM raw_data
              WHERE datetime BETWEEN %(start_datetime)s AND %(end_datetime)s
                AND station_id IN %(station_ids)s
-               -- AND qc_persist_quality_flag IS NULL
-             ORDER BY datetime DESC
+               AND EXISTS (SELECT 1
+                             FROM unnest(%(period_station_ids)s::integer[],
+                                         %(period_starts)s::timestamptz[],
+                                         %(period_ends)s::timestamptz[]) AS period(station_id, start_datetime, end_datetime)
+                            WHERE period.station_id = raw_data.station_id
+                              AND raw_data.datetime BETWEEN period.start_datetime - %(max_window)s * INTERVAL '1 second'
+                                                        AND period.end_datetime)
+             ORDER BY station_id, variable_id, datetime
           '''
-    params = {"station_ids": tuple(station_ids), "start_datetime": start_datetime, "end_datetime": end_datetime}
-    
+    period_station_ids, period_starts, period_ends = [], [], []
+    for start_datetime, end_datetime, station_ids in periods:
+        for station_id in station_ids:
+            period_station_ids.append(station_id)
+            period_starts.append(start_datetime)
+            period_ends.append(end_datetime)
 
-    sql_query = pd.read_sql_query(sql=sql, con=con, params=params)
-    con.close()
-
-    df = pd.DataFrame(sql_query)
-    return df
-
-# Station and variables used
-def get_hourly_sv_dict(start_datetime, end_datetime, station_ids):
-    df = get_hourly_raw_data(start_datetime, end_datetime, station_ids)
-
-    dict_sv = {}
-    for station_id in station_ids:
-        variable_ids = df[df['station_id']==station_id].variable_id.unique()
-        dict_v = {}
-        for variable_id in variable_ids:
-            s_datetime = df[(df['station_id']==station_id) & (df['variable_id']==variable_id)].datetime.min()
-            e_datetime = df[(df['station_id']==station_id) & (df['variable_id']==variable_id)].datetime.max()
-            dict_v[variable_id] = (s_datetime, e_datetime)
-        dict_sv[station_id] = dict_v
-    return dict_sv
-
-# Get data from each statation and variable with window interval
-def get_hourly_sv_data(start_datetime, end_datetime, station_id, variable_id, window):
-    con = get_connection()
-    sql = '''SELECT *
-             FROM raw_data
-             WHERE (datetime BETWEEN %(start_datetime)s AND %(end_datetime)s)
-               AND station_id = %(station_id)s
-               AND variable_id = %(variable_id)s
-          '''
-    params = {"station_id": station_id, "variable_id": int(variable_id), "start_datetime": start_datetime-timedelta(seconds=window), "end_datetime": end_datetime}
-
-    sql_query = pd.read_sql_query(sql=sql, con=con, params=params)
-    con.close()
+    params = {
+        "start_datetime": min(period_starts) - timedelta(seconds=max_window),
+        "end_datetime": max(period_ends),
+        "station_ids": tuple(set(period_station_ids)),
+        "period_station_ids": period_station_ids,
+        "period_starts": period_starts,
+        "period_ends": period_ends,
+        "max_window": max_window,
+    }
 
-    df = pd.DataFrame(sql_query)
+    with get_connection() as con:
+        df = pd.read_sql_query(sql=sql, con=con, params=params)
 
-    if not df.empty:
-        mask = df.datetime.between(start_datetime, end_datetime)
-        df['updated'] = False
-        df.loc[mask, 'updated'] = True
+    df['datetime'] = pd.to_datetime(df['datetime'], utc=True)
     return df
 
 def most_frequent(List):
@@ -1409,23 +1838,23 @@ def get_interval(df):
     interval = most_frequent(interval_list)
     return abs(interval)
 
-# Window
-def get_window(station_id, variable_id):
-    try:
-        _station = Station.objects.get(id=station_id)
-        _variable = Variable.objects.get(id=variable_id) 
-    except ObjectDoesNotExist:
-        return 3600
-        
-    if  _station.is_automatic:
-        hours = _variable.persistence_window_hourly
-        if hours is None:
-            hours = 1 # 1 Hour
-    else:
-        hours = _variable.persistence_window
-        if hours is None:
-            hours = 96 # 4 Days
-    return hours*3600
+# Window of every (station, variable) of the given stations, in seconds
+def get_persist_windows(station_ids):
+    stations = dict(Station.objects.filter(id__in=station_ids).values_list('id', 'is_automatic'))
+
+    windows = {}
+    for variable_id, window_hourly, window in Variable.objects.values_list('id', 'persistence_window_hourly', 'persistence_window'):
+        for station_id, is_automatic in stations.items():
+            if is_automatic:
+                hours = window_hourly
+                if hours is None:
+                    hours = 1 # 1 Hour
+            else:
+                hours = window
+                if hours is None:
+                    hours = 96 # 4 Days
+            windows[(station_id, variable_id)] = hours*3600
+    return windows
 
 # Thresholds
 def get_thresholds(station_id, variable_id, interval, window):
@@ -1433,45 +1862,8 @@ def get_thresholds(station_id, variable_id, interval, window):
     if window == 0 or interval==0:
         return thresholds
 
-    try:
-        # Trying to set persist thresholds using current station
-        _persist = QcPersistThreshold.objects.get(station_id=station_id, variable_id=variable_id, interval=interval, window=window)
-        thresholds['persist_min'] = _persist.minimum_variance
-        thresholds['persist_des'] = 'Custom station Threshold'
-    except ObjectDoesNotExist:
-        try:
-            # Trying to set persist thresholds using current station with NULL intervall
-            _range = QcPersistThreshold.objects.get(station_id=station_id, variable_id=variable_id, interval__isnull=True, window=window)        
-            thresholds['persist_min'] = _persist.minimum_variance
-            thresholds['persist_des'] = 'Custom station Threshold'
-        except ObjectDoesNotExist:
-            try:
-                # Trying to set persist thresholds using current station
-                _station = Station.objects.get(pk=station_id)
-                _persist = QcPersistThreshold.objects.get(station_id=_station.reference_station_id, variable_id=variable_id, interval=interval, window=window)
-                thresholds['persist_min'] = _persist.minimum_variance
-                thresholds['persist_des'] = 'Reference station threshold'
-            except ObjectDoesNotExist:
-                try:
-                    # Trying to set persist thresholds using current station with NULL intervall
-                    _station = Station.objects.get(pk=station_id)
-                    _persist = QcPersistThreshold.objects.get(station_id=_station.reference_station_id, variable_id=variable_id, interval__isnull=True, window=window)        
-                    thresholds['persist_min'] = _persist.minimum_variance
-                    thresholds['persist_des'] = 'Reference station threshold'
-                except ObjectDoesNotExist:
-                    try:
-                        # Trying to set persistence thresholds using global ranges
-                        _station = Station.objects.get(pk=station_id)
-                        _persist = Variable.objects.get(pk=variable_id)
-                        if _station.is_automatic:
-                            thresholds['persist_min'] = _persist.persistence_hourly
-                            thresholds['persist_des'] = 'Global threshold (Automatic)'
-                        else:
-                            thresholds['persist_min'] = _persist.persistence
-                            thresholds['persist_des'] = 'Global threshold (Manual)'
-                    except ObjectDoesNotExist:
-                        pass;                    
-    return thresholds
+    # Custom station -> custom station with NULL interval -> reference station -> global thresholds, resolved in memory
+    return get_persist_thresholds(thresholds, station_id, variable_id, interval, window)
 
 # Persistance function and calculation
 def persit_function(values):
@@ -1549,48 +1941,195 @@ def set_persist(row, df, s_datetime, e_datetime, interval, window, thresholds):
 
     return updated, persist_flag, persist_des, final_flag
 
+def rolling_window_max(values, datetimes, window):
+    # Max of values over [datetime-window, datetime], datetimes sorted ascending, O(n) with pandas time based rolling
+    if window <= 0:
+        return values.astype('float64')
+    series = pd.Series(values, index=datetimes, dtype='float64')
+    return series.rolling(pd.Timedelta(seconds=window), closed='both').max().to_numpy()
+
+def rolling_window_min(values, datetimes, window):
+    return -rolling_window_max(-values, datetimes, window)
+
+def persist_flags(df, s_datetime, e_datetime, window, thresholds):
+    """Same flags as applying set_persist row by row, with time based rolling windows instead of one
+    scan of the whole series per row"""
+    df = df.sort_values(by='datetime').reset_index(drop=True)
+    datetimes = pd.DatetimeIndex(df['datetime'])
+    in_range = ((datetimes >= s_datetime) & (datetimes <= e_datetime))
+
+    original_flag = df['qc_persist_quality_flag'].astype(object)
+
+    # Persistence of the rows being updated: max-min of the measurements in [datetime-window, datetime]
+    p_min = thresholds.get('persist_min')
+    if p_min is None:
+        persist_flag = np.full(len(df), NOT_CHECKED, dtype=object)
+        persist_des = np.full(len(df), "Threshold not found", dtype=object)
+    else:
+        measured = df['measured'].to_numpy(dtype='float64')
+        persist = np.abs(rolling_window_max(measured, datetimes, window) - rolling_window_min(measured, datetimes, window))
+        persist_flag = np.where(persist >= p_min, GOOD, BAD).astype(object)
+        persist_des = np.full(len(df), thresholds['persist_des'], dtype=object)
+
+    persist_flag = np.where(in_range, persist_flag, original_flag.to_numpy())
+    persist_des = np.where(in_range, persist_des, df['qc_persist_description'].astype(object).to_numpy())
+
+    # Suspicious: a stored BAD persistence flag in [datetime, datetime+window], the reversed series turns
+    # that forward window into a backward one
+    is_bad = original_flag.eq(BAD).to_numpy(dtype='float64')
+    reversed_datetimes = pd.DatetimeIndex(datetimes.max() - datetimes[::-1] + pd.Timestamp(0))
+    bad_ahead = rolling_window_max(is_bad[::-1], reversed_datetimes, window)[::-1] > 0
+
+    suspicious = bad_ahead & ~pd.Series(persist_flag).isin([BAD, SUSPICIOUS]).to_numpy()
+    persist_flag[suspicious] = SUSPICIOUS
+
+    # Final flag using range, step and persistence flags, as in qc_final
+    flags = [pd.Series(persist_flag), df['qc_range_quality_flag'].astype(object), df['qc_step_quality_flag'].astype(object)]
+    any_bad = np.logical_or.reduce([flag.eq(BAD).to_numpy() for flag in flags])
+    any_good = np.logical_or.reduce([flag.eq(GOOD).to_numpy() for flag in flags])
+    any_suspicious = np.logical_or.reduce([flag.eq(SUSPICIOUS).to_numpy() for flag in flags])
+    final_flag = np.where(any_bad, BAD, np.where(any_good, GOOD, np.where(any_suspicious, SUSPICIOUS, NOT_CHECKED)))
+
+    df['updated'] = df['updated'].to_numpy(dtype=bool) | suspicious
+    df['qc_persist_quality_flag'] = persist_flag
+    df['qc_persist_description'] = persist_des
+    df['quality_flag'] = final_flag
+    return df
+
 # Persistance update
-def update_insert_persist(df):
-    data = df.to_dict('records')
-    query = '''
-            INSERT INTO raw_data(created_at, updated_at, datetime, station_id, variable_id, measured, qc_persist_quality_flag, qc_persist_description, quality_flag)
-                VALUES (CURRENT_TIMESTAMP, CURRENT_TIMESTAMP, %(datetime)s, %(station_id)s, %(variable_id)s, 0, %(qc_persist_quality_flag)s, %(qc_persist_description)s, %(quality_flag)s)
-            ON CONFLICT (datetime, station_id, variable_id) DO UPDATE SET
-                updated_at=CURRENT_TIMESTAMP,
-                qc_persist_quality_flag = %(qc_persist_quality_flag)s,
-                qc_persist_description = %(qc_persist_description)s,
-                quality_flag = %(quality_flag)s
-            '''
-    con = get_connection()            
-    with con.cursor() as cursor:
-        cursor.executemany(query, data)
-    con.commit()
-    con.close()
+def update_persist_flags(df):
+    """Write the persistence and final flags back to raw_data with a COPY into a staging table and a single
+    UPDATE ... FROM, touching only the rows whose flags changed. Returns the number of changed rows."""
+    if df.empty:
+        return 0
+
+    df = df[['station_id', 'variable_id', 'datetime', 'qc_persist_quality_flag', 'qc_persist_description', 'quality_flag']].copy()
+    for column in ('qc_persist_quality_flag', 'quality_flag'):
+        df[column] = pd.to_numeric(df[column]).astype('Int64')
+
+    buffer = io.StringIO()
+    df.to_csv(buffer, index=False, header=False, na_rep='\\N')
+    buffer.seek(0)
+
+    with get_connection() as con:
+        with con.cursor() as cursor:
+            cursor.execute('''
+                CREATE TEMPORARY TABLE persist_flags_staging (
+                    station_id integer,
+                    variable_id integer,
+                    datetime timestamp with time zone,
+                    qc_persist_quality_flag integer,
+                    qc_persist_description character varying(256),
+                    quality_flag integer
+                ) ON COMMIT DROP
+            ''')
+            cursor.copy_expert("COPY persist_flags_staging FROM STDIN WITH (FORMAT csv, NULL '\\N')", buffer)
+            cursor.execute('ANALYZE persist_flags_staging')
+
+            cursor.execute('''
+                UPDATE raw_data rd
+                   SET updated_at = CURRENT_TIMESTAMP,
+                       qc_persist_quality_flag = pfs.qc_persist_quality_flag,
+                       qc_persist_description = pfs.qc_persist_description,
+                       quality_flag = pfs.quality_flag
+                  FROM persist_flags_staging pfs
+                 WHERE rd.station_id = pfs.station_id
+                   AND rd.variable_id = pfs.variable_id
+                   AND rd.datetime = pfs.datetime
+                   AND (rd.qc_persist_quality_flag, rd.qc_persist_description, rd.quality_flag)
+                       IS DISTINCT FROM (pfs.qc_persist_quality_flag, pfs.qc_persist_description, pfs.quality_flag)
+            ''')
+            changed = cursor.rowcount
+
+    logger.info(f'Persistence QC changed the flags of #{changed} of #{len(df)} checked rows.')
+    return changed
+
+def to_utc_timestamp(value):
+    # Daily tasks use dates, which the database reads as midnight UTC
+    value = pd.Timestamp(value)
+    if value.tzinfo is None:
+        return value.tz_localize('UTC')
+    return value.tz_convert('UTC')
 
 # Main Persist Function
 def update_qc_persist(start_datetime, end_datetime, station_ids, summary_type):
-    dict_sv = get_hourly_sv_dict(start_datetime, end_datetime, station_ids)
-    for station_id in dict_sv:
-        for variable_id in dict_sv[station_id]:
-            s_datetime, e_datetime = dict_sv[station_id][variable_id]
-            window = get_window(station_id, variable_id)
-            df = get_hourly_sv_data(s_datetime, e_datetime, station_id, variable_id, window)
-            
-            if not df.empty:
+    return update_qc_persist_periods([(start_datetime, end_datetime, station_ids)], summary_type)
+
+def update_qc_persist_periods(periods, summary_type):
+    """Persistence QC of a list of (start_datetime, end_datetime, station_ids) periods from a single scan of
+    raw_data. Periods are processed in order and see the flags written by the previous ones, as separate
+    update_qc_persist calls would. Returns the number of raw_data rows whose flags changed."""
+    periods = [(to_utc_timestamp(start_datetime), to_utc_timestamp(end_datetime), [int(station_id) for station_id in station_ids])
+               for start_datetime, end_datetime, station_ids in periods if station_ids]
+    if not periods:
+        return 0
+
+    all_station_ids = set(station_id for period in periods for station_id in period[2])
+    load_qc_thresholds(all_station_ids)
+
+    windows = get_persist_windows(all_station_ids)
+    max_window = max(list(windows.values()) + [3600])
+
+    df_all = get_persist_raw_data(periods, max_window)
+    if df_all.empty:
+        return 0
+
+    # Series of each station, sorted by datetime
+    station_series = {}
+    for (station_id, variable_id), df_sv in df_all.groupby(['station_id', 'variable_id'], sort=False):
+        df_sv = df_sv.reset_index(drop=True)
+        df_sv['qc_persist_quality_flag'] = df_sv['qc_persist_quality_flag'].astype(object)
+        df_sv['qc_persist_description'] = df_sv['qc_persist_description'].astype(object)
+        station_series.setdefault(int(station_id), []).append((int(variable_id), df_sv))
+    del df_all
+
+    checked = []
+    for start_datetime, end_datetime, station_ids in periods:
+        start, end = start_datetime.to_datetime64(), end_datetime.to_datetime64()
+
+        for station_id in station_ids:
+            for variable_id, df_sv in station_series.get(station_id, []):
+                datetimes = df_sv['datetime'].values
+
+                first = np.searchsorted(datetimes, start, side='left')
+                last = np.searchsorted(datetimes, end, side='right')
+                if first == last:
+                    continue
+
+                s_datetime, e_datetime = df_sv['datetime'].iat[first], df_sv['datetime'].iat[last-1]
+                window = windows.get((station_id, variable_id), 3600)
+                window_first = np.searchsorted(datetimes, datetimes[first] - np.timedelta64(window, 's'), side='left')
+
+                df = df_sv.iloc[window_first:last].copy()
+                df['updated'] = False
+                df.iloc[first-window_first:, df.columns.get_loc('updated')] = True
+
                 interval = get_interval(df)
 
-                thresholds = get_thresholds(station_id, variable_id, interval, window)   
-                
-                columns = ['updated', 'qc_persist_quality_flag', 'qc_persist_description', 'quality_flag']
-                df[columns] = df.apply(lambda row: set_persist(row, df, s_datetime, e_datetime, interval, window, thresholds), axis=1, result_type="expand")
+                thresholds = get_thresholds(station_id, variable_id, interval, window)
+
+                df = persist_flags(df, s_datetime, e_datetime, window, thresholds)
 
-                df = df[df['updated']==True]                
+                # Keeping the written flags for the next periods of this series
+                updated = df['updated'].to_numpy(dtype=bool)
+                positions = window_first + np.flatnonzero(updated)
+                for column in ('qc_persist_quality_flag', 'qc_persist_description'):
+                    df_sv.iloc[positions, df_sv.columns.get_loc(column)] = df[column].to_numpy()[updated]
+
+                df = df[updated]
 
                 columns = ['station_id', 'variable_id', 'qc_persist_quality_flag', 'qc_persist_description', 'quality_flag', 'datetime']
-                update_insert_persist(df[columns])
+                checked.append(df[columns])
 
                 recalculate_summary(df, station_id, s_datetime, e_datetime, summary_type)
 
+    # A row checked by several periods keeps the flags of the last one
+    if checked:
+        df = pd.concat(checked, ignore_index=True)
+        df.drop_duplicates(subset=['station_id', 'variable_id', 'datetime'], keep='last', inplace=True)
+        return update_persist_flags(df)
+    return 0
+
 def insert_summay(date, station_id, summary_type):
     query_hourly = '''
                     INSERT INTO wx_hourlysummarytask(created_at, updated_at, datetime, started_at, finished_at, station_id)
@@ -1608,11 +2147,10 @@ def insert_summay(date, station_id, summary_type):
 
 
     data = {'station_id': station_id, 'date': date}
-    con = get_connection()            
-    with con.cursor() as cursor:
-        cursor.execute(query, data)
-    con.commit()
-    con.close()
+    with get_connection() as con:
+        with con.cursor() as cursor:
+            cursor.execute(query, data)
+        con.commit()
 
 def recalculate_summary(df, station_id, s_datetime, e_datetime, summary_type):
     mask = df.datetime.between(s_datetime, e_datetime)    
@@ -1633,63 +2171,516 @@ def recalculate_summary(df, station_id, s_datetime, e_datetime, summary_type):
                 if not _hourlysummaries:
                     insert_summay(date, station_id, summary_type)
 
-def hourly_summary(hourly_summary_tasks_ids, station_ids, s_datetime, e_datetime):
+# Summary tasks claimed per execution of each process_*_summary_tasks
+HOURLY_SUMMARY_BATCH_SIZE = 10000
+DAILY_SUMMARY_BATCH_SIZE = 5000
+HFDATA_SUMMARY_BATCH_SIZE = 5000
+
+# Longest run of contiguous hours recomputed at once
+HOURLY_SUMMARY_MAX_RANGE_HOURS = 168
+
+# Claimed tasks not finished after this many seconds (crashed or failed worker) are claimed again. The lease of the
+# tasks still waiting in a batch is renewed before each part of the batch is processed.
+SUMMARY_TASK_LEASE_SECONDS = 3600
+
+# Tasks claimed this many times without finishing are left for manual inspection
+SUMMARY_TASK_MAX_ATTEMPTS = 5
+
+def claim_summary_tasks(table, columns, order_by, limit, lease_seconds=SUMMARY_TASK_LEASE_SECONDS):
+    """Claim up to limit pending tasks of a summary task table, returning (id, *columns) of each of them.
+    Rows locked by a concurrent claim are skipped, so several workers can process the same table."""
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(f"""
+                UPDATE {table} AS task
+                   SET started_at = now()
+                      ,updated_at = now()
+                      ,attempts = task.attempts + 1
+                  FROM (SELECT id
+                          FROM {table}
+                         WHERE finished_at IS NULL
+                           AND attempts < %(max_attempts)s
+                           AND (started_at IS NULL OR started_at < now() - %(lease_seconds)s * INTERVAL '1 second')
+                         ORDER BY started_at IS NOT NULL, {order_by}
+                         LIMIT %(limit)s
+                           FOR UPDATE SKIP LOCKED) AS claimable
+                 WHERE task.id = claimable.id
+             RETURNING task.id, task.attempts, {', '.join('task.' + column for column in columns)}
+            """, {"limit": limit, "lease_seconds": lease_seconds, "max_attempts": SUMMARY_TASK_MAX_ATTEMPTS})
+            claimed_tasks = cursor.fetchall()
+
+    if claimed_tasks:
+        logger.info(f'Claimed #{len(claimed_tasks)} tasks from {table}.')
+
+    last_attempt_ids = [task[0] for task in claimed_tasks if task[1] >= SUMMARY_TASK_MAX_ATTEMPTS]
+    if last_attempt_ids:
+        message = (f'Tasks {last_attempt_ids} of {table} claimed for the last time ({SUMMARY_TASK_MAX_ATTEMPTS} attempts), '
+                   f'they will not be claimed again if they do not finish.')
+        logger.warning(message)
+        db_logger.error(message)
+
+    return [(task[0],) + tuple(task[2:]) for task in claimed_tasks]
+
+def renew_summary_tasks(table, task_ids, renewed_at):
+    """Restart the lease of claimed tasks still waiting to be processed once half of it has passed since renewed_at,
+    returning when it was last renewed"""
+    if not task_ids or time() - renewed_at < SUMMARY_TASK_LEASE_SECONDS / 2:
+        return renewed_at
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(f"""
+                UPDATE {table}
+                   SET started_at = now()
+                      ,updated_at = now()
+                 WHERE id = ANY(%(task_ids)s)
+                   AND finished_at IS NULL
+            """, {"task_ids": list(task_ids)})
+    return time()
+
+def get_contiguous_hour_ranges(hours, max_hours):
+    ranges = []
+    for hour in sorted(set(hours)):
+        if ranges and hour - ranges[-1][-1] == timedelta(hours=1) and len(ranges[-1]) < max_hours:
+            ranges[-1].append(hour)
+        else:
+            ranges.append([hour])
+    return ranges
+
+def calculate_hourly_summary_range(station_hours):
+    """Recompute the hourly summaries of a list of (station_id, hour) within one contiguous range of hours,
+    with the same rules as calculate_hourly_summary but a single DELETE and INSERT for the whole range"""
+    start_datetime = min(hour for station_id, hour in station_hours)
+    end_datetime = max(hour for station_id, hour in station_hours) + timedelta(hours=1)
+
+    targets_sql = """
+        unnest(%(target_station_ids)s::integer[], %(target_datetimes)s::timestamptz[]) AS target(station_id, datetime)
+    """
+
+    delete_sql = f"""
+        DELETE FROM hourly_summary hs
+         USING {targets_sql}
+         WHERE hs.station_id = target.station_id
+           AND hs.datetime = target.datetime
+           AND hs.datetime BETWEEN %(start_datetime)s AND %(end_datetime)s
+    """
+
+    insert_sql = f"""
+        WITH target AS (SELECT * FROM {targets_sql})
+        INSERT INTO hourly_summary (
+            datetime,
+            station_id,
+            variable_id,
+            min_value,
+            max_value,
+            avg_value,
+            sum_value,
+            num_records,
+            created_at,
+            updated_at
+        )
+        SELECT summary.*, now(), now()
+        FROM ({hourly_summary_sql('EXISTS (SELECT 1 FROM target WHERE target.station_id = values.station_id AND target.datetime = values.datetime)')}) summary
+    """
+
+    params = {
+        "target_station_ids": [station_id for station_id, hour in station_hours],
+        "target_datetimes": [hour for station_id, hour in station_hours],
+        "station_ids": tuple(set(station_id for station_id, hour in station_hours)),
+        "start_datetime": start_datetime,
+        "end_datetime": end_datetime,
+    }
+
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(delete_sql, params)
+            cursor.execute(insert_sql, params)
+
+# Width of the raw_data_15min_summary buckets, every UTC offset in use is a multiple of it
+RAW_DATA_AGGREGATE_BUCKET_SECONDS = 900
+
+def refresh_raw_data_aggregate(start_datetime, end_datetime):
+    # Only the buckets entirely inside the window are refreshed, so it is widened to bucket boundaries
+    start_timestamp = start_datetime.timestamp() // RAW_DATA_AGGREGATE_BUCKET_SECONDS * RAW_DATA_AGGREGATE_BUCKET_SECONDS
+    end_timestamp = -(-end_datetime.timestamp() // RAW_DATA_AGGREGATE_BUCKET_SECONDS) * RAW_DATA_AGGREGATE_BUCKET_SECONDS
+
+    conn = get_connection()
     try:
-        HourlySummaryTask.objects.filter(id__in=hourly_summary_tasks_ids).update(started_at=datetime.now(tz=pytz.UTC))
-        calculate_hourly_summary(s_datetime, e_datetime, station_id_list=station_ids)
-    except Exception as err:
-        logger.error('Error calculation hourly summary for hour "{0}". '.format(hourly_summary_datetime) + repr(err))
-        db_logger.error('Error calculation hourly summary for hour "{0}". '.format(hourly_summary_datetime) + repr(err))
-    else:
-        HourlySummaryTask.objects.filter(id__in=hourly_summary_tasks_ids).update(finished_at=datetime.now(tz=pytz.UTC))
+        # Continuous aggregates cannot be refreshed inside a transaction block, migration 0029 creates this one
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute("CALL refresh_continuous_aggregate('raw_data_15min_summary', %(start_datetime)s, %(end_datetime)s)",
+                           {"start_datetime": datetime.fromtimestamp(start_timestamp, tz=pytz.UTC),
+                            "end_datetime": datetime.fromtimestamp(end_timestamp, tz=pytz.UTC)})
+    finally:
+        conn.close()
+
+def calculate_hourly_summary_aggregate(station_hours):
+    """Same as calculate_hourly_summary_range, but from the raw_data_15min_summary buckets, only writing the
+    summaries that changed"""
+    start_datetime = min(hour for station_id, hour in station_hours)
+    end_datetime = max(hour for station_id, hour in station_hours) + timedelta(hours=1)
+
+    # The bucket starting at end_datetime holds the midnight reads of the last hour
+    refresh_raw_data_aggregate(start_datetime, end_datetime + timedelta(seconds=RAW_DATA_AGGREGATE_BUCKET_SECONDS))
+
+    upsert_sql = """
+        WITH target AS (
+            SELECT *
+              FROM unnest(%(target_station_ids)s::integer[], %(target_datetimes)s::timestamptz[]) AS target(station_id, datetime)
+        ), computed AS (
+            SELECT 
+                values.datetime,
+                values.station_id,
+                values.variable_id,
+                min(values.min_value) AS min_value,
+                max(values.max_value) AS max_value,
+                sum(values.sum_value) / sum(values.num_records) AS avg_value,
+                sum(values.sum_value) AS sum_value,
+                sum(values.num_records) AS num_records
+            FROM
+                (SELECT 
+                    CASE WHEN NOT agg.is_daily AND agg.on_boundary AND agg.bucket = agg.bucket::date THEN agg.bucket - '1 hour'::interval ELSE date_trunc('hour', agg.bucket) END as datetime,
+                    agg.station_id,
+                    agg.variable_id,
+                    agg.min_value,
+                    agg.max_value,
+                    agg.sum_value,
+                    agg.num_records
+                FROM raw_data_15min_summary agg
+                WHERE agg.bucket >= %(start_datetime)s
+                  AND agg.bucket <= %(end_datetime)s
+                  AND agg.station_id in %(station_ids)s) values
+            JOIN target ON target.station_id = values.station_id AND target.datetime = values.datetime
+            GROUP BY 1,2,3
+        ), deleted AS (
+            DELETE FROM hourly_summary hs
+             USING target
+             WHERE hs.station_id = target.station_id
+               AND hs.datetime = target.datetime
+               AND hs.datetime BETWEEN %(start_datetime)s AND %(end_datetime)s
+               AND NOT EXISTS (SELECT 1
+                                 FROM computed
+                                WHERE computed.datetime = hs.datetime
+                                  AND computed.station_id = hs.station_id
+                                  AND computed.variable_id = hs.variable_id)
+        )
+        INSERT INTO hourly_summary (
+            datetime,
+            station_id,
+            variable_id,
+            min_value,
+            max_value,
+            avg_value,
+            sum_value,
+            num_records,
+            created_at,
+            updated_at
+        )
+        SELECT datetime, station_id, variable_id, min_value, max_value, avg_value, sum_value, num_records, now(), now()
+          FROM computed
+        ON CONFLICT ON CONSTRAINT hourly_summary_uniq DO UPDATE
+           SET min_value = excluded.min_value
+              ,max_value = excluded.max_value
+              ,avg_value = excluded.avg_value
+              ,sum_value = excluded.sum_value
+              ,num_records = excluded.num_records
+              ,updated_at = excluded.updated_at
+         WHERE (hourly_summary.min_value, hourly_summary.max_value, hourly_summary.avg_value, hourly_summary.sum_value, hourly_summary.num_records)
+               IS DISTINCT FROM (excluded.min_value, excluded.max_value, excluded.avg_value, excluded.sum_value, excluded.num_records)
+    """
+
+    params = {
+        "target_station_ids": [station_id for station_id, hour in station_hours],
+        "target_datetimes": [hour for station_id, hour in station_hours],
+        "station_ids": tuple(set(station_id for station_id, hour in station_hours)),
+        "start_datetime": start_datetime,
+        "end_datetime": end_datetime,
+    }
+
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(upsert_sql, params)
+
+def calculate_daily_summary_aggregate(start_date, end_date, station_id_list, period_summary_keys=None):
+    """Same as calculate_daily_summary, but from the raw_data_15min_summary buckets, only writing the summaries
+    that changed"""
+    stations = Station.objects.filter(id__in=station_id_list)
+
+    offsets = list(set([s.utc_offset_minutes for s in stations]))
+    for offset in offsets:
+        station_ids = tuple(stations.filter(utc_offset_minutes=offset).values_list('id', flat=True))
+
+        # Local days of these stations do not start at a bucket boundary
+        if offset * 60 % RAW_DATA_AGGREGATE_BUCKET_SECONDS:
+            calculate_daily_summary(start_date, end_date, station_id_list=station_ids, period_summary_keys=period_summary_keys)
+            continue
+
+        fixed_offset = pytz.FixedOffset(offset)
+        datetime_start = datetime(start_date.year, start_date.month, start_date.day, 0, 0, 0,
+                                  tzinfo=fixed_offset).astimezone(pytz.UTC)
+        datetime_end = datetime(end_date.year, end_date.month, end_date.day, 0, 0, 0,
+                                tzinfo=fixed_offset).astimezone(pytz.UTC)
+
+        refresh_raw_data_aggregate(datetime_start, datetime_end + timedelta(seconds=RAW_DATA_AGGREGATE_BUCKET_SECONDS))
+
+        upsert_sql = """
+            WITH computed AS (
+                SELECT 
+                    values.day,
+                    values.station_id,
+                    values.variable_id,
+                    min(values.min_value) AS min_value,
+                    max(values.max_value) AS max_value,
+                    sum(values.sum_value) / sum(values.num_records) AS avg_value,
+                    sum(values.sum_value) AS sum_value,
+                    sum(values.num_records) AS num_records
+                FROM
+                    (SELECT 
+                        CASE WHEN NOT agg.is_daily AND agg.on_boundary
+                             THEN cast((agg.bucket + interval '%(offset)s minutes') at time zone 'utc' - '1 second'::interval as DATE)
+                             ELSE cast((agg.bucket + interval '%(offset)s minutes') at time zone 'utc' as DATE) END as "day",
+                        agg.station_id,
+                        agg.variable_id,
+                        agg.min_value,
+                        agg.max_value,
+                        agg.sum_value,
+                        agg.num_records
+                    FROM raw_data_15min_summary agg
+                    WHERE agg.bucket >= %(datetime_start)s
+                      AND agg.bucket <= %(datetime_end)s
+                      AND agg.station_id in %(station_ids)s) values
+                WHERE values.day >= %(start_date)s
+                  AND values.day < %(end_date)s
+                GROUP BY 1,2,3
+            ), deleted AS (
+                DELETE FROM daily_summary ds
+                 WHERE ds.station_id in %(station_ids)s
+                   AND ds.day >= %(start_date)s
+                   AND ds.day < %(end_date)s
+                   AND NOT EXISTS (SELECT 1
+                                     FROM computed
+                                    WHERE computed.day = ds.day
+                                      AND computed.station_id = ds.station_id
+                                      AND computed.variable_id = ds.variable_id)
+            )
+            INSERT INTO daily_summary (
+                "day",
+                station_id,
+                variable_id,
+                min_value,
+                max_value,
+                avg_value,
+                sum_value,
+                num_records,
+                created_at,
+                updated_at
+            )
+            SELECT "day", station_id, variable_id, min_value, max_value, avg_value, sum_value, num_records, now(), now()
+              FROM computed
+            ON CONFLICT ON CONSTRAINT daily_summary_uniq DO UPDATE
+               SET min_value = excluded.min_value
+                  ,max_value = excluded.max_value
+                  ,avg_value = excluded.avg_value
+                  ,sum_value = excluded.sum_value
+                  ,num_records = excluded.num_records
+                  ,updated_at = excluded.updated_at
+             WHERE (daily_summary.min_value, daily_summary.max_value, daily_summary.avg_value, daily_summary.sum_value, daily_summary.num_records)
+                   IS DISTINCT FROM (excluded.min_value, excluded.max_value, excluded.avg_value, excluded.sum_value, excluded.num_records)
+        """
+
+        with get_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(upsert_sql, {"datetime_start": datetime_start, "datetime_end": datetime_end,
+                                            "start_date": start_date, "end_date": end_date,
+                                            "station_ids": station_ids, "offset": offset})
+                if period_summary_keys is None:
+                    refresh_period_summaries(cursor, get_period_summary_keys(station_ids, start_date, end_date))
+                else:
+                    period_summary_keys.update(get_period_summary_keys(station_ids, start_date, end_date))
+
+    cache.set('daily_summary_last_run', datetime.today(), None)
 
 @shared_task
 def process_hourly_summary_tasks():
-    # Process only 500 hourly summaries per execution
-    unprocessed_hourly_summary_datetimes = HourlySummaryTask.objects.filter(started_at=None).values_list('datetime',flat=True).distinct()[:501]
-    for hourly_summary_datetime in unprocessed_hourly_summary_datetimes:
-        start_datetime = hourly_summary_datetime
-        end_datetime = hourly_summary_datetime + timedelta(hours=1)
+    start_at = time()
 
-        hourly_summary_tasks = HourlySummaryTask.objects.filter(started_at=None, datetime=hourly_summary_datetime)
-        hourly_summary_tasks_ids = list(hourly_summary_tasks.values_list('id', flat=True))
-        station_ids = list(hourly_summary_tasks.values_list('station_id', flat=True).distinct())
+    claimed_tasks = claim_summary_tasks('wx_hourlysummarytask', ['station_id', 'datetime'], 'datetime', HOURLY_SUMMARY_BATCH_SIZE)
 
-        if station_ids:
-            update_qc_persist(start_datetime, end_datetime, station_ids, 'hourly')
+    tasks_by_hour = {}
+    for task_id, station_id, task_datetime in claimed_tasks:
+        tasks_by_hour.setdefault(task_datetime, []).append((task_id, station_id))
 
-        # Updating Hourly summary task
-        hourly_summary(hourly_summary_tasks_ids, station_ids, start_datetime, end_datetime)
+    hour_ranges = get_contiguous_hour_ranges(tasks_by_hour.keys(), HOURLY_SUMMARY_MAX_RANGE_HOURS)
+    lease_renewed_at = time()
+    for index, hours in enumerate(hour_ranges):
+        waiting_task_ids = [task_id for hours_left in hour_ranges[index:] for hour in hours_left for task_id, station_id in tasks_by_hour[hour]]
+        lease_renewed_at = renew_summary_tasks('wx_hourlysummarytask', waiting_task_ids, lease_renewed_at)
+
+        task_ids = [task_id for hour in hours for task_id, station_id in tasks_by_hour[hour]]
+        station_hours = sorted(set((station_id, hour) for hour in hours for task_id, station_id in tasks_by_hour[hour]))
+
+        try:
+            # Persistence QC of every hour of the range with a single scan of raw_data
+            update_qc_persist_periods([(hour, hour + timedelta(hours=1), sorted(set(station_id for task_id, station_id in tasks_by_hour[hour])))
+                                       for hour in hours], 'hourly')
+
+            if settings.SUMMARY_CONTINUOUS_AGGREGATES:
+                calculate_hourly_summary_aggregate(station_hours)
+            else:
+                calculate_hourly_summary_range(station_hours)
+        except Exception as err:
+            logger.error('Error calculation hourly summary from "{0}" to "{1}". '.format(hours[0], hours[-1]) + repr(err))
+            db_logger.error('Error calculation hourly summary from "{0}" to "{1}". '.format(hours[0], hours[-1]) + repr(err))
+        else:
+            HourlySummaryTask.objects.filter(id__in=task_ids).update(finished_at=datetime.now(tz=pytz.UTC))
+
+    logger.info(f'Processed #{len(claimed_tasks)} hourly summary tasks in {time() - start_at} seconds.')
 
-def daily_summary(daily_summary_tasks_ids, station_ids, s_datetime, e_datetime):
+def daily_summary(daily_summary_tasks_ids, station_ids, s_datetime, e_datetime, period_summary_keys=None):
     try:
-        DailySummaryTask.objects.filter(id__in=daily_summary_tasks_ids).update(started_at=datetime.now(tz=pytz.UTC))
-        calculate_daily_summary(s_datetime, e_datetime, station_id_list=station_ids)
-        # for station_id in station_ids:
-        #    calculate_station_minimum_interval(s_datetime, e_datetime, station_id_list=(station_id,))
+        if settings.SUMMARY_CONTINUOUS_AGGREGATES:
+            calculate_daily_summary_aggregate(s_datetime, e_datetime, station_ids, period_summary_keys=period_summary_keys)
+        else:
+            calculate_daily_summary(s_datetime, e_datetime, station_id_list=station_ids, period_summary_keys=period_summary_keys)
     except Exception as err:
-        logger.error('Error calculation daily summary for day "{0}". '.format(daily_summary_date) + repr(err))
-        db_logger.error('Error calculation daily summary for day "{0}". '.format(daily_summary_date) + repr(err))
-    else:
-        DailySummaryTask.objects.filter(id__in=daily_summary_tasks_ids).update(finished_at=datetime.now(tz=pytz.UTC))
+        logger.error('Error calculation daily summary for day "{0}". '.format(s_datetime) + repr(err))
+        db_logger.error('Error calculation daily summary for day "{0}". '.format(s_datetime) + repr(err))
+        return
+
+    DailySummaryTask.objects.filter(id__in=daily_summary_tasks_ids).update(finished_at=datetime.now(tz=pytz.UTC))
+
+    # The minimum intervals of the days whose reads changed are kept current by the same tasks, a failure must not
+    # retry the daily summaries already written
+    try:
+        calculate_station_minimum_interval(s_datetime, e_datetime - timedelta(days=1), station_id_list=station_ids)
+    except Exception as err:
+        logger.error('Error calculation minimum interval for day "{0}". '.format(s_datetime) + repr(err))
+        db_logger.error('Error calculation minimum interval for day "{0}". '.format(s_datetime) + repr(err))
 
 @shared_task
 def process_daily_summary_tasks():
-    # process only 500 daily summaries per execution
-    unprocessed_daily_summary_dates = DailySummaryTask.objects.filter(started_at=None).values_list('date',flat=True).distinct()[:501]
-    for daily_summary_date in unprocessed_daily_summary_dates:
+    claimed_tasks = claim_summary_tasks('wx_dailysummarytask', ['station_id', 'date'], 'date', DAILY_SUMMARY_BATCH_SIZE)
+
+    tasks_by_date = {}
+    for task_id, station_id, task_date in claimed_tasks:
+        tasks_by_date.setdefault(task_date, []).append((task_id, station_id))
+
+    daily_summary_batches = []
+    for daily_summary_date in sorted(tasks_by_date):
 
         start_date = daily_summary_date
         end_date = daily_summary_date + timedelta(days=1)
 
-        daily_summary_tasks = DailySummaryTask.objects.filter(started_at=None, date=daily_summary_date)
-        daily_summary_tasks_ids = list(daily_summary_tasks.values_list('id', flat=True))
-        station_ids = list(daily_summary_tasks.values_list('station_id', flat=True).distinct())
+        daily_summary_tasks_ids = [task_id for task_id, station_id in tasks_by_date[daily_summary_date]]
+        station_ids = sorted(set(station_id for task_id, station_id in tasks_by_date[daily_summary_date]))
+
+        daily_summary_batches.append((daily_summary_tasks_ids, station_ids, start_date, end_date))
+
+    # Persistence QC of every day with a single scan of raw_data
+    update_qc_persist_periods([(start_date, end_date, station_ids)
+                               for _, station_ids, start_date, end_date in daily_summary_batches], 'daily')
+
+    # Months and years of every day of the batch, refreshed once at the end
+    period_summary_keys = set()
 
-        if station_ids:
-            update_qc_persist(start_date, end_date, station_ids, 'daily')
+    lease_renewed_at = time()
+    for index, (daily_summary_tasks_ids, station_ids, start_date, end_date) in enumerate(daily_summary_batches):
+        lease_renewed_at = renew_summary_tasks('wx_dailysummarytask', [task_id for batch in daily_summary_batches[index:] for task_id in batch[0]],
+                                               lease_renewed_at)
+        daily_summary(daily_summary_tasks_ids, station_ids, start_date, end_date, period_summary_keys)
 
-        daily_summary(daily_summary_tasks_ids, station_ids, start_date, end_date)
+    try:
+        with get_connection() as conn:
+            with conn.cursor() as cursor:
+                refresh_period_summaries(cursor, period_summary_keys)
+    except Exception as err:
+        logger.error(f'Error refreshing #{len(period_summary_keys)} monthly and yearly summaries. ' + repr(err))
+        db_logger.error(f'Error refreshing #{len(period_summary_keys)} monthly and yearly summaries. ' + repr(err))
+
+# Days of a single station recalculated by each shard of rebuild_summaries
+SUMMARY_REBUILD_SHARD_DAYS = 31
+
+# Shards still running after this many seconds (crashed worker) are claimed again. Covers a single shard, failed shards
+# are released right away.
+SUMMARY_REBUILD_LEASE_SECONDS = 1800
+
+def to_date(value):
+    # Dates passed to celery tasks arrive as strings
+    if isinstance(value, str):
+        return dateutil.parser.parse(value).date()
+    return value
+
+def get_summary_rebuild_shards(station_ids, start_date, end_date):
+    # (station_id, start_date, end_date) of up to SUMMARY_REBUILD_SHARD_DAYS days each
+    shards = []
+    for station_id in station_ids:
+        shard_start = start_date
+        while shard_start < end_date:
+            shard_end = min(shard_start + timedelta(days=SUMMARY_REBUILD_SHARD_DAYS), end_date)
+            shards.append((station_id, shard_start, shard_end))
+            shard_start = shard_end
+    return shards
+
+@shared_task
+def rebuild_summaries(start_date, end_date, station_id_list=None, concurrency=None):
+    """Recalculate the daily summaries and minimum intervals from start_date to end_date (exclusive), split in
+    (station, date range) shards processed by up to concurrency workers at the same time"""
+    start_date, end_date = to_date(start_date), to_date(end_date)
+    concurrency = concurrency or settings.SUMMARY_REBUILD_CONCURRENCY
+
+    if station_id_list is None:
+        station_id_list = list(Station.objects.filter(is_active=True).values_list('id', flat=True))
+
+    rebuild_id = uuid.uuid4().hex
+    shards = [SummaryRebuildTask(rebuild_id=rebuild_id, station_id=station_id, start_date=shard_start, end_date=shard_end)
+              for station_id, shard_start, shard_end in get_summary_rebuild_shards(station_id_list, start_date, end_date)]
+    SummaryRebuildTask.objects.bulk_create(shards, batch_size=1000)
+
+    logger.info(f'Summary rebuild {rebuild_id} split in #{len(shards)} shards, processed by {concurrency} workers.')
+
+    group(process_summary_rebuild_tasks.s() for _ in range(concurrency)).apply_async()
+    return rebuild_id
+
+@shared_task
+def resume_summary_rebuild(rebuild_id, concurrency=None):
+    # Shards of workers still running keep their lease, the others (and the ones out of attempts) are claimed again
+    concurrency = concurrency or settings.SUMMARY_REBUILD_CONCURRENCY
+    lease_expired_at = datetime.now(tz=pytz.UTC) - timedelta(seconds=SUMMARY_REBUILD_LEASE_SECONDS)
+    SummaryRebuildTask.objects.filter(Q(started_at=None) | Q(started_at__lt=lease_expired_at),
+                                      rebuild_id=rebuild_id, finished_at=None).update(started_at=None, attempts=0)
+    group(process_summary_rebuild_tasks.s() for _ in range(concurrency)).apply_async()
+
+def summary_rebuild_progress(rebuild_id):
+    return SummaryRebuildTask.objects.filter(rebuild_id=rebuild_id).aggregate(
+        total=Count('id'),
+        finished=Count('id', filter=Q(finished_at__isnull=False)),
+        running=Count('id', filter=Q(started_at__isnull=False, finished_at=None)),
+        pending=Count('id', filter=Q(started_at=None)),
+    )
+
+@shared_task
+def process_summary_rebuild_tasks():
+    # Each worker takes one shard at a time until there are none left, failed shards are retried up to
+    # SUMMARY_TASK_MAX_ATTEMPTS times
+    while True:
+        claimed_tasks = claim_summary_tasks('wx_summaryrebuildtask', ['rebuild_id', 'station_id', 'start_date', 'end_date'],
+                                            'start_date', 1, lease_seconds=SUMMARY_REBUILD_LEASE_SECONDS)
+        if not claimed_tasks:
+            break
+
+        task_id, rebuild_id, station_id, start_date, end_date = claimed_tasks[0]
+        try:
+            calculate_daily_summary(start_date, end_date, station_id_list=[station_id])
+            calculate_station_minimum_interval(start_date, end_date - timedelta(days=1), station_id_list=[station_id])
+        except Exception as err:
+            logger.error(f'Error rebuilding summaries of station {station_id} from "{start_date}" to "{end_date}". ' + repr(err))
+            db_logger.error(f'Error rebuilding summaries of station {station_id} from "{start_date}" to "{end_date}". ' + repr(err))
+            SummaryRebuildTask.objects.filter(id=task_id).update(started_at=None)
+        else:
+            SummaryRebuildTask.objects.filter(id=task_id).update(finished_at=datetime.now(tz=pytz.UTC))
+
+        progress = summary_rebuild_progress(rebuild_id)
+        logger.info(f'Summary rebuild {rebuild_id}: #{progress["finished"]} of #{progress["total"]} shards finished.')
 
 def predict_data(start_datetime, end_datetime, prediction_id, station_ids, target_station_id, variable_id,
                  data_period_in_minutes, interval_in_minutes, result_mapping):
@@ -1727,8 +2718,7 @@ def predict_data(start_datetime, end_datetime, prediction_id, station_ids, targe
     }
 
     formated_list = []
-    conn = get_connection()
-    with conn.cursor() as cursor:
+    with get_connection() as conn, conn.cursor() as cursor:
         cursor.execute(query, params)
 
         # Group records in a dictionary by datetime
@@ -1803,17 +2793,17 @@ def predict_data(start_datetime, end_datetime, prediction_id, station_ids, targe
                 f'Error on predict_data for prediction "{prediction_id}": Invalid mapping for result "{record["prediction"]}".')
             raise Exception(e)
 
-    # Update records' labels
+    # Update records' labels, the connection of the query was given back before calling HydroML
     try:
-        with conn.cursor() as cursor:
-            cursor.executemany(f"""
-                UPDATE raw_data 
-                SET ml_flag = %(result)s
-                WHERE station_id = %(target_station_id)s
-                  AND variable_id = %(variable_id)s 
-                  AND datetime = %(datetime)s;
-            """, formated_response)
-        conn.commit()
+        with get_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.executemany(f"""
+                    UPDATE raw_data 
+                    SET ml_flag = %(result)s
+                    WHERE station_id = %(target_station_id)s
+                      AND variable_id = %(variable_id)s 
+                      AND datetime = %(datetime)s;
+                """, formated_response)
     except Exception as e:
         logger.error(f'Error on update raw_data: {repr(e)}')
 
@@ -1851,19 +2841,23 @@ def predict_preciptation_data():
 
 @shared_task
 def process_hfdata_summary_tasks():
-    # process only 500 HF summaries per execution
-    unprocessed_hf_summaries = HFSummaryTask.objects.filter(started_at=None).values_list('station', 'variable', 'start_datetime', 'end_datetime').distinct()[:501]
-    for  station_id, variable_id, s_datetime, e_datetime in unprocessed_hf_summaries:
-
-        hf_summary_task = HFSummaryTask.objects.filter(started_at=None, station_id=station_id, variable_id=variable_id, start_datetime=s_datetime, end_datetime=e_datetime)
-        hf_summary_task_ids = list(hf_summary_task.values_list('id', flat=True))
-
+    claimed_tasks = claim_summary_tasks('wx_hfsummarytask', ['station_id', 'variable_id', 'start_datetime', 'end_datetime'],
+                                        'start_datetime', HFDATA_SUMMARY_BATCH_SIZE)
+
+    unprocessed_hf_summaries = {}
+    for task_id, station_id, variable_id, s_datetime, e_datetime in claimed_tasks:
+        unprocessed_hf_summaries.setdefault((station_id, variable_id, s_datetime, e_datetime), []).append(task_id)
+
+    hf_summaries = list(unprocessed_hf_summaries.items())
+    lease_renewed_at = time()
+    for index, ((station_id, variable_id, s_datetime, e_datetime), hf_summary_task_ids) in enumerate(hf_summaries):
+        lease_renewed_at = renew_summary_tasks('wx_hfsummarytask', [task_id for _, task_ids in hf_summaries[index:] for task_id in task_ids],
+                                               lease_renewed_at)
         # Updating Hourly summary task
         hfdata_summary(hf_summary_task_ids, station_id, variable_id, s_datetime, e_datetime)
 
 def hfdata_summary(hf_summary_task_ids, station_id, variable_id, s_datetime, e_datetime):
     try:
-        HFSummaryTask.objects.filter(id__in=hf_summary_task_ids).update(started_at=datetime.now(tz=pytz.UTC))
         calculate_hfdata_summary(station_id, variable_id, s_datetime, e_datetime)
     except Exception as err:
         logger.error('Error calculation hfdata summary for variable "{0}" and range ("{1}","{2}"). '.format(variable_id, s_datetime, s_datetime) + repr(err))
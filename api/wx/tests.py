@@ -1,13 +1,28 @@
-from datetime import datetime
-
+import json
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from unittest import mock
+
+import numpy as np
+import pandas as pd
 import pytz
-from django.test import TestCase
+from django.core.cache import cache
+from django.db import connection
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
 
+from tempestas_api import settings
+from wx import db_pool
 from wx.decoders.hobo import parse_first_line_header as parse_first_line_header_hobo, \
     parse_second_line_header as parse_second_line_header_hobo, \
     convert_string_2_datetime as convert_string_2_datetime_hobo, get_column_names as get_column_names_hobo, \
     handle_null_field as handle_null_field_hobo
+from wx.decoders.insert_raw_data import qc_columns, qc_thresholds, qc_thresholds_columnar, get_data, insert_columns
 from wx.decoders.toa5 import read_file, parse_first_line_header, parse_second_line_header, convert_string_2_datetime
+from wx.enums import QualityFlagEnum
+from wx.models import DataFile, QcPersistThreshold, QcRangeThreshold, QcStepThreshold, Station, SummaryRebuildTask, Variable
+from wx import qc_thresholds as qc_thresholds_module
 
 
 class IngestTOA5File(TestCase):
@@ -99,3 +114,557 @@ class IngestTOA5File(TestCase):
         self.assertEqual(handle_null_field_hobo('a'), None)
         self.assertEqual(handle_null_field_hobo('3.1'), 3.1)
         self.assertEqual(handle_null_field_hobo('0'), 0.0)
+
+
+class QualityControlColumnar(TestCase):
+
+    def get_group(self):
+        datetimes = pd.to_datetime(['2019-04-03 00:00:00', '2019-04-03 00:05:00', '2019-04-03 00:10:00',
+                                    '2019-04-03 00:20:00', '2019-04-03 00:25:00'], utc=True)
+        df = pd.DataFrame({'seconds': 300, 'datetime': datetimes, 'measured': [10.0, 12.0, 30.0, 31.0, -5.0]})
+        df['diff_value'] = df.measured.diff(periods=1)
+        df['diff_datetime'] = df.datetime.diff(periods=1).dt.total_seconds().fillna(0).astype("int32")
+        return df
+
+    def assert_same_as_row_wise(self, thresholds):
+        df = self.get_group()
+        expected = [qc_thresholds(row, thresholds) for row in df.itertuples()]
+        result = qc_thresholds_columnar(df, thresholds)[qc_columns].values.tolist()
+
+        self.assertEqual(expected, result)
+
+    def test_step_and_range_thresholds(self):
+        self.assert_same_as_row_wise({'step_min': -5, 'step_max': 5, 'step_description': 'Custom station Threshold',
+                                      'range_min': 0, 'range_max': 30, 'range_description': 'Custom station Threshold'})
+
+    def test_missing_thresholds(self):
+        self.assert_same_as_row_wise({})
+        self.assert_same_as_row_wise({'step_min': -5, 'step_max': 5, 'step_description': 'Global threshold (Manual)'})
+        self.assert_same_as_row_wise({'range_min': None, 'range_max': None, 'range_description': 'Global threshold (Manual)'})
+
+    def test_step_continuity_across_chunks(self):
+        df = self.get_group()
+        raw_data_list = [[1, 10, 300, read_datetime, measured] + [None] * 9 + [False]
+                         for read_datetime, measured in zip(df['datetime'].tolist(), df['measured'].tolist())]
+
+        thresholds = {'step_min': -5, 'step_max': 5, 'step_description': 'Custom station Threshold'}
+        with mock.patch('wx.qc_thresholds.get_group_thresholds', return_value=thresholds):
+            expected = get_data(raw_data_list)
+
+            # The first read of the second chunk is checked against the last read of the first one
+            previous_reads = {}
+            result = get_data(raw_data_list[:2], previous_reads) + get_data(raw_data_list[2:], previous_reads)
+
+        self.assertEqual([read[:-2] for read in expected], [read[:-2] for read in result])
+        self.assertEqual(result[2][insert_columns.index('qc_step_quality_flag')], QualityFlagEnum.BAD.id)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class QualityControlReferenceStations(TestCase):
+
+    def setUp(self):
+        qc_thresholds_module._clear()
+        self.addCleanup(qc_thresholds_module._clear)
+
+        self.variable = Variable.objects.create(variable_type='Float', symbol='TEMP', name='Temperature')
+
+        # The first station references the second one, which references the third one
+        self.third_station = Station.objects.create(name='Third', code='THIRD', latitude=17.25, longitude=-88.77,
+                                                    utc_offset_minutes=-360)
+        self.second_station = Station.objects.create(name='Second', code='SECOND', latitude=17.25, longitude=-88.77,
+                                                     utc_offset_minutes=-360, reference_station=self.third_station)
+        self.first_station = Station.objects.create(name='First', code='FIRST', latitude=17.25, longitude=-88.77,
+                                                    utc_offset_minutes=-360, reference_station=self.second_station)
+
+        QcStepThreshold.objects.create(station=self.third_station, variable=self.variable, interval=None,
+                                       step_min=-2.0, step_max=2.0)
+        QcRangeThreshold.objects.create(station=self.first_station, variable=self.variable, interval=300, month=1,
+                                        range_min=0.0, range_max=30.0)
+        QcPersistThreshold.objects.create(station=self.first_station, variable=self.variable, interval=300,
+                                          window=3600, minimum_variance=0.5)
+
+    def test_reference_chain(self):
+        # The second station is first loaded as the reference of the first one, its own reference must still be followed
+        self.assertEqual(qc_thresholds_module.get_step_thresholds({}, self.first_station.id, self.variable.id, 300), {})
+
+        thresholds = qc_thresholds_module.get_step_thresholds({}, self.second_station.id, self.variable.id, 300)
+        self.assertEqual(thresholds, {'step_min': -2.0, 'step_max': 2.0,
+                                      'step_description': 'Reference station threshold'})
+
+    def test_thresholds_loaded_once(self):
+        # Variables, the station, its reference station, then the step, range and persistence thresholds of both
+        with self.assertNumQueries(6):
+            qc_thresholds_module.load_qc_thresholds([self.first_station.id])
+
+        with self.assertNumQueries(0):
+            qc_thresholds_module.load_qc_thresholds([self.first_station.id])
+            thresholds = qc_thresholds_module.get_range_thresholds({}, self.first_station.id, self.variable.id, 300, 1)
+            persist_thresholds = qc_thresholds_module.get_persist_thresholds({}, self.first_station.id,
+                                                                             self.variable.id, 300, 3600)
+
+        self.assertEqual(thresholds, {'range_min': 0.0, 'range_max': 30.0,
+                                      'range_description': 'Custom station Threshold'})
+        self.assertEqual(persist_thresholds, {'persist_min': 0.5, 'persist_des': 'Custom station Threshold'})
+
+    def test_thresholds_reloaded_after_an_edit(self):
+        qc_thresholds_module.load_qc_thresholds([self.first_station.id])
+
+        QcStepThreshold.objects.create(station=self.first_station, variable=self.variable, interval=300,
+                                       step_min=-1.0, step_max=1.0)
+        with self.assertNumQueries(0):
+            qc_thresholds_module.load_qc_thresholds([self.first_station.id])
+            self.assertEqual(qc_thresholds_module.get_step_thresholds({}, self.first_station.id, self.variable.id, 300), {})
+
+        # Another process edited the threshold, bumping the shared version
+        cache.set(qc_thresholds_module.QC_THRESHOLDS_VERSION_KEY, qc_thresholds_module.get_qc_thresholds_version() + 1, None)
+        with self.assertNumQueries(6):
+            qc_thresholds_module.load_qc_thresholds([self.first_station.id])
+
+        thresholds = qc_thresholds_module.get_step_thresholds({}, self.first_station.id, self.variable.id, 300)
+        self.assertEqual(thresholds, {'step_min': -1.0, 'step_max': 1.0, 'step_description': 'Custom station Threshold'})
+
+        # Edits of this process are seen right away
+        qc_thresholds_module.invalidate_qc_thresholds()
+        with self.assertNumQueries(6):
+            qc_thresholds_module.load_qc_thresholds([self.first_station.id])
+
+
+class PersistenceQualityControl(TestCase):
+
+    def get_series(self):
+        datetimes = pd.date_range('2019-04-03 00:00:00', periods=40, freq='60s', tz='UTC')
+        measured = [10.0, 10.0, 10.0, 10.0, 10.0, 10.0, 10.2, 11.0, 12.5, 12.5] * 4
+        df = pd.DataFrame({'datetime': datetimes, 'measured': measured, 'station_id': 1, 'variable_id': 10})
+        df['qc_persist_quality_flag'] = np.nan
+        df.loc[[3, 27], 'qc_persist_quality_flag'] = 3
+        df['qc_persist_description'] = None
+        df['qc_range_quality_flag'] = [4, 3, 1, np.nan] * 10
+        df['qc_step_quality_flag'] = 1
+        df['updated'] = df.index >= 5
+        # Rows come from the database without any order
+        return df.sample(frac=1, random_state=0)
+
+    def assert_same_as_row_wise(self, window, thresholds):
+        from wx.tasks import persist_flags, set_persist
+
+        df = self.get_series()
+        s_datetime, e_datetime = df[df['updated']].datetime.min(), df.datetime.max()
+
+        expected = df.copy()
+        columns = ['updated', 'qc_persist_quality_flag', 'qc_persist_description', 'quality_flag']
+        expected[columns] = df.apply(lambda row: set_persist(row, df, s_datetime, e_datetime, 60, window, thresholds),
+                                     axis=1, result_type="expand")
+        expected = expected.sort_values(by='datetime')
+
+        result = persist_flags(df, s_datetime, e_datetime, window, thresholds)
+
+        for column in columns:
+            self.assertEqual([None if value != value else value for value in expected[column].tolist()],
+                             [None if value != value else value for value in result[column].tolist()], column)
+
+    def test_persistence_thresholds(self):
+        self.assert_same_as_row_wise(300, {'persist_min': 0.5, 'persist_des': 'Custom station Threshold'})
+
+    def test_missing_thresholds(self):
+        self.assert_same_as_row_wise(300, {})
+        self.assert_same_as_row_wise(300, {'persist_min': None, 'persist_des': 'Global threshold (Manual)'})
+
+
+class ExportDataPivot(TestCase):
+
+    def test_pivot_export_rows(self):
+        from wx.tasks import pivot_export_rows
+
+        rows = [
+            (datetime(2020, 1, 1, 0, 0), 10, '1.5'),
+            (datetime(2020, 1, 1, 0, 0), 30, '-99.9'),
+            (datetime(2020, 1, 1, 0, 5), 10, '2.5'),
+            (datetime(2020, 1, 1, 0, 5), 30, '7'),
+        ]
+
+        self.assertEqual(list(pivot_export_rows(iter(rows), [10, 20, 30])), [
+            (datetime(2020, 1, 1, 0, 0), ['1.5', None, '-99.9']),
+            (datetime(2020, 1, 1, 0, 5), ['2.5', None, '7']),
+        ])
+        self.assertEqual(list(pivot_export_rows(iter([]), [10])), [])
+
+    def test_export_float_values(self):
+        from wx.tasks import export_float_values, get_netcdf_variable_name
+
+        batch = [(datetime(2020, 1, 1, 0, 0), ['1.5', '-99.9']), (datetime(2020, 1, 1, 0, 5), [None, '2'])]
+
+        self.assertEqual(export_float_values(batch, 0)[0], 1.5)
+        self.assertNotEqual(export_float_values(batch, 0)[1], export_float_values(batch, 0)[1])
+        self.assertNotEqual(export_float_values(batch, 1)[0], export_float_values(batch, 1)[0])
+        self.assertEqual(get_netcdf_variable_name('TEMP-2m'), 'TEMP_2m')
+        self.assertEqual(get_netcdf_variable_name('2RH'), 'v_2RH')
+
+    def test_export_cache_key(self):
+        from wx.tasks import get_export_cache_key
+
+        key = get_export_cache_key(1, 'raw_data', '2020-01-01 00:00:00', '2020-01-02 00:00:00', [10, 30], 300, 'csv')
+
+        self.assertEqual(key, get_export_cache_key('1', 'raw_data', '2020-01-01 00:00:00', '2020-01-02 00:00:00',
+                                                   ['30', '10'], 300, 'csv'))
+        self.assertNotEqual(key, get_export_cache_key(1, 'raw_data', '2020-01-01 00:00:00', '2020-01-02 00:00:00',
+                                                      [10, 30], 300, 'parquet'))
+
+
+class RawDataPageCursor(TestCase):
+
+    def test_cursor_round_trip(self):
+        from wx.utils import encode_raw_data_cursor, decode_raw_data_cursor
+
+        row_datetime = pytz.UTC.localize(datetime(2020, 1, 1, 0, 5))
+        token = encode_raw_data_cursor(row_datetime, 12, 30)
+
+        self.assertEqual(decode_raw_data_cursor(token), (row_datetime, 12, 30))
+        self.assertRaises(ValueError, decode_raw_data_cursor, 'not a cursor')
+
+    def test_invalid_search_type(self):
+        from wx.utils import get_raw_data_page
+
+        for search_type in (None, 'unknown'):
+            self.assertRaises(ValueError, get_raw_data_page, search_type, '1', None, '2020-01-01T00:00:00Z',
+                              '2020-01-02T00:00:00Z', 10)
+
+    def test_columnar_page(self):
+        from wx.views import raw_data_list_columns, RAW_DATA_LIST_COLUMNS
+
+        row_datetime = pytz.UTC.localize(datetime(2020, 1, 1, 0, 5))
+        rows = [(12, 30, 'TEMP', 'Temperature', 'Degrees Celsius', 'C', 21.456, row_datetime, 'G', 'Float', None),
+                (12, 31, 'WX', 'Weather', None, None, 1.0, row_datetime, 'G', 'Code', 'RA')]
+        columns = raw_data_list_columns(rows)
+
+        self.assertEqual(list(columns), [key for key, expression in RAW_DATA_LIST_COLUMNS])
+        self.assertEqual(columns['value'], [21.46, 'RA'])
+        self.assertEqual(columns['date'], [row_datetime, row_datetime])
+
+
+class ColumnarJson(TestCase):
+
+    fixtures = ['fixtures/wx_qualityflag.json', ]
+
+    def test_columnar_json_sql(self):
+        from wx.utils import columnar_json_sql, columnar_json_aliases
+
+        self.assertEqual(columnar_json_aliases(3), 'c0, c1, c2')
+        self.assertEqual(columnar_json_sql([('date', 'c1'), ('value', 'c2')], 'c1'),
+                         "json_build_object('date', COALESCE(json_agg(c1 ORDER BY c1), '[]'), "
+                         "'value', COALESCE(json_agg(c2 ORDER BY c1), '[]'))")
+
+    def test_raw_data_list_columns_match_rows(self):
+        from wx.views import raw_data_list
+
+        station = Station.objects.create(name='Columnar', code='COLUMNAR', latitude=17.25, longitude=-88.77,
+                                         utc_offset_minutes=-360)
+        temperature = Variable.objects.create(variable_type='Float', symbol='TEMP', name='Temperature')
+        weather = Variable.objects.create(variable_type='Code', symbol='WX', name='Weather')
+
+        with connection.cursor() as cursor:
+            for variable_id, read_datetime, measured, code in (
+                    (temperature.id, datetime(2020, 1, 1, 0, 5), 21.456, None),
+                    (weather.id, datetime(2020, 1, 1, 0, 6), 1.0, 'RA'),
+                    (temperature.id, datetime(2020, 1, 1, 0, 10, 0, 123456), -3.0, None)):
+                cursor.execute("""
+                    INSERT INTO raw_data (station_id, variable_id, datetime, measured, code, quality_flag)
+                    VALUES (%s, %s, %s, %s, %s, %s)
+                """, [station.id, variable_id, pytz.UTC.localize(read_datetime), measured, code, QualityFlagEnum.GOOD.id])
+
+        parameters = {'search_type': 'station', 'search_value': station.id,
+                      'search_date_start': '2020-01-01T00:00:00Z', 'search_date_end': '2020-01-02T00:00:00Z'}
+        rows = json.loads(raw_data_list(RequestFactory().get('/', parameters)).content)['results']
+        columns = json.loads(raw_data_list(RequestFactory().get('/', dict(parameters, format='columnar'))).content)['results']
+
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[2]['date'], '2020-01-01T00:10:00.123Z')
+        self.assertEqual(columns, {
+            'station': [row['station'] for row in rows],
+            'variable_id': [temperature.id, weather.id, temperature.id],
+            'variable': [row['variable']['symbol'] for row in rows],
+            'unit_symbol': [row['variable']['unit_symbol'] for row in rows],
+            'date': [row['date'] for row in rows],
+            'value': [row['value'] for row in rows],
+        })
+
+
+class PeriodSummaryKeys(TestCase):
+
+    def test_months_of_the_days(self):
+        from wx.tasks import get_period_summary_keys
+
+        self.assertEqual(get_period_summary_keys([1], datetime(2020, 1, 31).date(), datetime(2020, 2, 1).date()),
+                         {(1, datetime(2020, 1, 1))})
+        self.assertEqual(get_period_summary_keys([1, 2], datetime(2020, 12, 15).date(), datetime(2021, 1, 2).date()),
+                         {(1, datetime(2020, 12, 1)), (1, datetime(2021, 1, 1)),
+                          (2, datetime(2020, 12, 1)), (2, datetime(2021, 1, 1))})
+
+
+class PooledConnectionTestCase(TransactionTestCase):
+    """The code under test runs its queries on wx.db_pool connections, which are pointed at the test database. Rows
+    created by the tests are committed right away so those connections can see them."""
+
+    # raw_data references wx_station outside of the models, flushing the tables needs a cascade
+    available_apps = settings.INSTALLED_APPS
+
+    def setUp(self):
+        database = connection.settings_dict
+        self.pool = db_pool.ConnectionPool(f"dbname={database['NAME']} user={database['USER']} "
+                                           f"password={database['PASSWORD']} host={database['HOST']}",
+                                           max_size=settings.SURFACE_DB_POOL_MAX_SIZE,
+                                           timeout=settings.SURFACE_DB_POOL_TIMEOUT,
+                                           health_check_interval=settings.SURFACE_DB_POOL_HEALTH_CHECK_INTERVAL,
+                                           max_idle=settings.SURFACE_DB_POOL_MAX_IDLE)
+        patcher = mock.patch.object(db_pool, '_pool', self.pool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.close_pool)
+
+    def close_pool(self):
+        # The test database cannot be flushed or dropped while the pool keeps connections to it
+        for conn, released_at in self.pool._idle:
+            self.pool._discard(conn)
+        self.pool._idle.clear()
+
+    def execute(self, sql, params=None):
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            if cursor.description is not None:
+                return cursor.fetchall()
+
+    def insert_raw_data(self, reads):
+        # (station_id, variable_id, datetime, measured, consisted, quality_flag, manual_flag, is_daily)
+        for read in reads:
+            self.execute("""
+                INSERT INTO raw_data (station_id, variable_id, datetime, measured, consisted, quality_flag, manual_flag, is_daily)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+            """, read)
+
+
+class ContinuousAggregateSummaries(PooledConnectionTestCase):
+
+    fixtures = ['fixtures/wx_qualityflag.json', ]
+
+    def setUp(self):
+        super().setUp()
+        self.variable = Variable.objects.create(variable_type='Float', symbol='TEMP', name='Temperature')
+        self.daily_variable = Variable.objects.create(variable_type='Float', symbol='TEMPAVG', name='Daily temperature')
+        # Local days start at a bucket boundary for the first station but not for the second one
+        self.station = Station.objects.create(name='Aligned', code='ALIGNED', latitude=17.25, longitude=-88.77,
+                                              utc_offset_minutes=-360)
+        self.unaligned_station = Station.objects.create(name='Unaligned', code='UNALIGNED', latitude=17.25,
+                                                        longitude=-88.77, utc_offset_minutes=-350)
+        self.station_ids = (self.station.id, self.unaligned_station.id)
+        self.addCleanup(self.delete_summaries)
+
+        good = QualityFlagEnum.GOOD.id
+        bad = QualityFlagEnum.BAD.id
+        not_checked = QualityFlagEnum.NOT_CHECKED.id
+        variable_id = self.variable.id
+
+        def utc(*args):
+            return pytz.UTC.localize(datetime(*args))
+
+        self.insert_raw_data([
+            # UTC midnight, belongs to the last hour of the previous day
+            (self.station.id, variable_id, utc(2020, 1, 1, 0, 0), 1.0, None, good, None, False),
+            (self.station.id, variable_id, utc(2020, 1, 1, 0, 10), 2.0, None, good, None, False),
+            (self.station.id, variable_id, utc(2020, 1, 1, 0, 20), 3.0, 4.0, good, None, False),
+            (self.station.id, variable_id, utc(2020, 1, 1, 0, 30), 50.0, None, bad, None, False),
+            (self.station.id, variable_id, utc(2020, 1, 1, 0, 40), 50.0, None, bad, good, False),
+            (self.station.id, variable_id, utc(2020, 1, 1, 0, 50), settings.MISSING_VALUE, None, good, None, False),
+            (self.station.id, variable_id, utc(2020, 1, 1, 1, 0), 5.0, None, not_checked, None, False),
+            # Local midnight, belongs to the previous local day
+            (self.station.id, variable_id, utc(2020, 1, 1, 6, 0), 6.0, None, good, None, False),
+            (self.station.id, variable_id, utc(2020, 1, 1, 6, 15), 7.0, None, good, None, False),
+            (self.station.id, variable_id, utc(2020, 1, 2, 6, 0), 8.0, None, good, None, False),
+            (self.station.id, self.daily_variable.id, utc(2020, 1, 1, 18, 0), 9.5, None, good, None, True),
+            # The local midnight of the second station splits the 05:45 bucket
+            (self.unaligned_station.id, variable_id, utc(2020, 1, 1, 5, 45), 1.5, None, good, None, False),
+            (self.unaligned_station.id, variable_id, utc(2020, 1, 1, 5, 50), 2.5, None, good, None, False),
+            (self.unaligned_station.id, variable_id, utc(2020, 1, 1, 5, 55), 3.5, None, good, None, False),
+            (self.unaligned_station.id, variable_id, utc(2020, 1, 1, 6, 0), 4.5, None, good, None, False),
+        ])
+
+    def delete_summaries(self):
+        for table in ('hourly_summary', 'daily_summary'):
+            self.execute(f"DELETE FROM {table} WHERE station_id IN %s", [self.station_ids])
+
+    def summaries(self, table, date_column):
+        return self.execute(f"""
+            SELECT {date_column}, station_id, variable_id, min_value, max_value, avg_value, sum_value, num_records
+              FROM {table}
+             WHERE station_id IN %s
+             ORDER BY 1, 2, 3
+        """, [self.station_ids])
+
+    def test_hourly_summaries(self):
+        from wx.tasks import calculate_hourly_summary_aggregate, calculate_hourly_summary_range
+
+        first_hour = pytz.UTC.localize(datetime(2019, 12, 31, 23))
+        station_hours = [(station_id, first_hour + timedelta(hours=hours))
+                         for station_id in self.station_ids for hours in range(33)]
+
+        calculate_hourly_summary_range(station_hours)
+        expected = self.summaries('hourly_summary', 'datetime')
+        self.delete_summaries()
+
+        calculate_hourly_summary_aggregate(station_hours)
+        self.assertEqual(expected, self.summaries('hourly_summary', 'datetime'))
+        self.assertIn(first_hour, [row[0] for row in expected])
+
+    def test_daily_summaries(self):
+        from wx.tasks import calculate_daily_summary, calculate_daily_summary_aggregate
+
+        start_date = datetime(2019, 12, 31).date()
+        end_date = datetime(2020, 1, 3).date()
+
+        calculate_daily_summary(start_date, end_date, station_id_list=self.station_ids, period_summary_keys=set())
+        expected = self.summaries('daily_summary', 'day')
+        self.delete_summaries()
+
+        calculate_daily_summary_aggregate(start_date, end_date, self.station_ids, period_summary_keys=set())
+        self.assertEqual(expected, self.summaries('daily_summary', 'day'))
+        self.assertEqual(5, len(expected))
+
+
+class SummaryRebuild(PooledConnectionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.station = Station.objects.create(name='Rebuild', code='REBUILD', latitude=17.25, longitude=-88.77,
+                                              utc_offset_minutes=-360)
+        # The shard workers are run by the tests themselves
+        patcher = mock.patch('wx.tasks.group')
+        self.group = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def rebuild(self):
+        from wx.tasks import rebuild_summaries
+
+        return rebuild_summaries('2020-01-01', '2020-02-15', station_id_list=[self.station.id], concurrency=3)
+
+    def shards(self, rebuild_id):
+        return list(SummaryRebuildTask.objects.filter(rebuild_id=rebuild_id).order_by('start_date')
+                    .values_list('start_date', 'end_date', 'started_at', 'finished_at', 'attempts'))
+
+    def test_shards(self):
+        from wx.tasks import get_summary_rebuild_shards
+
+        self.assertEqual(get_summary_rebuild_shards([1, 2], datetime(2020, 1, 1).date(), datetime(2020, 3, 1).date()),
+                         [(1, datetime(2020, 1, 1).date(), datetime(2020, 2, 1).date()),
+                          (1, datetime(2020, 2, 1).date(), datetime(2020, 3, 1).date()),
+                          (2, datetime(2020, 1, 1).date(), datetime(2020, 2, 1).date()),
+                          (2, datetime(2020, 2, 1).date(), datetime(2020, 3, 1).date())])
+        self.assertEqual(get_summary_rebuild_shards([1], datetime(2020, 1, 1).date(), datetime(2020, 1, 1).date()), [])
+
+    def test_rebuild_summaries(self):
+        from wx.tasks import summary_rebuild_progress
+
+        rebuild_id = self.rebuild()
+
+        self.assertEqual(self.shards(rebuild_id), [(datetime(2020, 1, 1).date(), datetime(2020, 2, 1).date(), None, None, 0),
+                                                   (datetime(2020, 2, 1).date(), datetime(2020, 2, 15).date(), None, None, 0)])
+        self.assertEqual(summary_rebuild_progress(rebuild_id), {'total': 2, 'finished': 0, 'running': 0, 'pending': 2})
+        self.assertEqual(len(list(self.group.call_args[0][0])), 3)
+
+    def test_claim_and_lease_expiry(self):
+        from wx.tasks import claim_summary_tasks, SUMMARY_REBUILD_LEASE_SECONDS
+
+        rebuild_id = self.rebuild()
+
+        def claim():
+            return claim_summary_tasks('wx_summaryrebuildtask', ['start_date'], 'start_date', 1,
+                                       lease_seconds=SUMMARY_REBUILD_LEASE_SECONDS)
+
+        [(first_id, first_start_date)] = claim()
+        [(second_id, second_start_date)] = claim()
+        self.assertEqual((first_start_date, second_start_date), (datetime(2020, 1, 1).date(), datetime(2020, 2, 1).date()))
+        # Both shards are leased
+        self.assertEqual(claim(), [])
+
+        # The worker of the first shard crashed
+        SummaryRebuildTask.objects.filter(id=first_id).update(
+            started_at=pytz.UTC.localize(datetime.utcnow()) - timedelta(seconds=SUMMARY_REBUILD_LEASE_SECONDS + 60))
+        self.assertEqual(claim(), [(first_id, first_start_date)])
+        self.assertEqual(SummaryRebuildTask.objects.get(id=first_id).attempts, 2)
+        self.assertEqual(SummaryRebuildTask.objects.get(id=second_id).attempts, 1)
+
+    def test_failed_shards_are_retried_then_resumed(self):
+        from wx.tasks import process_summary_rebuild_tasks, resume_summary_rebuild, summary_rebuild_progress, \
+            SUMMARY_TASK_MAX_ATTEMPTS
+
+        rebuild_id = self.rebuild()
+
+        with mock.patch('wx.tasks.calculate_station_minimum_interval', side_effect=Exception('failed')):
+            process_summary_rebuild_tasks()
+
+        # Released after every failure and claimed again until out of attempts
+        self.assertEqual([shard[2:] for shard in self.shards(rebuild_id)],
+                         [(None, None, SUMMARY_TASK_MAX_ATTEMPTS), (None, None, SUMMARY_TASK_MAX_ATTEMPTS)])
+
+        resume_summary_rebuild(rebuild_id, concurrency=2)
+        self.assertEqual([shard[4] for shard in self.shards(rebuild_id)], [0, 0])
+        self.assertEqual(len(list(self.group.call_args[0][0])), 2)
+
+        process_summary_rebuild_tasks()
+        self.assertEqual(summary_rebuild_progress(rebuild_id), {'total': 2, 'finished': 2, 'running': 0, 'pending': 0})
+        self.assertEqual([shard[4] for shard in self.shards(rebuild_id)], [1, 1])
+
+    def test_resume_keeps_running_shards(self):
+        from wx.tasks import claim_summary_tasks, resume_summary_rebuild, SUMMARY_REBUILD_LEASE_SECONDS
+
+        rebuild_id = self.rebuild()
+        [(running_id, start_date)] = claim_summary_tasks('wx_summaryrebuildtask', ['start_date'], 'start_date', 1,
+                                                         lease_seconds=SUMMARY_REBUILD_LEASE_SECONDS)
+        started_at = SummaryRebuildTask.objects.get(id=running_id).started_at
+
+        resume_summary_rebuild(rebuild_id, concurrency=2)
+
+        running = SummaryRebuildTask.objects.get(id=running_id)
+        self.assertEqual((running.started_at, running.attempts), (started_at, 1))
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class CachedExportReuse(PooledConnectionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        export_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, export_path)
+        patcher = mock.patch.object(settings, 'EXPORTED_DATA_CELERY_PATH', export_path + '/')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.station = Station.objects.create(name='Export', code='EXPORT', latitude=17.25, longitude=-88.77,
+                                              utc_offset_minutes=-360)
+        self.parameters = ('raw_data', '2020-01-01 00:00:00', '2020-01-02 00:00:00', [10, 30])
+
+    def export(self, prepared_by):
+        return DataFile.objects.create(ready=False, prepared_by=prepared_by, interval_in_seconds=300, file_format='csv')
+
+    def test_each_request_gets_its_own_file(self):
+        from wx.tasks import get_export_cache_key, get_export_file_path, reuse_cached_export
+
+        first_datafile = self.export('First user')
+        self.assertFalse(reuse_cached_export(first_datafile, self.station.id, *self.parameters, 'csv'))
+
+        with open(get_export_file_path(first_datafile.id), 'w') as f:
+            f.write('Prepared by:,First user\n')
+        DataFile.objects.filter(id=first_datafile.id).update(ready=True, ready_at=datetime.now(tz=pytz.UTC), lines=1)
+        cache.set(get_export_cache_key(self.station.id, *self.parameters, 300, 'csv'), first_datafile.id)
+
+        second_datafile = self.export('Second user')
+        self.assertTrue(reuse_cached_export(second_datafile, self.station.id, *self.parameters, 'csv'))
+
+        second_datafile.refresh_from_db()
+        self.assertNotEqual(second_datafile.id, first_datafile.id)
+        self.assertEqual((second_datafile.ready, second_datafile.lines, second_datafile.prepared_by),
+                         (True, 1, 'First user'))
+        self.assertTrue(os.path.samefile(get_export_file_path(first_datafile.id), get_export_file_path(second_datafile.id)))
+
+        # Deleting the first export keeps the file of the second one
+        os.remove(get_export_file_path(first_datafile.id))
+        with open(get_export_file_path(second_datafile.id)) as f:
+            self.assertEqual(f.read(), 'Prepared by:,First user\n')
+        self.assertFalse(reuse_cached_export(self.export('Third user'), self.station.id, *self.parameters, 'csv'))
@@ -68,6 +68,7 @@ urlpatterns = [
     path('wx/data/export/download/', views.DownloadDataFile, name='data-export-download'),
     path('wx/data/export/delete/', views.DeleteDataFile, name='data-export-delete'),
     path('wx/data/export/schedule/', views.ScheduleDataExport, name='data-export-schedule'),
+    path('wx/data/export/stream/', views.StreamDataExport, name='data-export-stream'),
     path('get_yearly_average/', views.get_yearly_average),
     path('wx/reports/yearly_average/', views.YearlyAverageReport.as_view(), name='yearly-average'),
     path('wx/reports/synop_capture/', views.SynopCaptureView.as_view(), name='synop-capture'),
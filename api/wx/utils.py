@@ -1,4 +1,6 @@
+import base64
 import datetime
+import json
 import logging
 import os
 from builtins import IndexError
@@ -306,6 +308,39 @@ def get_monthly_or_yearly(search_type, station, variable, search_date_start, sea
     return response
 
 
+def columnar_json_sql(columns, order_by):
+    # json_build_object with an array per (key, expression) column, aggregated in order_by order
+    arrays = ', '.join(f"'{key}', COALESCE(json_agg({expression} ORDER BY {order_by}), '[]')"
+                       for key, expression in columns)
+    return f'json_build_object({arrays})'
+
+
+def columnar_datetime_sql(expression):
+    # Same text as DjangoJSONEncoder gives the datetimes of the row responses: UTC with 'Z' (json_agg gives '+00:00')
+    # and milliseconds only when there are fractions of a second
+    return (f"""to_char({expression} AT TIME ZONE 'UTC', CASE WHEN date_trunc('second', {expression}) = {expression} """
+            f"""THEN 'YYYY-MM-DD"T"HH24:MI:SS"Z"' ELSE 'YYYY-MM-DD"T"HH24:MI:SS.MS"Z"' END)""")
+
+
+def columnar_json_aliases(num_columns):
+    # Result columns of the wrapped query are named c0, c1, ... as they may repeat names (b.name, c.name)
+    return ', '.join(f'c{i}' for i in range(num_columns))
+
+
+def get_columnar_json(sql_string, params, num_columns, columns, order_by, where='TRUE'):
+    """Rows of sql_string as JSON text with an array per column, assembled by Postgres so no Python object is
+    created per row. columns are (key, SQL expression) pairs over the num_columns columns of sql_string, named c0,
+    c1, ... as the row indexes. None when there are no rows."""
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            SELECT count(*), {columnar_json_sql(columns, order_by)}::text
+              FROM ({sql_string}) AS q({columnar_json_aliases(num_columns)})
+             WHERE {where}
+        """, params)
+        num_rows, results = cursor.fetchone()
+        return results if num_rows else None
+
+
 def get_raw_data(search_type, search_value, search_value2, search_date_start, search_date_end, source='raw_data'):
     sql_string = ""
 
@@ -557,6 +592,79 @@ def get_raw_data(search_type, search_value, search_value2, search_date_start, se
     return response
 
 
+def encode_raw_data_cursor(row_datetime, station_id, variable_id):
+    token = json.dumps([row_datetime.isoformat(), station_id, variable_id])
+    return base64.urlsafe_b64encode(token.encode()).decode()
+
+
+def decode_raw_data_cursor(token):
+    # (datetime, station_id, variable_id) of the last row of the previous page
+    try:
+        row_datetime, station_id, variable_id = json.loads(base64.urlsafe_b64decode(token.encode()))
+        return datetime.datetime.fromisoformat(row_datetime), int(station_id), int(variable_id)
+    except (TypeError, ValueError):
+        raise ValueError(f'Invalid cursor "{token}".')
+
+
+def get_raw_data_page(search_type, search_value, search_value2, start_date, end_date, page_size, cursor_token=None):
+    """Page of raw data ordered by (datetime, station_id, variable_id), read from the unique index on those columns
+    after the row of cursor_token. Returns the rows and the cursor of the next page, None on the last page.
+    Raises ValueError for an unknown search_type or an invalid cursor."""
+    if search_type not in ['variable', 'station', 'stationvariable']:
+        raise ValueError('Invalid search_type. Expected variable, station or stationvariable')
+
+    params = {'start_date': start_date, 'end_date': end_date, 'limit': page_size + 1}
+    where = ['a.datetime >= %(start_date)s', 'a.datetime <= %(end_date)s']
+
+    if search_type in ['station', 'stationvariable']:
+        where.append('a.station_id = %(station_id)s')
+        params['station_id'] = search_value
+    if search_type == 'variable':
+        where.append('a.variable_id = %(variable_id)s')
+        params['variable_id'] = search_value
+    if search_type == 'stationvariable':
+        where.append('a.variable_id = %(variable_id)s')
+        params['variable_id'] = search_value2
+
+    if cursor_token:
+        params['after_datetime'], params['after_station_id'], params['after_variable_id'] = \
+            decode_raw_data_cursor(cursor_token)
+        where.append('(a.datetime, a.station_id, a.variable_id) > '
+                     '(%(after_datetime)s, %(after_station_id)s, %(after_variable_id)s)')
+        # Row comparisons do not exclude chunks, a plain bound on datetime does
+        where.append('a.datetime >= %(after_datetime)s')
+
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            SELECT station_id,
+                   variable_id,
+                   b.symbol,
+                   b.name,
+                   c.name,
+                   c.symbol,
+                   a.measured,
+                   a.datetime,
+                   q.symbol as quality_flag,
+                   b.variable_type,
+                   a.code
+            FROM raw_data a
+            JOIN wx_variable b ON a.variable_id=b.id
+            LEFT JOIN wx_unit c ON b.unit_id=c.id
+            JOIN wx_qualityflag q ON a.quality_flag=q.id
+            WHERE {' AND '.join(where)}
+            ORDER BY a.datetime, a.station_id, a.variable_id
+            LIMIT %(limit)s
+        """, params)
+        rows = cursor.fetchall()
+
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = encode_raw_data_cursor(rows[-1][7], rows[-1][0], rows[-1][1])
+
+    return rows, next_cursor
+
+
 def get_station_raw_data(search_type, search_values, search_value2, search_date_start, search_date_end, search_filter,
                          source='raw_data'):
     sql_string = ""
@@ -1,3 +1,4 @@
+import csv
 import datetime
 import io
 import json
@@ -21,7 +22,7 @@ from django.contrib.messages.views import SuccessMessageMixin
 from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
 from django.db import connection
-from django.http import HttpResponse, JsonResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.template import loader
 from django.urls import reverse
 from django.views.decorators.csrf import csrf_exempt
@@ -54,7 +55,7 @@ from wx.models import Country, Unit, Station, Variable, DataSource, StationVaria
     StationProfile, Document, Watershed, Interval
 from wx.utils import get_altitude, get_watershed, get_district, get_interpolation_image, parse_float_value, \
     parse_int_value
-from .utils import get_raw_data, get_station_raw_data
+from .utils import columnar_datetime_sql, get_columnar_json, get_raw_data, get_raw_data_page, get_station_raw_data
 from wx.models import MaintenanceReport, VisitType, Technician
 from django.views.decorators.http import require_http_methods
 from base64 import b64encode
@@ -70,6 +71,8 @@ from wx.models import Equipment, EquipmentType, Manufacturer, FundingSource, Sta
 from django.core.serializers import serialize
 from wx.models import MaintenanceReportEquipment
 from wx.models import QcRangeThreshold, QcStepThreshold, QcPersistThreshold
+from wx.db_pool import get_connection
+from wx.qc_thresholds import invalidate_qc_thresholds
 from simple_history.utils import update_change_reason
 from django.db.models.functions import Cast
 from django.db.models import IntegerField
@@ -79,13 +82,23 @@ logger = logging.getLogger('surface.urls')
 # CONSTANT to be used in datetime to milliseconds conversion
 EPOCH = datetime_constructor(1970, 1, 1, tzinfo=timezone.utc)
 
+# Rows per page of the keyset paginated raw data list
+RAW_DATA_PAGE_SIZE = 1000
+RAW_DATA_MAX_PAGE_SIZE = 10000
+
+# Bytes of CSV or JSON sent at once by the streaming export
+EXPORT_STREAM_CHUNK_SIZE = 64 * 1024
+
 
 @csrf_exempt
 def ScheduleDataExport(request):
     if request.method != 'POST':
         return HttpResponse(status=405)
 
-    json_body = json.loads(request.body)
+    return schedule_data_export(request, json.loads(request.body))
+
+
+def schedule_data_export(request, json_body):
     station_ids = json_body['stations']  # array with station ids
     data_source = json_body[
         'source']  # one of raw_data, hourly_summary, daily_summary, monthly_summary or yearly_summary
@@ -93,6 +106,11 @@ def ScheduleDataExport(request):
     end_date = json_body['end_datetime']  # in format %Y-%m-%d %H:%M:%S
     variable_ids = json_body['variables']  # list of obj in format {id: Int, agg: Str}
 
+    file_format = json_body.get('format', 'csv')  # one of csv, parquet or netcdf
+    if file_format not in tasks.EXPORT_FORMATS:
+        message = f'Invalid format "{file_format}".'
+        return JsonResponse(data={"message": message}, status=status.HTTP_400_BAD_REQUEST)
+
     data_interval_seconds = None
     if data_source == 'raw_data' and 'data_interval' in json_body:  # a number with the data interval in seconds. Only required for raw_data
         data_interval_seconds = json_body['data_interval']
@@ -125,22 +143,150 @@ def ScheduleDataExport(request):
     else:
         prepared_by = request.user.username
 
+    if json_body.get('bundle', False):  # a single archive with the files of all stations
+        newfile = DataFile.objects.create(ready=False, initial_date=start_date_utc, final_date=end_date_utc,
+                                          source=data_source_description, prepared_by=prepared_by, lines=0,
+                                          interval_in_seconds=data_interval_seconds, file_format='zip')
+        for station_id in station_ids:
+            DataFileStation.objects.create(datafile=newfile, station_id=station_id)
+
+        for variable_id in variable_ids:
+            variable = Variable.objects.get(pk=variable_id)
+            DataFileVariable.objects.create(datafile=newfile, variable=variable)
+
+        tasks.schedule_export_bundle(station_ids, data_source, start_date, end_date, variable_ids, newfile.id,
+                                     file_format)
+        return HttpResponse([newfile.id], status=status.HTTP_200_OK)
+
     for station_id in station_ids:
         newfile = DataFile.objects.create(ready=False, initial_date=start_date_utc, final_date=end_date_utc,
                                           source=data_source_description, prepared_by=prepared_by,
-                                          interval_in_seconds=data_interval_seconds)
+                                          interval_in_seconds=data_interval_seconds, file_format=file_format)
         DataFileStation.objects.create(datafile=newfile, station_id=station_id)
 
         for variable_id in variable_ids:
             variable = Variable.objects.get(pk=variable_id)
             DataFileVariable.objects.create(datafile=newfile, variable=variable)
 
-        tasks.export_data.delay(station_id, data_source, start_date, end_date, variable_ids, newfile.id)
+        if tasks.reuse_cached_export(newfile, station_id, data_source, start_date, end_date, variable_ids, file_format):
+            created_data_file_ids.append(newfile.id)
+            continue
+
+        tasks.export_data.delay(station_id, data_source, start_date, end_date, variable_ids, newfile.id, file_format)
         created_data_file_ids.append(newfile.id)
 
     return HttpResponse(created_data_file_ids, status=status.HTTP_200_OK)
 
 
+@csrf_exempt
+def StreamDataExport(request):
+    """Same request as ScheduleDataExport, answered with the data of a single station streamed as CSV or JSON.
+    Requests above EXPORT_STREAM_MAX_ROWS time steps, or beyond EXPORT_STREAM_MAX_CONCURRENT streams at the same time,
+    are scheduled as a file export instead (status 202)."""
+    if request.method != 'POST':
+        return HttpResponse(status=405)
+
+    json_body = json.loads(request.body)
+    station_ids = json_body['stations']
+    data_source = json_body['source']
+    start_date = json_body['start_datetime']
+    end_date = json_body['end_datetime']
+    variable_ids = json_body['variables']
+
+    stream_format = json_body.get('format', 'csv')  # one of csv or json
+    if stream_format not in ('csv', 'json'):
+        message = f'Invalid format "{stream_format}".'
+        return JsonResponse(data={"message": message}, status=status.HTTP_400_BAD_REQUEST)
+
+    data_interval_seconds = None
+    if data_source == 'raw_data':
+        data_interval_seconds = json_body.get('data_interval', 300)
+
+    estimated_rows = tasks.estimate_export_rows(data_source, start_date, end_date, data_interval_seconds)
+    stream_conn = None
+    if len(station_ids) == 1 and estimated_rows <= settings.EXPORT_STREAM_MAX_ROWS:
+        stream_conn = tasks.open_export_stream_connection()
+
+    # Also when all the stream slots are taken
+    if stream_conn is None:
+        response = schedule_data_export(request, dict(json_body, format='csv'))
+        if response.status_code == status.HTTP_200_OK:
+            response.status_code = status.HTTP_202_ACCEPTED
+        return response
+
+    try:
+        station = Station.objects.get(pk=station_ids[0])
+        variables = tasks.get_export_variables(variable_ids)
+        date_columns, date_formats = tasks.get_export_date_columns(data_source)
+        start_datetime, end_datetime = tasks.get_export_range(data_source, start_date, end_date)
+    except Exception:
+        stream_conn.close()
+        raise
+
+    # Time steps are read from a server-side cursor only as the chunks are written to the client
+    rows = tasks.iter_export_data(data_source, station, [variable['id'] for variable in variables], start_datetime,
+                                  end_datetime, data_interval_seconds, f'stream_export_{uuid.uuid4().hex}', stream_conn)
+
+    if stream_format == 'json':
+        content = stream_export_json(station, data_source, variables, rows)
+        response = StreamingHttpResponse(content, content_type='application/json')
+    else:
+        content = stream_export_csv(variables, date_columns, date_formats, rows)
+        response = StreamingHttpResponse(content, content_type='text/csv')
+        response['Content-Disposition'] = f'attachment; filename={station.code}.csv'
+
+    return response
+
+
+def stream_export_csv(variables, date_columns, date_formats, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(date_columns + [variable['symbol'] for variable in variables])
+
+    for row_datetime, values in rows:
+        writer.writerow([row_datetime.strftime(date_format) for date_format in date_formats] + values)
+        if buffer.tell() >= EXPORT_STREAM_CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    yield buffer.getvalue()
+
+
+def stream_export_value(value, is_code):
+    # Missing values are null, as in the other JSON endpoints
+    if value is None or str(value) == str(settings.MISSING_VALUE):
+        return None
+    return value if is_code else float(value)
+
+
+def stream_export_json(station, data_source, variables, rows):
+    header = {
+        'station': station.code,
+        'source': data_source,
+        'variables': [variable['symbol'] for variable in variables],
+    }
+    is_code = [tasks.is_code_variable(variable) for variable in variables]
+
+    chunk = [json.dumps(header)[:-1], ', "data": [']
+    chunk_size = 0
+    separator = ''
+    for row_datetime, values in rows:
+        values = [stream_export_value(value, code) for value, code in zip(values, is_code)]
+        line = separator + json.dumps([row_datetime.isoformat()] + values)
+        chunk.append(line)
+        chunk_size += len(line)
+        separator = ', '
+
+        if chunk_size >= EXPORT_STREAM_CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+            chunk_size = 0
+
+    chunk.append(']}')
+    yield ''.join(chunk)
+
+
 @api_view(('GET',))
 def DataExportFiles(request):
     files = []
@@ -152,13 +298,10 @@ def DataExportFiles(request):
         else:
             file_status = {'text': "Processing", 'value': 0}
 
-        current_station_name = None
-        try:
-            current_data_file = DataFileStation.objects.get(datafile_id=df['id'])
-            current_station = Station.objects.get(pk=current_data_file.station_id)
-            current_station_name = current_station.name
-        except ObjectDoesNotExist:
-            current_station_name = "Station not found"
+        # Export bundles have several stations
+        station_names = DataFileStation.objects.filter(datafile_id=df['id']).order_by('station__name') \
+            .values_list('station__name', flat=True)
+        current_station_name = ', '.join(station_names) or "Station not found"
 
         f = {
             'id': df['id'],
@@ -172,7 +315,8 @@ def DataExportFiles(request):
             'source': {'text': df['source'],
                        'value': 0 if df['source'] == 'Raw data' else (1 if df['source'] == 'Hourly summary' else 2)},
             'lines': df['lines'],
-            'prepared_by': df['prepared_by']
+            'prepared_by': df['prepared_by'],
+            'format': df['file_format'],
         }
         if f['ready_date'] is not None:
             f['ready_date'] = f['ready_date']
@@ -185,10 +329,11 @@ def DataExportFiles(request):
 
 def DownloadDataFile(request):
     file_id = request.GET.get('id', None)
-    file_path = os.path.join('/data', 'exported_data', str(file_id) + '.csv')
+    file_format = DataFile.objects.filter(pk=file_id).values_list('file_format', flat=True).first() or 'csv'
+    file_path = tasks.get_export_file_path(file_id, file_format)
     if os.path.exists(file_path):
         with open(file_path, 'rb') as fh:
-            response = HttpResponse(fh.read(), content_type="text/csv")
+            response = HttpResponse(fh.read(), content_type=tasks.EXPORT_FILE_TYPES[file_format][1])
             response['Content-Disposition'] = 'inline; filename=' + os.path.basename(file_path)
             return response
     return JsonResponse({}, status=status.HTTP_404_NOT_FOUND)
@@ -200,7 +345,7 @@ def DeleteDataFile(request):
     DataFileStation.objects.filter(datafile=df).delete()
     DataFileVariable.objects.filter(datafile=df).delete()
     df.delete()
-    file_path = os.path.join('/data', 'exported_data', str(file_id) + '.csv')
+    file_path = tasks.get_export_file_path(file_id, df.file_format)
     if os.path.exists(file_path):
         os.remove(file_path)
     return JsonResponse({}, status=status.HTTP_200_OK)
@@ -775,6 +920,97 @@ def station_telemetry_data(request, date):
     return Response(data)
 
 
+def columnar_json_response(results, **fields):
+    # results is JSON text assembled by Postgres, inserted in the response without decoding it
+    extra_fields = ''.join(f', {json.dumps(key)}: {json.dumps(value)}' for key, value in fields.items())
+    return HttpResponse(f'{{"results": {results}{extra_fields}}}', content_type='application/json')
+
+
+# Columns of format=columnar responses, as (key, SQL expression) over the row indexes of each list query
+RAW_DATA_LIST_COLUMNS = [
+    ('station', 'c0'),
+    ('variable_id', 'c1'),
+    ('variable', 'c2'),
+    ('unit_symbol', 'c5'),
+    ('date', columnar_datetime_sql('c7')),
+    ('value', "CASE WHEN lower(c9) = 'code' THEN to_json(c10) ELSE to_json(round(c6::numeric, 2)) END"),
+]
+
+SUMMARY_LIST_VALUE = 'CASE WHEN c4 IN (1, 2) THEN c9 WHEN c4 = 3 THEN c7 WHEN c4 = 4 THEN c8 ELSE c10 END'
+
+HOURLY_SUMMARY_LIST_COLUMNS = [
+    ('station', 'c0'),
+    ('variable_id', 'c1'),
+    ('variable', 'c2'),
+    ('unit_symbol', 'c6'),
+    ('date', columnar_datetime_sql('c12')),
+    ('value', f'round(({SUMMARY_LIST_VALUE})::numeric, 2)'),
+    ('min', 'round(c7::numeric, 2)'),
+    ('max', 'round(c8::numeric, 2)'),
+    ('avg', 'round(c9::numeric, 2)'),
+    ('sum', 'round(c10::numeric, 2)'),
+    ('count', 'c11'),
+]
+
+DAILY_SUMMARY_LIST_COLUMNS = [
+    ('station', 'c0'),
+    ('variable_id', 'c1'),
+    ('variable', 'c2'),
+    ('unit_symbol', 'c6'),
+    ('date', 'c11'),
+    ('value', f'round(({SUMMARY_LIST_VALUE})::numeric, 2)'),
+    ('min', 'round(c7::numeric, 2)'),
+    ('max', 'round(c8::numeric, 2)'),
+    ('avg', 'round(c9::numeric, 2)'),
+    ('total', 'round(c10::numeric, 2)'),
+    ('count', 'c12'),
+]
+
+QC_LIST_COLUMNS = [
+    ('datetime', columnar_datetime_sql('c0')),
+    ('measured', 'c1'),
+    ('consisted', 'c2'),
+    ('automatic_flag', 'c3'),
+    ('manual_flag', 'c4'),
+    ('station_id', 'c5'),
+    ('variable_id', 'c6'),
+    ('remarks', 'c7'),
+    ('ml_flag', 'c8'),
+]
+
+
+def raw_data_list_result(row):
+    if row[9] is not None and row[9].lower() == 'code':
+        value = row[10]
+    else:
+        value = round(row[6], 2)
+
+    return {
+        'station': row[0],
+        'date': row[7],
+        'value': value,
+        'variable': {
+            'symbol': row[2],
+            'name': row[3],
+            'unit_name': row[4],
+            'unit_symbol': row[5]
+        }
+    }
+
+
+def raw_data_list_columns(rows):
+    # Same columns as RAW_DATA_LIST_COLUMNS, for the pages of rows already fetched
+    results = [raw_data_list_result(row) for row in rows]
+    return {
+        'station': [row[0] for row in rows],
+        'variable_id': [row[1] for row in rows],
+        'variable': [row[2] for row in rows],
+        'unit_symbol': [row[5] for row in rows],
+        'date': [row[7] for row in rows],
+        'value': [result['value'] for result in results],
+    }
+
+
 def raw_data_list(request):
     search_type = request.GET.get('search_type', None)
     search_value = request.GET.get('search_value', None)
@@ -802,9 +1038,19 @@ def raw_data_list(request):
         message = 'Invalid date format. Expected YYYY-MM-DDTHH:MI:SSZ'
         return JsonResponse(data={"message": message}, status=status.HTTP_400_BAD_REQUEST)
 
+    # Keyset paginated requests are not restricted to seven days
+    paginated = 'page_size' in request.GET or 'cursor' in request.GET
+    try:
+        page_size = int(request.GET.get('page_size', RAW_DATA_PAGE_SIZE))
+    except ValueError:
+        page_size = 0
+    if paginated and not 0 < page_size <= RAW_DATA_MAX_PAGE_SIZE:
+        message = f'Invalid page_size. Expected a number between 1 and {RAW_DATA_MAX_PAGE_SIZE}'
+        return JsonResponse(data={"message": message}, status=status.HTTP_400_BAD_REQUEST)
+
     delta = end_date - start_date
 
-    if delta.days > 8:  # Restrict queries to max seven days
+    if not paginated and delta.days > 8:  # Restrict queries to max seven days
         message = 'Interval between start date and end date is greater than one week.'
         return JsonResponse(data={"message": message}, status=status.HTTP_400_BAD_REQUEST)
 
@@ -816,6 +1062,19 @@ def raw_data_list(request):
         finally:
             search_value = station.id
 
+    if paginated:
+        try:
+            rows, response['next'] = get_raw_data_page(search_type, search_value, search_value2, search_date_start,
+                                                       search_date_end, page_size, request.GET.get('cursor'))
+        except ValueError as e:
+            return JsonResponse(data={"message": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        if request.GET.get('format') == 'columnar':
+            response['results'] = raw_data_list_columns(rows)
+        else:
+            response['results'] = [raw_data_list_result(row) for row in rows]
+        return JsonResponse(response, status=status.HTTP_200_OK)
+
     if search_type is not None and search_type == 'variable':
         sql_string = """
             SELECT station_id,
@@ -879,6 +1138,16 @@ def raw_data_list(request):
     if sql_string:
         sql_string += " ORDER BY datetime"
 
+        if request.GET.get('format') == 'columnar':
+            if search_type == 'stationvariable':
+                params = [search_value, search_value2, search_date_start, search_date_end]
+            else:
+                params = [search_value, search_date_start, search_date_end]
+            results = get_columnar_json(sql_string, params, 11, RAW_DATA_LIST_COLUMNS, 'c7')
+            if results is None:
+                return JsonResponse(data={"message": "No data found."}, status=status.HTTP_404_NOT_FOUND)
+            return columnar_json_response(results, messages=[])
+
         with connection.cursor() as cursor:
 
             if search_type is not None and search_type == 'stationvariable':
@@ -892,25 +1161,7 @@ def raw_data_list(request):
             rows = cursor.fetchall()
 
             for row in rows:
-
-                if row[9] is not None and row[9].lower() == 'code':
-                    value = row[10]
-                else:
-                    value = round(row[6], 2)
-
-                obj = {
-                    'station': row[0],
-                    'date': row[7],
-                    'value': value,
-                    'variable': {
-                        'symbol': row[2],
-                        'name': row[3],
-                        'unit_name': row[4],
-                        'unit_symbol': row[5]
-                    }
-                }
-
-                response['results'].append(obj)
+                response['results'].append(raw_data_list_result(row))
 
             if response['results']:
                 return JsonResponse(response, status=status.HTTP_200_OK)
@@ -1022,6 +1273,17 @@ def hourly_summary_list(request):
     if sql_string:
         sql_string += " ORDER BY datetime"
 
+        if request.GET.get('format') == 'columnar':
+            if search_type == 'stationvariable':
+                params = [search_value, search_value2, search_date_start, search_date_end]
+            else:
+                params = [search_value, search_date_start, search_date_end]
+            results = get_columnar_json(sql_string, params, 13, HOURLY_SUMMARY_LIST_COLUMNS, 'c12',
+                                        where=f'({SUMMARY_LIST_VALUE}) IS NOT NULL')
+            if results is None:
+                return JsonResponse(data=response)
+            return columnar_json_response(results, messages=[])
+
         with connection.cursor() as cursor:
 
             if search_type is not None and search_type == 'stationvariable':
@@ -1190,6 +1452,17 @@ def daily_summary_list(request):
     if sql_string:
         sql_string += " ORDER BY day"
 
+        if request.GET.get('format') == 'columnar':
+            if search_type == 'stationvariable':
+                params = [search_value, search_value2, search_date_start, search_date_end]
+            else:
+                params = [search_value, search_date_start, search_date_end]
+            results = get_columnar_json(sql_string, params, 13, DAILY_SUMMARY_LIST_COLUMNS, 'c11',
+                                        where=f'({SUMMARY_LIST_VALUE}) IS NOT NULL')
+            if results is None:
+                return JsonResponse(data=response)
+            return columnar_json_response(results, messages=[])
+
         with connection.cursor() as cursor:
 
             if search_type is not None and search_type == 'stationvariable':
@@ -1900,6 +2173,13 @@ def qc_list(request):
             sql_string += " AND %s >= value.datetime "
 
         sql_string += " ORDER BY value.datetime "
+
+        if request.GET.get('format') == 'columnar':
+            results = get_columnar_json(sql_string, where_parameters, 9, QC_LIST_COLUMNS, 'c0')
+            if results is None:
+                return JsonResponse(response)
+            return columnar_json_response(results, count=-999, next=None, previous=None)
+
         with connection.cursor() as cursor:
 
             cursor.execute(sql_string, where_parameters)
@@ -1982,7 +2262,7 @@ def qc_list(request):
             sql_query = f"UPDATE raw_data SET {', '.join(sql_columns_to_update)} WHERE datetime=%s AND station_id=%s AND variable_id=%s"
 
             station = Station.objects.get(pk=station_id)
-            with psycopg2.connect(settings.SURFACE_CONNECTION_STRING) as conn:
+            with get_connection() as conn:
                 with conn.cursor() as cursor:
                     cursor.execute(sql_query, query_parameters)
 
@@ -2142,7 +2422,7 @@ def capture_forms_values_patch(request):
 
         body = json.loads(request.body.decode('utf-8'))
 
-        conn = psycopg2.connect(settings.SURFACE_CONNECTION_STRING)
+        conn = get_connection()
         with conn.cursor() as cursor:
             cursor.executemany(
                """
@@ -2167,7 +2447,7 @@ def capture_forms_values_patch(request):
 
         body = json.loads(request.body.decode('utf-8'))
 
-        with psycopg2.connect(settings.SURFACE_CONNECTION_STRING) as conn:
+        with get_connection() as conn:
             with conn.cursor() as cursor:
                 for rec in body:
                     try:
@@ -2379,7 +2659,7 @@ def pgia_load(request):
     start_datetime = request_datetime
     end_datetime = request_datetime + datetime.timedelta(days=1)
 
-    with psycopg2.connect(settings.SURFACE_CONNECTION_STRING) as conn:
+    with get_connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute(
                 f"""
@@ -2419,7 +2699,7 @@ def MonthlyFormLoad(request):
     datetime_offset = pytz.FixedOffset(station.utc_offset_minutes)
     end_date = start_date.replace(month=start_date.month + 1) - datetime.timedelta(days=1)
 
-    with psycopg2.connect(settings.SURFACE_CONNECTION_STRING) as conn:
+    with get_connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute(
                 f"""
@@ -2446,32 +2726,31 @@ def MonthlyFormLoad(request):
 
 @api_view(['POST'])
 def MonthlyFormUpdate(request):
-    with psycopg2.connect(settings.SURFACE_CONNECTION_STRING) as conn:
-        records_list = []
+    records_list = []
 
-        station_id = int(request.data['station'])
-        station = Station.objects.get(id=station_id)
-        first_day = datetime.datetime(year=int(request.data['date']['year']), month=int(request.data['date']['month']),
-                                      day=1)
+    station_id = int(request.data['station'])
+    station = Station.objects.get(id=station_id)
+    first_day = datetime.datetime(year=int(request.data['date']['year']), month=int(request.data['date']['month']),
+                                  day=1)
 
-        now_utc = datetime.datetime.now().astimezone(pytz.UTC)
-        datetime_offset = pytz.FixedOffset(station.utc_offset_minutes)
+    now_utc = datetime.datetime.now().astimezone(pytz.UTC)
+    datetime_offset = pytz.FixedOffset(station.utc_offset_minutes)
 
-        days_in_month = (first_day.replace(month=first_day.month + 1) - datetime.timedelta(days=1)).day
+    days_in_month = (first_day.replace(month=first_day.month + 1) - datetime.timedelta(days=1)).day
 
-        for day in range(0, days_in_month):
-            data = request.data['table'][day]
-            data_datetime = first_day.replace(day=day + 1)
-            data_datetime = datetime_offset.localize(data_datetime)
+    for day in range(0, days_in_month):
+        data = request.data['table'][day]
+        data_datetime = first_day.replace(day=day + 1)
+        data_datetime = datetime_offset.localize(data_datetime)
 
-            if data_datetime <= now_utc:
-                for variable_id, value in data.items():
-                    if value is None:
-                        value = settings.MISSING_VALUE
+        if data_datetime <= now_utc:
+            for variable_id, value in data.items():
+                if value is None:
+                    value = settings.MISSING_VALUE
 
-                    records_list.append((
-                        station_id, variable_id, 86400, data_datetime, value, 1, None, None, None, None,
-                        None, None, None, None, False, None, None, None))
+                records_list.append((
+                    station_id, variable_id, 86400, data_datetime, value, 1, None, None, None, None,
+                    None, None, None, None, False, None, None, None))
 
     insert_raw_data_pgia.insert(raw_data_list=records_list, date=first_day, station_id=station_id,
                                 override_data_on_conflict=True, utc_offset_minutes=station.utc_offset_minutes)
@@ -5121,6 +5400,8 @@ def update_reference_station(request):
     station.reference_station_id = new_reference_station_id
     station.save()
 
+    invalidate_qc_thresholds()
+
     response = {}
     return JsonResponse(response, status=status.HTTP_200_OK)
 
@@ -5166,6 +5447,8 @@ def update_global_threshold(request):
 
     variable.save()
 
+    invalidate_qc_thresholds()
+
     response = {}
     return JsonResponse(response, status=status.HTTP_200_OK)
 
@@ -5214,7 +5497,7 @@ def range_threshold_view(request): # For synop and daily data captures
         """
 
         result = []
-        with psycopg2.connect(settings.SURFACE_CONNECTION_STRING) as conn:
+        with get_connection() as conn:
             with conn.cursor() as cursor:
                 cursor.execute(get_range_threshold_query, query_parameters)
 
@@ -5271,7 +5554,7 @@ def range_threshold_view(request): # For synop and daily data captures
             INSERT INTO wx_qcrangethreshold (created_at, updated_at, range_min, range_max, station_id, variable_id, interval, month) 
             VALUES (now(), now(), %(range_min)s, %(range_max)s , %(station_id)s, %(variable_id)s, %(interval)s, %(month)s)
         """
-        with psycopg2.connect(settings.SURFACE_CONNECTION_STRING) as conn:
+        with get_connection() as conn:
             with conn.cursor() as cursor:
                 try:
                     cursor.execute(post_range_threshold_query,
@@ -5283,6 +5566,8 @@ def range_threshold_view(request): # For synop and daily data captures
                                         status=status.HTTP_400_BAD_REQUEST)
 
             conn.commit()
+
+        invalidate_qc_thresholds()
         return Response(status=status.HTTP_200_OK)
 
 
@@ -5317,7 +5602,7 @@ def range_threshold_view(request): # For synop and daily data captures
             WHERE id = %(range_threshold_id)s
         """
 
-        with psycopg2.connect(settings.SURFACE_CONNECTION_STRING) as conn:
+        with get_connection() as conn:
             with conn.cursor() as cursor:
                 try:
                     cursor.execute(patch_range_threshold_query,
@@ -5329,6 +5614,8 @@ def range_threshold_view(request): # For synop and daily data captures
                                         status=status.HTTP_400_BAD_REQUEST)
 
             conn.commit()
+
+        invalidate_qc_thresholds()
         return Response(status=status.HTTP_200_OK)
 
 
@@ -5340,7 +5627,7 @@ def range_threshold_view(request): # For synop and daily data captures
                          status=status.HTTP_400_BAD_REQUEST)
 
         delete_range_threshold_query = f""" DELETE FROM wx_qcrangethreshold WHERE id = %(range_threshold_id)s """
-        with psycopg2.connect(settings.SURFACE_CONNECTION_STRING) as conn:
+        with get_connection() as conn:
             with conn.cursor() as cursor:
                 try:
                     cursor.execute(delete_range_threshold_query, {'range_threshold_id': range_threshold_id})
@@ -5350,6 +5637,8 @@ def range_threshold_view(request): # For synop and daily data captures
                                         status=status.HTTP_400_BAD_REQUEST)
 
             conn.commit()
+
+        invalidate_qc_thresholds()
         return Response(status=status.HTTP_200_OK)
 
     return Response([], status=status.HTTP_200_OK)
@@ -5542,6 +5831,8 @@ def update_range_threshold(request):
 
     qcrangethreshold.save()
 
+    invalidate_qc_thresholds()
+
     response = {}
     return JsonResponse(response, status=status.HTTP_200_OK)
 
@@ -5564,6 +5855,7 @@ def delete_range_threshold(request):
     try:
         qcrangethreshold = QcRangeThreshold.objects.get(station_id=station.id, variable_id=variable.id, month=month_id, interval=interval_seconds)
         qcrangethreshold.delete()
+        invalidate_qc_thresholds()
     except ObjectDoesNotExist:
         pass
 
@@ -5721,6 +6013,8 @@ def update_step_threshold(request):
 
     qcstepthreshold.save()
 
+    invalidate_qc_thresholds()
+
     response = {}
     return JsonResponse(response, status=status.HTTP_200_OK)
 
@@ -5738,6 +6032,7 @@ def delete_step_threshold(request):
     try:
         qcstepthreshold = QcStepThreshold.objects.get(station_id=station.id, variable_id=variable.id, interval=interval_seconds)        
         qcstepthreshold.delete()
+        invalidate_qc_thresholds()
     except ObjectDoesNotExist:
         pass
 
@@ -5895,6 +6190,8 @@ def update_persist_threshold(request):
 
     qcpersistthreshold.save()
 
+    invalidate_qc_thresholds()
+
     response = {}
     return JsonResponse(response, status=status.HTTP_200_OK)
 
@@ -5912,6 +6209,7 @@ def delete_persist_threshold(request):
     try:
         qcpersistthreshold = QcPersistThreshold.objects.get(station_id=station.id, variable_id=variable.id, interval=interval_seconds)        
         qcpersistthreshold.delete()
+        invalidate_qc_thresholds()
     except ObjectDoesNotExist:
         pass
 
@@ -6462,7 +6760,7 @@ def delete_pgia_hourly_capture_row(request):
         ON CONFLICT DO NOTHING
     """
 
-    with psycopg2.connect(settings.SURFACE_CONNECTION_STRING) as conn:
+    with get_connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute(delete_query, {"station_id": station_id, "variable_id_list": variable_id_list,
                                           "current_datetime": current_datetime})